@@ -0,0 +1,201 @@
+import os, sys, json, time, argparse, tempfile, subprocess, tracemalloc
+from synth import *
+from realtime import *
+from rawdata import *
+import hrv
+
+def _frames(ctx):
+    with open(ctx["file"], "rb") as f:
+        data = f.read(ctx["packets"] * 95)
+    offsets, lengths = frame_offsets(data, partial=True)
+    return [data[o:o + l] for o, l in zip(offsets.tolist(), lengths.tolist())]
+
+def _rr(ctx):
+    # the rr intervals of the first few hours, like the hrv.py window
+    table = parse_table(ctx["file"]).between(None, ctx["start"] + ctx["window"])
+    return table.rr[np.arange(4) < table.rr_count[:, None]].astype(np.float64)
+
+def _frequency_loop(times, rrs, interval=300):
+    # one calculate_frequency_domain_metrics call per window, what the batch engine replaces
+    keys = times - times % interval
+    bounds = np.flatnonzero(np.diff(keys)) + 1
+    return [hrv.calculate_frequency_domain_metrics(rr) for rr in np.split(rrs, bounds) if len(rr) > 1]
+
+def _realtime(ctx):
+    # the first records as parsed REALTIME_DATA packets, like the strap streams them
+    table = parse_table(ctx["file"])
+    n = ctx["packets"]
+    packets = []
+    for unix, subsec, heart, count, rr in zip(*(getattr(table, name)[:n].tolist() for name in ("unix", "subsec", "heart_rate", "rr_count", "rr"))):
+        count = min(count, 3)
+        data = struct.pack("<3sHBB3H", struct.pack("<L", unix)[1:], subsec, heart, count, *rr[:3]) + b"\x00" * 4
+        packets.append(WhoopPacket.from_data(WhoopPacket(PacketType.REALTIME_DATA, 0, unix & 0xff, data).framed_packet()))
+    return packets
+
+def _realtime_push(packets):
+    buffer = RealtimeBuffer(4096)
+    for packet in packets:
+        buffer.push(packet)
+    return buffer.last()
+
+def _responses(ctx):
+    # parsed clock, battery and wrist event packets, like the cmd and events characteristics deliver them,
+    # responses carry the strap's seq in the header and the request seq and status first in the data
+    packets = [
+        WhoopPacket(PacketType.COMMAND_RESPONSE, 0xb8, CommandNumber.GET_CLOCK, b"\x0a\x01" + struct.pack("<LH", ctx["start"], 0)),
+        WhoopPacket(PacketType.COMMAND_RESPONSE, 0xb9, CommandNumber.GET_BATTERY_LEVEL, b"\x0b\x01" + struct.pack("<H", 875)),
+        WhoopPacket(PacketType.EVENT, 3, EventNumber.WRIST_ON, b"\x00" + struct.pack("<LH", ctx["start"], 0) + bytes(6)),
+    ]
+    frames = [p.framed_packet() for p in packets]
+    return [WhoopPacket.from_data(frames[i % 3]) for i in range(ctx["packets"])]
+
+def _raw(ctx):
+    # raw data blocks of 100 samples per axis
+    rng = np.random.default_rng(ctx["seed"])
+    return b"".join(raw_packet(PacketType.REALTIME_RAW_DATA, i & 0xFF, ctx["start"] + i, 0, 60, rng.integers(-4096, 4096, (100, 3)), rng.integers(-4096, 4096, (100, 3)))
+                    for i in range(ctx["packets"] // 10))
+
+def _import(module):
+    # a fresh interpreter importing the module, what every CLI run pays before doing anything
+    subprocess.run([sys.executable, "-c", f"import {module}"], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    return [module]
+
+# name: (setup, run, what is counted), setup runs untimed and its result is passed to run
+STAGES = {
+    "synth": (lambda ctx: ctx, lambda ctx: write_dump(ctx["scratch"], ctx["days"], ctx["start"], ctx["seed"]), "records"),
+    "from_data": (_frames, lambda frames: [WhoopPacket.from_data(f) for f in frames], "packets"),
+    "framed_packet": (lambda ctx: [WhoopPacket.from_data(f) for f in _frames(ctx)], lambda packets: [p.framed_packet() for p in packets], "packets"),
+    "parse_table": (lambda ctx: ctx["file"], parse_table, "records"),
+    "parse_data": (lambda ctx: ctx["file"], parse_data, "records"),
+    "interpolate_anomalies": (lambda ctx: parse_data(ctx["file"]), HistoricalRecord.interpolate_anomalies, "records"),
+    "interpolate_table": (lambda ctx: parse_table(ctx["file"]), lambda table: table.interpolate_anomalies(), "records"),
+    "downsample": (lambda ctx: parse_data(ctx["file"]), HistoricalRecord.downsample, "records"),
+    "downsample_table": (lambda ctx: parse_table(ctx["file"]), lambda table: table.downsample(60, percentiles=(5, 50, 95)), "records"),
+    "hrv_time_domain": (_rr, hrv.calculate_time_domain_metrics, "beats"),
+    "hrv_score": (_rr, hrv.calculate_hrv, "beats"),
+    "hrv_frequency_domain": (_rr, hrv.calculate_frequency_domain_metrics, "beats"),
+    "hrv_tumbling": (lambda ctx: hrv.table_beats(parse_table(ctx["file"])), lambda beats: list(hrv.tumbling(*beats, 300)), "beats"),
+    "hrv_sliding": (lambda ctx: hrv.table_beats(parse_table(ctx["file"])), lambda beats: list(hrv.sliding(*beats, 300, 60)), "beats"),
+    "hrv_frequency_loop": (lambda ctx: hrv.table_beats(parse_table(ctx["file"])), lambda beats: _frequency_loop(*beats), "beats"),
+    "hrv_frequency_windows": (lambda ctx: hrv.table_beats(parse_table(ctx["file"])), lambda beats: hrv.frequency_windows(*beats, 300), "beats"),
+    "realtime_str": (_realtime, lambda packets: [str(p) for p in packets], "packets"),
+    "realtime_push": (_realtime, _realtime_push, "packets"),
+    "packet_str": (_responses, lambda packets: [str(p) for p in packets], "packets"),
+    "packet_decode": (_responses, lambda packets: [p.decode() for p in packets], "packets"),
+    "raw_decode": (_raw, RawTable.from_buffer, "samples"),
+    "import_packet": (lambda ctx: "packet", _import, "imports"),
+    "import_parser": (lambda ctx: "parser", _import, "imports"),
+    "import_hrv": (lambda ctx: "hrv", _import, "imports"),
+    "import_plot": (lambda ctx: "plot", _import, "imports"),
+    "import_whoop": (lambda ctx: "whoop", _import, "imports"),
+}
+
+def _count(value, arg):
+    # items going into the stage, or coming out of it for the stages that read a file
+    if isinstance(arg, (list, np.ndarray, HistoricalTable)):
+        return len(arg)
+    if isinstance(arg, tuple):
+        return len(arg[0])
+    if isinstance(value, (list, HistoricalTable, RawTable)):
+        return len(value)
+    return 0
+
+def run_stage(name, ctx, repeat=3, memory=True):
+    """
+    Times a stage, best of repeat runs, and measures its peak traced memory in one more run.
+    """
+    setup, run, unit = STAGES[name]
+    best = None
+    count = 0
+    for _ in range(repeat):
+        arg = setup(ctx)
+        start = time.perf_counter()
+        value = run(arg)
+        seconds = time.perf_counter() - start
+        count = _count(value, arg) if name != "synth" else value
+        best = seconds if best is None else min(best, seconds)
+        del arg, value
+
+    peak = 0
+    if memory:
+        arg = setup(ctx)
+        tracemalloc.start()
+        run(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del arg
+
+    return {"seconds": best, "count": count, "unit": unit, "rate": count / best if best else 0.0, "peak_bytes": peak}
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the stages that got slower than the baseline by more than tolerance.
+    """
+    slower = []
+    for name, result in results.items():
+        base = baseline.get("stages", {}).get(name)
+        if base is not None and result["seconds"] > base["seconds"] * (1 + tolerance):
+            slower.append((name, base["seconds"], result["seconds"]))
+    return slower
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the WHOOP scripts on a synthetic or real historical dump")
+    parser.add_argument("--file", help="dump to benchmark, a synthetic one is generated when not set")
+    parser.add_argument("--days", type=float, default=1.0, help="days of synthetic records (default is 1)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic dump (default is 0)")
+    parser.add_argument("--packets", type=int, default=100000, help="packets used by the per packet stages (default is 100000)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the best one counts (default is 3)")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES), help="stages to run (default is all)")
+    parser.add_argument("--no_memory", action="store_true", help="skip the peak memory runs")
+    parser.add_argument("--save", help="write the results as a baseline json")
+    parser.add_argument("--baseline", help="baseline json to compare against, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline (default is 0.25)")
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    start = 1735362000
+    ctx = {
+        "file": args.file,
+        "scratch": os.path.join(tmp.name, "scratch.bin"),
+        "days": args.days,
+        "seed": args.seed,
+        "start": start,
+        "packets": args.packets,
+        "window": 4 * 60 * 60,
+    }
+
+    if args.file is None:
+        ctx["file"] = os.path.join(tmp.name, "whoop_hist.bin")
+        write_dump(ctx["file"], args.days, start, args.seed)
+    else:
+        table = parse_table(args.file)
+        ctx["start"] = int(table.unix[0]) if len(table) else start
+
+    print(f"{'stage':<24}{'time':>12}{'rate':>23}{'peak memory':>14}")
+    results = {}
+    for name in args.stages:
+        result = run_stage(name, ctx, args.repeat, not args.no_memory)
+        results[name] = result
+        print(f"{name:<24}{result['seconds'] * 1000:>9.1f} ms{result['rate']:>12.0f} {result['unit'] + '/s':<10}{result['peak_bytes'] / 1e6:>9.1f} MB")
+
+    meta = {"file": args.file, "days": args.days, "seed": args.seed, "packets": args.packets, "python": sys.version.split()[0], "numpy": np.__version__}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"meta": meta, "stages": results}, f, indent=2)
+        print(f"saved baseline to {args.save}")
+
+    tmp.cleanup()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        slower = compare(results, baseline, args.tolerance)
+        for name, before, after in slower:
+            print(f"regression: {name} {before * 1000:.1f} ms -> {after * 1000:.1f} ms")
+        if slower:
+            sys.exit(1)
+        print("no regressions")
+
+if __name__ == "__main__":
+    main()
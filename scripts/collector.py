@@ -0,0 +1,478 @@
+import os, sys, random, argparse, asyncio, inspect
+from framer import *
+from sync import *
+from pipeline import *
+from hrvstream import *
+from realtime import *
+from rawdata import *
+from metrics import *
+from logstore import *
+
+WHOOP_SERVICE = "61080001-8d6d-82b8-614a-1c8cb0f8dcc6"
+WHOOP_CHAR_CMD_TO_STRAP = "61080002-8d6d-82b8-614a-1c8cb0f8dcc6"
+WHOOP_CHAR_CMD_FROM_STRAP = "61080003-8d6d-82b8-614a-1c8cb0f8dcc6"
+WHOOP_CHAR_EVENTS_FROM_STRAP = "61080004-8d6d-82b8-614a-1c8cb0f8dcc6"
+WHOOP_CHAR_DATA_FROM_STRAP = "61080005-8d6d-82b8-614a-1c8cb0f8dcc6"
+WHOOP_CHAR_MEMFAULT = "61080007-8D6D-82B8-614A-1C8CB0F8DCC6"
+
+class Transport:
+    """
+    What a StrapSession needs from a bluetooth connection.
+    disconnected is an asyncio.Event that is set when the link drops.
+    """
+    def __init__(self):
+        self.disconnected = asyncio.Event()
+
+    @property
+    def is_connected(self):
+        raise NotImplementedError
+
+    async def connect(self):
+        raise NotImplementedError
+
+    async def disconnect(self):
+        raise NotImplementedError
+
+    async def start_notify(self, uuid, callback):
+        raise NotImplementedError
+
+    async def write(self, uuid, data):
+        raise NotImplementedError
+
+class BleakTransport(Transport):
+    """
+    A real strap through bleak, address is an address, a BLEDevice or a device name.
+    """
+    def __init__(self, address, name=None):
+        super().__init__()
+        self.address = address
+        self.name = name
+        self.client = None
+
+    @property
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
+
+    async def connect(self):
+        from bleak import BleakClient, BleakScanner
+
+        address = self.address
+        if address is None:
+            address = await BleakScanner.find_device_by_name(self.name)
+            if address is None:
+                raise Exception(f"device with name '{self.name}' not found")
+
+        self.disconnected = asyncio.Event()
+        self.client = BleakClient(address, disconnected_callback=lambda client: self.disconnected.set())
+        await self.client.connect()
+
+    async def disconnect(self):
+        if self.client is not None:
+            await self.client.disconnect()
+
+    async def start_notify(self, uuid, callback):
+        await self.client.start_notify(uuid, callback)
+
+    async def write(self, uuid, data):
+        await self.client.write_gatt_char(uuid, data)
+
+class FakeTransport(Transport):
+    """
+    In process transport for load tests. Writes go to peer.on_write(transport, uuid, data),
+    the peer answers by calling notify. The peer's on_connect and on_disconnect are awaited too.
+    """
+    def __init__(self, peer):
+        super().__init__()
+        self.peer = peer
+        self.callbacks = {}
+        self.connected = False
+
+    @property
+    def is_connected(self):
+        return self.connected
+
+    async def connect(self):
+        self.disconnected = asyncio.Event()
+        self.callbacks = {}
+        self.connected = True
+        await self.peer.on_connect(self)
+
+    async def disconnect(self):
+        if self.connected:
+            self.connected = False
+            self.disconnected.set()
+            await self.peer.on_disconnect(self)
+
+    async def start_notify(self, uuid, callback):
+        self.callbacks[uuid] = callback
+
+    async def write(self, uuid, data):
+        if not self.connected:
+            raise Exception("not connected")
+        await self.peer.on_write(self, uuid, bytes(data))
+
+    async def notify(self, uuid, data):
+        callback = self.callbacks.get(uuid)
+        if not self.connected or callback is None:
+            return
+        result = callback(uuid, bytearray(data))
+        if inspect.isawaitable(result):
+            await result
+
+class Backoff:
+    """
+    Exponential reconnect delay with jitter.
+    """
+    def __init__(self, initial=1.0, maximum=300.0, factor=2.0, jitter=0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.delay = initial
+
+    def reset(self):
+        self.delay = self.initial
+
+    def next(self):
+        delay = self.delay * (1 + random.uniform(-self.jitter, self.jitter))
+        self.delay = min(self.maximum, self.delay * self.factor)
+        return delay
+
+class StrapSession:
+    """
+    One strap connection with its own framers, queues and files in directory.
+    run keeps it connected, reconnecting with backoff, and syncs history every interval seconds.
+    """
+    def __init__(self, transport, directory=".", label="strap", interval=3600.0, backoff=None, timeout=60.0, max_in_flight=4, command_timeout=5.0, realtime_capacity=4096, metrics=None):
+        self.transport = transport
+        self.directory = directory
+        self.label = label
+        self.interval = interval
+        self.backoff = backoff or Backoff()
+        self.timeout = timeout
+        self.verbose = False
+        self.stopped = asyncio.Event()
+        self.connected = asyncio.Event()
+        self.watcher = None
+
+        os.makedirs(directory, exist_ok=True)
+        self.commands = CommandPipeline(self.send, max_in_flight, command_timeout)
+        self.meta_queue = asyncio.Queue()
+        self.cmd_framer = Framer()
+        self.events_framer = Framer()
+        self.data_framer = Framer()
+        self.history_sync = HistorySync(os.path.join(directory, "whoop_hist.bin"))
+        self.logs = LogStore(os.path.join(directory, "logs"))
+        self.log_lines = LogLines()
+        self.realtime = RealtimeBuffer(realtime_capacity)
+        self.capture = None
+        self.capture_dropped = 0
+        self.hrv = RRWindow(300)
+
+        self.connects = 0
+        self.syncs = 0
+        self.errors = 0
+        self._register_metrics(metrics or METRICS)
+
+    def _register_metrics(self, metrics):
+        # the handlers only bump these counters, everything else is read from the session when scraped
+        strap = self.label
+        self.metrics = metrics
+        self.notifications = {}
+        self.notification_bytes = {}
+        framers = {"cmd": self.cmd_framer, "events": self.events_framer, "data": self.data_framer}
+        for char in ("cmd", "events", "data", "memfault"):
+            self.notifications[char] = metrics.counter("whoop_notifications_total", "BLE notifications received", strap=strap, char=char)
+            self.notification_bytes[char] = metrics.counter("whoop_notification_bytes_total", "bytes of BLE notifications received", strap=strap, char=char)
+            framer = framers.get(char)
+            if framer is not None:
+                metrics.counter("whoop_frames_total", "frames decoded", lambda framer=framer: framer.frames, strap=strap, char=char)
+                metrics.counter("whoop_dropped_frames_total", "frames dropped for a bad crc", lambda framer=framer: framer.dropped_frames, strap=strap, char=char)
+                metrics.counter("whoop_dropped_bytes_total", "bytes skipped while resynchronizing", lambda framer=framer: framer.dropped_bytes, strap=strap, char=char)
+
+        self.history_bytes = metrics.counter("whoop_history_bytes_total", "bytes of historical data frames received", strap=strap)
+        self.commands.latency = metrics.histogram("whoop_command_latency_seconds", "command round trip time", strap=strap)
+        metrics.gauge("whoop_connected", "1 while the strap is connected", lambda: int(self.transport.is_connected), strap=strap)
+        metrics.gauge("whoop_meta_queue_depth", "metadata packets waiting for the history sync", lambda: self.meta_queue.qsize(), strap=strap)
+        metrics.gauge("whoop_commands_in_flight", "commands waiting for a response", lambda: len(self.commands.pending), strap=strap)
+        metrics.counter("whoop_commands_total", "commands sent", lambda: self.commands.sent, strap=strap)
+        metrics.counter("whoop_command_timeouts_total", "commands that got no response in time", lambda: self.commands.timeouts, strap=strap)
+        metrics.counter("whoop_unmatched_responses_total", "responses no command was waiting for", lambda: self.commands.unmatched, strap=strap)
+        # goes down when the dump is rebuilt from a shorter file, so a gauge
+        metrics.gauge("whoop_history_stored_bytes", "bytes of history committed to whoop_hist.bin", lambda: self.history_sync.state["bytes"], strap=strap)
+        metrics.counter("whoop_connects_total", "successful connects", lambda: self.connects, strap=strap)
+        metrics.counter("whoop_syncs_total", "completed history syncs", lambda: self.syncs, strap=strap)
+        metrics.counter("whoop_errors_total", "errors that dropped the connection", lambda: self.errors, strap=strap)
+        metrics.counter("whoop_realtime_samples_total", "realtime heart rate samples received", lambda: self.realtime.count, strap=strap)
+        metrics.counter("whoop_log_lines_total", "console log lines archived", lambda: len(self.logs), strap=strap)
+        metrics.counter("whoop_log_dropped_total", "console log lines dropped on a full log sink queue", lambda: self.logs.dropped, strap=strap)
+        metrics.counter("whoop_capture_dropped_total", "raw data frames dropped on a full capture sink queue", lambda: self.capture_dropped + (self.capture.sink.dropped if self.capture is not None else 0), strap=strap)
+
+    def __repr__(self):
+        return f"StrapSession(label={self.label}, connected={self.transport.is_connected}, connects={self.connects}, syncs={self.syncs}, errors={self.errors})"
+
+    def cmd_handler(self, sender, data):
+        self.notifications["cmd"].inc()
+        self.notification_bytes["cmd"].inc(len(data))
+        for frame, packet in self.cmd_framer.feed(data):
+            if not self.commands.dispatch(packet) and self.verbose:
+                print(f"{self.label} unmatched response: {packet}")
+
+            if self.verbose:
+                print(f"{self.label} cmd: {frame.hex()}")
+                print(packet)
+
+    def events_handler(self, sender, data):
+        self.notifications["events"].inc()
+        self.notification_bytes["events"].inc(len(data))
+        for frame, packet in self.events_framer.feed(data):
+            if self.verbose:
+                print(f"{self.label} events: {frame.hex()}")
+                print(packet)
+
+    async def data_handler(self, sender, data):
+        self.notifications["data"].inc()
+        self.notification_bytes["data"].inc(len(data))
+        for frame, packet in self.data_framer.feed(data):
+            if self.verbose:
+                print(f"{self.label} data: {frame.hex()}")
+                print(packet)
+
+            # kept until the chunk is committed
+            if packet.type == PacketType.HISTORICAL_DATA:
+                self.history_sync.add(frame)
+                self.history_bytes.inc(len(frame))
+
+            if packet.type == PacketType.METADATA:
+                if self.verbose:
+                    print(packet)
+                if packet.cmd == MetadataType.HISTORY_START.value:
+                    self.history_sync.start_chunk()
+                elif packet.cmd == MetadataType.HISTORY_END.value:
+                    self.history_sync.end_chunk(packet, self.data_framer.dropped_bytes)
+                await self.meta_queue.put(packet)
+
+            # live samples into the ring, and hrv over the last five minutes of realtime rr intervals
+            if packet.type == PacketType.REALTIME_DATA:
+                unix, subsec, heart, rrnum, *rr = self.realtime.push(packet)
+                for value in rr[:rrnum]:
+                    self.hrv.add(unix, value)
+
+            # raw sensor blocks are stored as they come and decoded in bulk later
+            if packet.type in RAW_TYPES and self.capture is not None:
+                self.capture.write(frame)
+
+            # whole lines with the strap time they started at
+            if packet.type == PacketType.CONSOLE_LOGS:
+                self.logs.extend(self.log_lines.feed(*console_log(packet)))
+
+    def memfault_handler(self, sender, data):
+        self.notifications["memfault"].inc()
+        self.notification_bytes["memfault"].inc(len(data))
+
+    async def connect(self):
+        # a reconnect starts with empty framers and queues
+        for framer in (self.cmd_framer, self.events_framer, self.data_framer):
+            framer.reset()
+        self.history_sync.reset(self.data_framer.dropped_bytes)
+        self.logs.extend(self.log_lines.flush())
+        self.commands.fail(Exception("reconnected"))
+        self.meta_queue = asyncio.Queue()
+
+        await self.transport.connect()
+        self._stop_watch()
+        self.watcher = asyncio.ensure_future(self._watch(self.transport.disconnected))
+        await self.transport.start_notify(WHOOP_CHAR_CMD_FROM_STRAP, self.cmd_handler)
+        await self.transport.start_notify(WHOOP_CHAR_EVENTS_FROM_STRAP, self.events_handler)
+        await self.transport.start_notify(WHOOP_CHAR_DATA_FROM_STRAP, self.data_handler)
+        await self.transport.start_notify(WHOOP_CHAR_MEMFAULT, self.memfault_handler)
+        self.connects += 1
+        self.connected.set()
+
+    async def _watch(self, disconnected):
+        # commands waiting for a response fail as soon as the link drops
+        await disconnected.wait()
+        self.commands.fail(Exception("disconnected"))
+
+    def _stop_watch(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+            self.watcher = None
+
+    async def send(self, pkt):
+        await self.transport.write(WHOOP_CHAR_CMD_TO_STRAP, pkt)
+
+    async def _get(self, queue):
+        # gives up on a timeout or when the link drops
+        get = asyncio.ensure_future(queue.get())
+        lost = asyncio.ensure_future(self.transport.disconnected.wait())
+        done, _ = await asyncio.wait([get, lost], timeout=self.timeout, return_when=asyncio.FIRST_COMPLETED)
+        lost.cancel()
+        if get in done:
+            return get.result()
+        get.cancel()
+        raise Exception("disconnected" if lost in done else "timed out waiting for the strap")
+
+    async def sync_history(self):
+        """
+        Pulls every history chunk the strap has, committing and acknowledging them one by one.
+        """
+        # a chunk committed before the last disconnect may never have been acknowledged
+        trim = self.history_sync.unacked_trim()
+        if trim is not None:
+            await self.commands.post(CommandNumber.HISTORICAL_DATA_RESULT, history_result(trim))
+            await self.history_sync.acked()
+
+        response = await self.commands.request(CommandNumber.SEND_HISTORICAL_DATA)
+        if self.verbose:
+            print(response)
+
+        while True:
+            metapkt = await self._get(self.meta_queue)
+
+            # get the first history end
+            while metapkt.cmd != MetadataType.HISTORY_END.value and metapkt.cmd != MetadataType.HISTORY_COMPLETE.value:
+                metapkt = await self._get(self.meta_queue)
+
+            # reached the complete metadata
+            if metapkt.cmd == MetadataType.HISTORY_COMPLETE.value:
+                break
+
+            # store the chunk durably before the strap is allowed to trim it
+            trim = await self.history_sync.commit(metapkt)
+            if trim is None:
+                # not acknowledged, the strap sends the chunk again after the reconnect
+                raise Exception("history chunk lost frames")
+            await self.commands.post(CommandNumber.HISTORICAL_DATA_RESULT, history_result(trim))
+            await self.history_sync.acked()
+
+        self.syncs += 1
+
+    async def _wait(self, timeout):
+        # returns early on stop or disconnect
+        waits = [asyncio.ensure_future(self.stopped.wait()), asyncio.ensure_future(self.transport.disconnected.wait())]
+        await asyncio.wait(waits, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for wait in waits:
+            wait.cancel()
+
+    async def run(self):
+        while not self.stopped.is_set():
+            try:
+                await self.connect()
+                print(f"{self.label}: connected")
+                self.backoff.reset()
+
+                while self.transport.is_connected and not self.stopped.is_set():
+                    await self.sync_history()
+                    print(f"{self.label}: {self.history_sync}")
+                    await self._wait(self.interval)
+            except Exception as e:
+                self.errors += 1
+                print(f"{self.label}: {type(e).__name__} {e}")
+
+            try:
+                await self.transport.disconnect()
+            except Exception:
+                pass
+            self._stop_watch()
+
+            if not self.stopped.is_set():
+                delay = self.backoff.next()
+                print(f"{self.label}: reconnecting in {delay:.1f}s")
+                await self._wait(delay)
+
+    def start_capture(self):
+        """
+        Starts appending raw data frames to raw.bin, see rawdata.load_raw to decode it.
+        """
+        if self.capture is None:
+            self.capture = RawCapture(os.path.join(self.directory, "raw.bin"))
+        return self.capture
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+            self.capture_dropped += capture.sink.dropped
+        return capture
+
+    def stop(self):
+        self.stopped.set()
+
+    def close(self):
+        self._stop_watch()
+        if self.capture is not None:
+            self.capture.close()
+        self.logs.extend(self.log_lines.flush())
+        self.logs.close()
+
+class Collector:
+    """
+    Runs many StrapSessions on one event loop.
+    """
+    def __init__(self, sessions):
+        self.sessions = sessions
+
+    async def run(self):
+        try:
+            await asyncio.gather(*(session.run() for session in self.sessions))
+        finally:
+            for session in self.sessions:
+                session.close()
+
+    def stop(self):
+        for session in self.sessions:
+            session.stop()
+
+async def main():
+    parser = argparse.ArgumentParser(description="collect history from several WHOOP straps")
+    parser.add_argument("--address", "-a", action="append", default=[], help="bluetooth address of a strap, can be repeated")
+    parser.add_argument("--name", "-n", action="append", default=[], help="bluetooth name of a strap, can be repeated")
+    parser.add_argument("--fake", type=int, default=0, help="number of in process simulated straps, for load testing")
+    parser.add_argument("--fake_days", type=float, default=1.0, help="days of history per fake strap (default is 1)")
+    parser.add_argument("--out", default="collected", help="directory with one sub directory per strap (default is collected)")
+    parser.add_argument("--interval", type=float, default=3600.0, help="seconds between history syncs (default is 3600)")
+    parser.add_argument("--once", action="store_true", help="sync every strap once and exit")
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+
+    sessions = []
+    for address in args.address:
+        sessions.append(StrapSession(BleakTransport(address), os.path.join(args.out, address.replace(":", "")), address, args.interval))
+    for name in args.name:
+        sessions.append(StrapSession(BleakTransport(None, name), os.path.join(args.out, name), name, args.interval))
+    if args.fake:
+        from simulator import StrapSimulator
+    for i in range(args.fake):
+        label = f"fake{i}"
+        sessions.append(StrapSession(FakeTransport(StrapSimulator(args.fake_days, seed=i)), os.path.join(args.out, label), label, args.interval))
+
+    if not sessions:
+        print("need to provide at least one address, name or fake strap!")
+        sys.exit(1)
+
+    collector = Collector(sessions)
+    if args.once:
+        async def stop_when_synced():
+            while not all(session.syncs for session in sessions):
+                await asyncio.sleep(0.1)
+            collector.stop()
+
+        asyncio.create_task(stop_when_synced())
+
+    stop_metrics = await start_metrics(args)
+    start = asyncio.get_running_loop().time()
+    try:
+        await collector.run()
+    finally:
+        stop_metrics()
+    elapsed = asyncio.get_running_loop().time() - start
+    for session in sessions:
+        print(session)
+    print(f"done in {elapsed:.2f}s")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("program terminated")
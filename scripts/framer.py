@@ -0,0 +1,86 @@
+from packet import *
+
+class Framer:
+    """
+    Push based frame decoder for a stream of BLE notifications.
+    Frames split over several notifications are reassembled, several frames in one notification are split,
+    and after corrupted data it resynchronizes on the next sof with a valid header crc8.
+    """
+    MIN_LENGTH = 7
+
+    def __init__(self, max_length=4096):
+        self.max_length = max_length
+        self.buffer = bytearray()
+        self.frames = 0
+        self.dropped_bytes = 0
+        self.dropped_frames = 0
+
+    def __repr__(self):
+        return f"Framer(frames={self.frames}, dropped_frames={self.dropped_frames}, dropped_bytes={self.dropped_bytes}, buffered={len(self.buffer)})"
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "dropped_frames": self.dropped_frames,
+            "dropped_bytes": self.dropped_bytes,
+            "buffered": len(self.buffer),
+        }
+
+    def reset(self):
+        """
+        Drops a partial frame, e.g. after a reconnect.
+        """
+        self.dropped_bytes += len(self.buffer)
+        self.buffer.clear()
+
+    def feed(self, data):
+        """
+        Appends a notification and returns the (frame bytes, WhoopPacket) pairs it completed.
+        """
+        self.buffer += data
+        out = []
+        pos = 0
+
+        with memoryview(self.buffer) as view:
+            while True:
+                idx = self.buffer.find(WhoopPacket.sof, pos)
+                if idx == -1:
+                    self.dropped_bytes += len(self.buffer) - pos
+                    pos = len(self.buffer)
+                    break
+
+                self.dropped_bytes += idx - pos
+                pos = idx
+
+                # wait for the whole header
+                if len(self.buffer) - pos < 4:
+                    break
+
+                length = self.buffer[pos + 1] | self.buffer[pos + 2] << 8
+                if crc8(view[pos + 1:pos + 3]) != self.buffer[pos + 3] or not self.MIN_LENGTH <= length <= self.max_length:
+                    # not a frame start, resync on the next sof
+                    self.dropped_bytes += 1
+                    pos += 1
+                    continue
+
+                # wait for the rest of the frame
+                total = length + 4
+                if len(self.buffer) - pos < total:
+                    break
+
+                frame = bytes(view[pos:pos + total])
+                try:
+                    packet = WhoopPacket.from_data(frame)
+                except Exception:
+                    # the header may have been a false match inside another frame, so only skip the sof
+                    self.dropped_frames += 1
+                    self.dropped_bytes += 1
+                    pos += 1
+                    continue
+
+                self.frames += 1
+                out.append((frame, packet))
+                pos += total
+
+        del self.buffer[:pos]
+        return out
@@ -1,25 +1,7 @@
-import argparse, numpy as np, matplotlib.pyplot as plt
-from scipy.signal import welch
-from scipy.integrate import trapezoid
-from parser import *
-
-parser = argparse.ArgumentParser(description="WHOOP hrv analysis")
-parser.add_argument("file", help="path to the binary file containing the Whoop historical data packets")
-
-args = parser.parse_args()
-
-records = parse_data(args.file)
-records = HistoricalRecord.interpolate_anomalies(records)
-records = HistoricalRecord.filter_records_by_date(records, "2024-12-28 4:00:00 AM", "2024-12-28 8:00:00 AM")
-rr_intervals = []
-for record in records:
-    if len(record.rr) > 0:
-        rr_intervals += record.rr
-print(rr_intervals)
-
-#heart_rate = [record.heart_rate for record in records]
-# rr_intervals = 60000 / np.array(heart_rate)  # RR intervals in milliseconds
-# print(rr_intervals)
+import argparse, numpy as np
+from store import *
+from hrvstream import *
+from spectrum import *
 
 def calculate_time_domain_metrics(rr_intervals):
     diff_rr = np.diff(rr_intervals)  # Differences between consecutive RR intervals
@@ -42,42 +24,80 @@ def calculate_hrv(rr):
 
     return hrv
 
-# https://help.elitehrv.com/article/54-how-do-you-calculate-the-hrv-score
-hrv = calculate_hrv(rr_intervals)
-print(hrv)
-
 # Frequency-domain HRV metrics
 def calculate_frequency_domain_metrics(rr_intervals, fs=4.0):
     """
     Compute the frequency domain metrics using Welch's method.
     """
+    from scipy.signal import welch
+    from scipy.integrate import trapezoid
+
     rr_intervals_sec = np.array(rr_intervals) / 1000.0  # Convert to seconds
     f, pxx = welch(rr_intervals_sec, fs=fs, nperseg=len(rr_intervals_sec))
-    
+
     lf_band = (0.04, 0.15)  # Low-frequency band (Hz)
     hf_band = (0.15, 0.4)   # High-frequency band (Hz)
-    
+
     lf = trapezoid(pxx[(f >= lf_band[0]) & (f < lf_band[1])], f[(f >= lf_band[0]) & (f < lf_band[1])])
     hf = trapezoid(pxx[(f >= hf_band[0]) & (f < hf_band[1])], f[(f >= hf_band[0]) & (f < hf_band[1])])
     lf_hf_ratio = lf / hf if hf > 0 else np.nan
-    
+
     return f, pxx, lf, hf, lf_hf_ratio
 
-# Calculate metrics
-rmssd, sdnn = calculate_time_domain_metrics(rr_intervals)
-f, pxx, lf, hf, lf_hf_ratio = calculate_frequency_domain_metrics(rr_intervals)
-
-# Display metrics
-print(f"Time-Domain Metrics: RMSSD = {rmssd:.2f} ms, SDNN = {sdnn:.2f} ms")
-print(f"Frequency-Domain Metrics: LF = {lf:.2f}, HF = {hf:.2f}, LF/HF Ratio = {lf_hf_ratio:.2f}")
-
-# Plot the power spectral density
-plt.figure(figsize=(10, 6))
-plt.semilogy(f, pxx, label="PSD")
-plt.axvspan(0.04, 0.15, color='red', alpha=0.2, label='LF Band')
-plt.axvspan(0.15, 0.4, color='blue', alpha=0.2, label='HF Band')
-plt.xlabel("Frequency (Hz)")
-plt.ylabel("Power Spectral Density")
-plt.title("HRV Frequency Domain Analysis")
-plt.legend()
-plt.show()
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description="WHOOP hrv analysis")
+    parser.add_argument("file", help="path to the binary file containing the Whoop historical data packets, or a history store made by store.py")
+    parser.add_argument("--start_date", default="2024-12-28 4:00:00 AM", help="start of the analysed data, see plot.py for the formats (default is 2024-12-28 4:00:00 AM)")
+    parser.add_argument("--end_date", default="2024-12-28 8:00:00 AM", help="end of the analysed data (default is 2024-12-28 8:00:00 AM)")
+    parser.add_argument("--no_plot", action="store_true", help="only print the metrics")
+    parser.add_argument("--window", type=int, default=300, help="also print the time and frequency domain metrics of every window of this many seconds (default is 300, 0 is off)")
+
+    args = parser.parse_args()
+
+    # the rr intervals of the records, heart rate anomalies carry none
+    times, rr_intervals = table_beats(load_table(args.file, args.start_date, args.end_date))
+    print(rr_intervals.tolist())
+
+    #heart_rate = [record.heart_rate for record in records]
+    # rr_intervals = 60000 / np.array(heart_rate)  # RR intervals in milliseconds
+    # print(rr_intervals)
+
+    # https://help.elitehrv.com/article/54-how-do-you-calculate-the-hrv-score
+    hrv = calculate_hrv(rr_intervals)
+    print(hrv)
+
+    # Calculate metrics
+    rmssd, sdnn = calculate_time_domain_metrics(rr_intervals)
+    f, pxx, lf, hf, lf_hf_ratio = calculate_frequency_domain_metrics(rr_intervals)
+
+    # Display metrics
+    if args.window:
+        bands = frequency_windows(times, rr_intervals, args.window)
+        power = {start: (lf, hf, ratio) for start, lf, hf, ratio in zip(bands["start"].tolist(), bands["lf"], bands["hf"], bands["lf_hf"])}
+        for start, metrics in tumbling(times, rr_intervals, args.window):
+            window_lf, window_hf, window_ratio = power.get(start, (np.nan, np.nan, np.nan))
+            print(f"{timestring(start)}: beats {metrics['beats']} RMSSD {metrics['rmssd']:.2f} SDNN {metrics['sdnn']:.2f} pNN50 {metrics['pnn50']:.1f} score {metrics['score']:.1f} LF {window_lf:.0f} HF {window_hf:.0f} LF/HF {window_ratio:.2f}")
+    print(f"Time-Domain Metrics: RMSSD = {rmssd:.2f} ms, SDNN = {sdnn:.2f} ms")
+    print(f"Frequency-Domain Metrics: LF = {lf:.2f}, HF = {hf:.2f}, LF/HF Ratio = {lf_hf_ratio:.2f}")
+
+    if not args.no_plot:
+        plot_spectrum(f, pxx)
+
+def plot_spectrum(f, pxx):
+    """
+    Plots the power spectral density with the LF and HF bands.
+    """
+    import matplotlib.pyplot as plt
+
+    plt.figure(figsize=(10, 6))
+    plt.semilogy(f, pxx, label="PSD")
+    plt.axvspan(0.04, 0.15, color='red', alpha=0.2, label='LF Band')
+    plt.axvspan(0.15, 0.4, color='blue', alpha=0.2, label='HF Band')
+    plt.xlabel("Frequency (Hz)")
+    plt.ylabel("Power Spectral Density")
+    plt.title("HRV Frequency Domain Analysis")
+    plt.legend()
+    plt.show()
+
+if __name__ == "__main__":
+    main()
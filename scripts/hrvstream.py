@@ -0,0 +1,191 @@
+import math, collections, numpy as np
+from packet import *
+
+class RRWindow:
+    """
+    Time-domain HRV over a sliding window of rr intervals (ms), updated in O(1) per beat.
+    Keeps integer running sums of the intervals, their squares and the squared successive differences,
+    so RMSSD, SDNN, pNN50 and the ln(RMSSD) score never need the window to be walked again.
+    The window holds the beats of the last duration seconds and at most count beats, either can be None.
+    Successive differences across a gap of more than max_gap seconds are left out.
+    """
+    def __init__(self, duration=300, count=None, max_gap=3):
+        self.duration = duration
+        self.count = count
+        self.max_gap = max_gap
+        self.reset()
+
+    def reset(self):
+        # beats are [time, rr, squared difference to the beat before or None]
+        self.beats = collections.deque()
+        self.n = 0
+        self.sum = 0
+        self.sum_sq = 0
+        self.diffs = 0
+        self.sum_diff_sq = 0
+        self.nn50 = 0
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return f"RRWindow(beats={self.n}, rmssd={self.rmssd:.2f}, sdnn={self.sdnn:.2f}, pnn50={self.pnn50:.1f}, score={self.score:.1f})"
+
+    def add(self, t, rr):
+        """
+        Adds a beat at time t (seconds) and evicts the beats that fell out of the window.
+        """
+        rr = int(rr)
+        diff = None
+        if self.beats:
+            last = self.beats[-1]
+            if t - last[0] <= self.max_gap:
+                diff = (rr - last[1]) ** 2
+                self.diffs += 1
+                self.sum_diff_sq += diff
+                self.nn50 += diff > 2500
+
+        self.beats.append([t, rr, diff])
+        self.n += 1
+        self.sum += rr
+        self.sum_sq += rr * rr
+
+        while self.count is not None and self.n > self.count:
+            self._evict()
+        self.expire(t)
+
+    def expire(self, now):
+        """
+        Evicts the beats older than duration seconds before now, e.g. while no beats arrive.
+        """
+        if self.duration is None:
+            return
+        while self.n and self.beats[0][0] < now - self.duration:
+            self._evict()
+
+    def extend(self, times, rrs):
+        for t, rr in zip(*_lists(times, rrs)):
+            self.add(t, rr)
+
+    def _evict(self):
+        t, rr, diff = self.beats.popleft()
+        self.n -= 1
+        self.sum -= rr
+        self.sum_sq -= rr * rr
+
+        # the difference to the evicted beat is stored on the beat after it
+        if self.beats and self.beats[0][2] is not None:
+            diff = self.beats[0][2]
+            self.beats[0][2] = None
+            self.diffs -= 1
+            self.sum_diff_sq -= diff
+            self.nn50 -= diff > 2500
+
+    @property
+    def mean(self):
+        return self.sum / self.n if self.n else math.nan
+
+    @property
+    def rmssd(self):
+        return math.sqrt(self.sum_diff_sq / self.diffs) if self.diffs else math.nan
+
+    @property
+    def sdnn(self):
+        if not self.n:
+            return math.nan
+        # exact integer variance, population like np.std
+        return math.sqrt((self.n * self.sum_sq - self.sum * self.sum) / (self.n * self.n))
+
+    @property
+    def pnn50(self):
+        return 100.0 * self.nn50 / self.diffs if self.diffs else math.nan
+
+    @property
+    def score(self):
+        """
+        ln(RMSSD) scaled to 0-100 like calculate_hrv.
+        """
+        rmssd = self.rmssd
+        return math.log(rmssd) / 6.5 * 100.0 if rmssd > 0 else math.nan
+
+    def metrics(self):
+        return {
+            "beats": self.n,
+            "mean_rr": self.mean,
+            "heart_rate": 60000.0 / self.mean if self.n else math.nan,
+            "rmssd": self.rmssd,
+            "sdnn": self.sdnn,
+            "pnn50": self.pnn50,
+            "score": self.score,
+        }
+
+def table_beats(table):
+    """
+    (time, rr) arrays of every rr interval of a HistoricalTable, a beat takes the unix time of its record.
+    """
+    mask = np.arange(4) < table.rr_count[:, None]
+    return np.repeat(table.unix.astype(np.int64), table.rr_count), table.rr[mask].astype(np.int64)
+
+def record_beats(records):
+    """
+    (time, rr) lists of every rr interval of HistoricalRecords, as made by parse_data.
+    """
+    times = []
+    rrs = []
+    for record in records:
+        times += [record.unix] * len(record.rr)
+        rrs += record.rr
+    return times, rrs
+
+def realtime_rr(packet):
+    """
+    (unix, heart rate, rr intervals) of a REALTIME_DATA packet.
+    """
+    unix, subsec, heart, rrnum, *rr = packet.realtime()
+    return unix, heart, rr[:rrnum]
+
+def _lists(times, rrs):
+    # plain ints iterate much faster than numpy scalars
+    return np.asarray(times).tolist(), np.asarray(rrs).tolist()
+
+def sliding(times, rrs, duration=300, step=60, max_gap=3):
+    """
+    Yields (time, metrics) of the window of the last duration seconds every step seconds of beats,
+    the window at time holds the beats in [time - duration, time) like the windows of tumbling.
+    """
+    times, rrs = _lists(times, rrs)
+    window = RRWindow(duration, max_gap=max_gap)
+    due = None
+    for t, rr in zip(times, rrs):
+        if due is None:
+            due = t - t % step + step
+        while t >= due:
+            window.expire(due)
+            if window.n:
+                yield due, window.metrics()
+            due += step
+        window.add(t, rr)
+
+    if window.n:
+        window.expire(due)
+        yield due, window.metrics()
+
+def tumbling(times, rrs, interval=300, max_gap=3, min_beats=2):
+    """
+    Yields (window start, metrics) of back to back interval second windows aligned to the epoch,
+    windows with fewer than min_beats beats are left out.
+    """
+    times, rrs = _lists(times, rrs)
+    window = RRWindow(None, max_gap=max_gap)
+    start = None
+    for t, rr in zip(times, rrs):
+        bucket = t - t % interval
+        if bucket != start:
+            if start is not None and window.n >= min_beats:
+                yield start, window.metrics()
+            window.reset()
+            start = bucket
+        window.add(t, rr)
+
+    if start is not None and window.n >= min_beats:
+        yield start, window.metrics()
@@ -0,0 +1,246 @@
+import os, sys, mmap, time, zlib, fnmatch, argparse, numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from store import *
+
+# a historical frame is at least the decoded prefix plus its crc32
+MIN_FRAME = HISTORICAL_SIZE + 4
+SHARD_BYTES = 64 * 1024 * 1024
+
+# the table columns plus where every record came from, so a consolidated dump can be written
+INGEST_COLUMNS = dict(COLUMNS, source=(np.dtype("<u4"), ()), offset=(np.dtype("<u8"), ()), length=(np.dtype("<u4"), ()))
+
+def find_dumps(paths, pattern="whoop_hist*.bin"):
+    """
+    Expands directories into the dumps under them matching pattern, sorted by path.
+    """
+    out = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                out += [os.path.join(root, name) for name in files if fnmatch.fnmatch(name, pattern)]
+        else:
+            out.append(path)
+    return sorted(out)
+
+def _frame_at(mm, pos, length):
+    # a whole frame of the given total length starts at pos: sof, header crc8 and data crc32 all check out,
+    # so payload bytes that only look like a header are not taken for one
+    if pos + length > len(mm) or mm[pos] != WhoopPacket.sof or (mm[pos + 1] | mm[pos + 2] << 8) + 4 != length:
+        return False
+    if crc8(mm[pos + 1:pos + 3]) != mm[pos + 3]:
+        return False
+    return zlib.crc32(mm[pos + 4:pos + length - 4]) & 0xFFFFFFFF == int.from_bytes(mm[pos + length - 4:pos + length], "little")
+
+def split_file(file_path, shard_bytes=SHARD_BYTES):
+    """
+    Splits a dump into (lo, hi) byte ranges of about shard_bytes that start and end on frame boundaries.
+    Dumps are almost always one frame length throughout, so a split point is guessed from the length of the
+    frame before it and only checked, with the crcs of the frame there; if the guess is not a frame the frames
+    are walked to the next boundary.
+    """
+    size = os.path.getsize(file_path)
+    if size <= shard_bytes:
+        return [(0, size)] if size else []
+
+    with open(file_path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        bounds = [0]
+        pos = 0
+        while size - pos > shard_bytes:
+            length = (mm[pos + 1] | mm[pos + 2] << 8) + 4
+            guess = pos + max(1, shard_bytes // length) * length
+            if not _frame_at(mm, guess, length):
+                guess = pos
+                while guess < pos + shard_bytes and guess + 3 <= size:
+                    guess += (mm[guess + 1] | mm[guess + 2] << 8) + 4
+            if guess >= size:
+                break
+            bounds.append(guess)
+            pos = guess
+        bounds.append(size)
+    finally:
+        mm.close()
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _attach(names):
+    blocks = {name: shared_memory.SharedMemory(name=block) for name, block in names.items()}
+    return blocks, {name: _column(blocks[name], name) for name in blocks}
+
+def _column(block, name):
+    dtype, shape = INGEST_COLUMNS[name]
+    rows = block.size // (dtype.itemsize * int(np.prod(shape, dtype=np.int64)))
+    return np.ndarray((rows,) + shape, dtype=dtype, buffer=block.buf)
+
+def _ingest_shard(task):
+    """
+    Decodes one byte range of a dump into the shared columns from row start on, returns the number of records.
+    """
+    names, source, file_path, lo, hi, start, batch_size, verify = task
+    blocks, columns = _attach(names)
+    try:
+        with open(file_path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            row = start
+            dp = lo
+            while dp < hi:
+                length = (mm[dp + 1] | mm[dp + 2] << 8) + 4
+                window = mm[dp:min(hi, dp + batch_size * length)]
+                offsets, lengths = frame_offsets(window, partial=True)
+                if len(offsets) == 0:
+                    raise Exception(f"truncated packet at offset {dp} of {file_path}")
+
+                used = int(offsets[-1] + lengths[-1])
+                table = HistoricalTable.from_buffer(memoryview(window)[:used], verify=verify)
+                historical = np.frombuffer(window, dtype=np.uint8)[offsets + 4] == PacketType.HISTORICAL_DATA.value
+
+                n = len(table)
+                for name in COLUMNS:
+                    columns[name][row:row + n] = getattr(table, name)
+                columns["source"][row:row + n] = source
+                columns["offset"][row:row + n] = dp + offsets[historical]
+                columns["length"][row:row + n] = lengths[historical]
+
+                row += n
+                dp += used
+        finally:
+            mm.close()
+
+        return row - start
+    finally:
+        del columns
+        for block in blocks.values():
+            block.close()
+
+class Timeline:
+    """
+    Consolidated, sorted and deduplicated records of many dumps.
+    source, offset and length locate every record's frame in files[source].
+    """
+    def __init__(self, table, files, source, offset, length):
+        self.table = table
+        self.files = files
+        self.source = source
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return len(self.table)
+
+    def __repr__(self):
+        return f"Timeline(records={len(self)}, files={len(self.files)})"
+
+    def write_dump(self, file_path):
+        """
+        Writes the frames of every record in timeline order, runs of adjacent frames are copied at once.
+        """
+        if len(self) == 0:
+            open(file_path, "wb").close()
+            return
+
+        # a run breaks where the next frame is not the one right after in the same file
+        source = self.source.astype(np.int64)
+        offset = self.offset.astype(np.int64)
+        end = offset + self.length
+        breaks = np.flatnonzero((source[1:] != source[:-1]) | (offset[1:] != end[:-1])) + 1
+        starts = np.concatenate(([0], breaks))
+        stops = np.concatenate((breaks, [len(self)]))
+
+        maps = {}
+        try:
+            with open(file_path, "wb") as out:
+                for lo, hi in zip(starts.tolist(), stops.tolist()):
+                    index = int(source[lo])
+                    if index not in maps:
+                        with open(self.files[index], "rb") as f:
+                            maps[index] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    out.write(maps[index][int(offset[lo]):int(end[hi - 1])])
+        finally:
+            for mm in maps.values():
+                mm.close()
+
+def ingest(paths, workers=None, shard_bytes=SHARD_BYTES, batch_size=65536, verify=True, pattern="whoop_hist*.bin"):
+    """
+    Decodes every dump under paths on a process pool and merges them into one Timeline.
+    Files, and large files split at frame boundaries, are decoded in parallel straight into shared columns,
+    then the records are sorted by unix time and subsec, and records with the same unix and subsec in
+    overlapping dumps are kept once (the copy from the first file in path order).
+    """
+    files = find_dumps(paths, pattern)
+    tasks = []
+    rows = 0
+    for source, file_path in enumerate(files):
+        for lo, hi in split_file(file_path, shard_bytes):
+            tasks.append((source, file_path, lo, hi, rows))
+            rows += (hi - lo) // MIN_FRAME
+
+    blocks = {}
+    try:
+        for name, (dtype, shape) in INGEST_COLUMNS.items():
+            size = max(1, rows * dtype.itemsize * int(np.prod(shape, dtype=np.int64)))
+            blocks[name] = shared_memory.SharedMemory(create=True, size=size)
+        names = {name: block.name for name, block in blocks.items()}
+        columns = {name: _column(block, name) for name, block in blocks.items()}
+
+        # largest shards first so one big file does not finish last on its own
+        order = sorted(range(len(tasks)), key=lambda i: tasks[i][2] - tasks[i][3])
+        jobs = [(names,) + tasks[i][:4] + (tasks[i][4], batch_size, verify) for i in order]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            counts = list(pool.map(_ingest_shard, jobs))
+
+        # every shard wrote from its own start row, keep the rows it filled
+        keep = np.zeros(rows, dtype=bool)
+        for job, count in zip(jobs, counts):
+            keep[job[5]:job[5] + count] = True
+        keep = np.flatnonzero(keep)
+
+        # lexsort is stable, so the first copy of a record stays first
+        order = np.lexsort((columns["subsec"][keep], columns["unix"][keep]))
+        keep = keep[order]
+        unix = columns["unix"][keep]
+        subsec = columns["subsec"][keep]
+        first = np.ones(len(keep), dtype=bool)
+        first[1:] = (unix[1:] != unix[:-1]) | (subsec[1:] != subsec[:-1])
+        keep = keep[first]
+
+        # copy out of the shared blocks before they are freed
+        out = {name: columns[name][keep] for name in INGEST_COLUMNS}
+        del columns, unix, subsec
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+    table = HistoricalTable(*(out[name] for name in COLUMNS))
+    return Timeline(table, files, out["source"], out["offset"], out["length"])
+
+def main():
+    parser = argparse.ArgumentParser(description="merge many WHOOP historical data dumps into one timeline")
+    parser.add_argument("paths", nargs="+", help="dumps, or directories searched for them")
+    parser.add_argument("--pattern", default="whoop_hist*.bin", help="file name pattern of dumps in directories (default is whoop_hist*.bin)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default is one per core)")
+    parser.add_argument("--shard_mb", type=float, default=SHARD_BYTES / 1024 / 1024, help="split files into shards of about this many MB (default is 64)")
+    parser.add_argument("--no_verify", action="store_true", help="skip the sof and crc checks")
+    parser.add_argument("--out", help="write the merged timeline as a single dump")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    timeline = ingest(args.paths, args.workers, int(args.shard_mb * 1024 * 1024), verify=not args.no_verify, pattern=args.pattern)
+    elapsed = time.perf_counter() - start
+
+    size = sum(os.path.getsize(f) for f in timeline.files)
+    print(f"{timeline} from {size / 1e6:.1f} MB in {elapsed:.2f}s ({size / 1e6 / elapsed:.1f} MB/s)")
+    if len(timeline):
+        print(f"{timestring(int(timeline.table.unix[0]))} to {timestring(int(timeline.table.unix[-1]))}")
+
+    if args.out:
+        timeline.write_dump(args.out)
+        print(f"wrote {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+import os, re, sys, json, time, struct, argparse, collections, numpy as np
+from parser import *
+from sink import *
+
+# on disk layout of a log store directory:
+#   segment_<n>.log   append only LOG_RECORD headers each followed by the utf-8 text of one line
+#   segment_<n>.json  index of a segment: min/max unix, offset and record count of every block of
+#                     block_records records, and the blocks each lower cased token appears in
+# a segment is closed once it reaches segment_bytes, only the last one is ever appended to
+LOG_VERSION = 1
+LOG_RECORD = struct.Struct("<LHBH")
+SEGMENT_BYTES = 16 * 1024 * 1024
+BLOCK_RECORDS = 256
+
+TOKEN = re.compile(r"[A-Za-z0-9_]+")
+
+class LogLine(collections.namedtuple("LogLine", "unix subsec seq text")):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"{timestring(self.unix)} {self.text}"
+
+def tokens(text):
+    return {token.lower() for token in TOKEN.findall(text)}
+
+def indexed_tokens(text):
+    # numbers are mostly counters and timestamps that would only bloat the index, they are matched by scanning
+    return {token for token in tokens(text) if not token.isdigit()}
+
+def console_log(packet):
+    """
+    (unix, subsec, seq, text) of a CONSOLE_LOGS packet, whose data is a zero byte, unix, subsec, 34 00 01, the text and a zero byte.
+    """
+    data = packet.payload
+    unix, subsec = struct.unpack_from("<LH", data, 1)
+    return unix, subsec, packet.seq, bytes(data[10:len(data) - 1]).decode("utf-8", "replace")
+
+class LogLines:
+    """
+    Joins the text of CONSOLE_LOGS packets into whole lines, a line takes the time and seq of the packet it started in.
+    The strap splits lines over packets anywhere, a gap in the packet seqs ends the partial line.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.text = ""
+        self.start = None
+        self.last_seq = None
+
+    def feed(self, unix, subsec, seq, text):
+        out = []
+        if self.text and self.last_seq is not None and seq != (self.last_seq + 1) & 0xFF:
+            out += self.flush()
+        self.last_seq = seq
+
+        parts = text.split("\n")
+        for i, part in enumerate(parts):
+            if self.start is None and part:
+                self.start = (unix, subsec, seq)
+            self.text += part
+            if i < len(parts) - 1:
+                out += self.flush()
+        return out
+
+    def flush(self):
+        """
+        Returns the partial line as a line of its own, e.g. on a disconnect.
+        """
+        out = []
+        line = self.text.strip()
+        if line:
+            out.append(LogLine(*self.start, line))
+        self.text = ""
+        self.start = None
+        return out
+
+class Segment:
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+        self.bytes = 0
+        self.records = 0
+        self.block_min = []
+        self.block_max = []
+        self.block_offset = []
+        self.block_count = []
+        self.postings = {}
+        self._arrays = None
+        # the FileSink appending to the segment and the segment size when it was opened
+        self.sink = None
+        self.base = 0
+
+    def readable(self):
+        """
+        Bytes of the segment on disk, the sink may still be writing the last records that were added.
+        """
+        if self.sink is None:
+            return self.bytes
+        return min(self.bytes, self.base + self.sink.bytes_written)
+
+    @property
+    def log_path(self):
+        return os.path.join(self.path, f"segment_{self.number:06d}.log")
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, f"segment_{self.number:06d}.json")
+
+    def add(self, unix, offset, words, block_records):
+        if not self.block_count or self.block_count[-1] >= block_records:
+            self.block_min.append(unix)
+            self.block_max.append(unix)
+            self.block_offset.append(offset)
+            self.block_count.append(0)
+        else:
+            self.block_min[-1] = min(self.block_min[-1], unix)
+            self.block_max[-1] = max(self.block_max[-1], unix)
+
+        block = len(self.block_count) - 1
+        self.block_count[-1] += 1
+        self.records += 1
+        self._arrays = None
+        if words is not None:
+            for word in words:
+                blocks = self.postings.setdefault(word, [])
+                if not blocks or blocks[-1] != block:
+                    blocks.append(block)
+
+    def arrays(self):
+        # numpy copies of the block index, rebuilt only after the segment changed
+        if self._arrays is None:
+            self._arrays = (np.array(self.block_min, dtype=np.int64), np.array(self.block_max, dtype=np.int64))
+        return self._arrays
+
+    def save(self, indexed):
+        meta = {
+            "version": LOG_VERSION,
+            "bytes": self.bytes,
+            "records": self.records,
+            "block_min": self.block_min,
+            "block_max": self.block_max,
+            "block_offset": self.block_offset,
+            "block_count": self.block_count,
+            "tokens": self.postings if indexed else None,
+        }
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.index_path)
+
+    def load(self):
+        """
+        Loads the saved index, returns False if there is none or the segment grew since it was saved.
+        """
+        if not os.path.exists(self.index_path):
+            return False
+        with open(self.index_path) as f:
+            meta = json.load(f)
+        if meta["version"] != LOG_VERSION:
+            raise Exception(f"unsupported log index version: {meta['version']}")
+        if meta["bytes"] != os.path.getsize(self.log_path):
+            return False
+
+        self.bytes = meta["bytes"]
+        self.records = meta["records"]
+        self.block_min = meta["block_min"]
+        self.block_max = meta["block_max"]
+        self.block_offset = meta["block_offset"]
+        self.block_count = meta["block_count"]
+        self.postings = meta["tokens"] or {}
+        return True
+
+def _records(data):
+    # yields (unix, subsec, seq, text, end offset) of every whole record in a buffer
+    pos = 0
+    while pos + LOG_RECORD.size <= len(data):
+        unix, subsec, seq, length = LOG_RECORD.unpack_from(data, pos)
+        end = pos + LOG_RECORD.size + length
+        if end > len(data):
+            break
+        yield unix, subsec, seq, data[pos + LOG_RECORD.size:end].decode("utf-8", "replace"), end
+        pos = end
+
+class LogStore:
+    """
+    Append only archive of console log lines with their strap time and packet seq, in segments with a
+    sparse time index and an inverted index of the words of every block. A query only reads the blocks
+    that can hold lines in its time range with all its words.
+    The index of the last segment lives in memory and is saved when the segment is closed or the store
+    is, after a crash it is rebuilt from the segment on open.
+    Records are written and indexes saved by a FileSink writer thread, so append never waits on the disk.
+    A line the sink has no room for is dropped and counted, and a query only sees what is already written.
+    A readonly store only queries, e.g. while a collector is appending to it.
+    """
+    def __init__(self, path, segment_bytes=SEGMENT_BYTES, block_records=BLOCK_RECORDS, indexed=True, flush_interval=1.0, max_queue=4096, readonly=False):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.block_records = block_records
+        self.indexed = indexed
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.readonly = readonly
+        self.dropped = 0
+        os.makedirs(path, exist_ok=True)
+
+        numbers = sorted(int(name[8:14]) for name in os.listdir(path) if re.fullmatch(r"segment_\d{6}\.log", name))
+        self.segments = []
+        for number in numbers:
+            segment = Segment(path, number)
+            if not segment.load():
+                self._rebuild(segment)
+            self.segments.append(segment)
+
+        if not self.segments:
+            self.segments.append(Segment(path, 0))
+        if not readonly:
+            self._open(self.segments[-1])
+
+    def __len__(self):
+        return sum(segment.records for segment in self.segments)
+
+    def __repr__(self):
+        return f"LogStore(path={self.path}, lines={len(self)}, segments={len(self.segments)}, dropped={self.dropped})"
+
+    def _rebuild(self, segment):
+        with open(segment.log_path, "rb") as f:
+            data = f.read()
+
+        end = 0
+        for unix, subsec, seq, text, next_end in _records(data):
+            segment.add(unix, end, indexed_tokens(text) if self.indexed else None, self.block_records)
+            end = next_end
+
+        # a record cut off by a crash is dropped
+        if end != len(data) and not self.readonly:
+            with open(segment.log_path, "r+b") as f:
+                f.truncate(end)
+        segment.bytes = end
+
+    def append(self, line):
+        """
+        Appends a LogLine.
+        """
+        segment = self.segments[-1]
+        if segment.bytes >= self.segment_bytes:
+            segment = self._roll()
+
+        text = line.text.encode("utf-8")[:0xFFFF]
+        if not segment.sink.write(LOG_RECORD.pack(line.unix, line.subsec, line.seq, len(text)) + text):
+            self.dropped += 1
+            return
+        segment.add(line.unix, segment.bytes, indexed_tokens(line.text) if self.indexed else None, self.block_records)
+        segment.bytes += LOG_RECORD.size + len(text)
+
+    def extend(self, lines):
+        for line in lines:
+            self.append(line)
+
+    def _open(self, segment):
+        segment.base = segment.bytes
+        segment.sink = FileSink(segment.log_path, "ab", max_queue=self.max_queue, flush_interval=self.flush_interval, on_close=lambda: segment.save(self.indexed))
+
+    def _roll(self):
+        # the writer thread finishes the full segment and saves its index
+        self.segments[-1].sink.close(wait=False)
+        segment = Segment(self.path, self.segments[-1].number + 1)
+        self.segments.append(segment)
+        self._open(segment)
+        return segment
+
+    def close(self):
+        """
+        Writes the queued lines and saves the indexes of the segments still being written.
+        """
+        for segment in self.segments:
+            if segment.sink is not None:
+                segment.sink.close()
+
+    def _blocks(self, segment, start, end, words):
+        if not segment.records:
+            return np.zeros(0, dtype=np.int64)
+
+        block_min, block_max = segment.arrays()
+        mask = np.ones(len(block_min), dtype=bool)
+        if start is not None:
+            mask &= block_max >= start
+        if end is not None:
+            mask &= block_min <= end
+        if words and self.indexed:
+            for word in words - {word for word in words if word.isdigit()}:
+                blocks = segment.postings.get(word)
+                if blocks is None:
+                    return np.zeros(0, dtype=np.int64)
+                keep = np.zeros(len(mask), dtype=bool)
+                keep[blocks] = True
+                mask &= keep
+        return np.flatnonzero(mask)
+
+    def query(self, start=None, end=None, words=None, contains=None, limit=None):
+        """
+        Returns the LogLines between start and end (inclusive, see to_epoch) that have all the words
+        (case insensitive, whole words, found through the index) and the contains substring, in archive order.
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        words = tokens(words if isinstance(words, str) else " ".join(words)) if words else set()
+        needle = contains.encode("utf-8") if contains is not None else None
+        encoded = [word.encode() for word in words]
+
+        out = []
+        for segment in self.segments:
+            blocks = self._blocks(segment, start, end, words)
+            if len(blocks) == 0:
+                continue
+
+            # read runs of consecutive blocks in one read each
+            runs = np.split(blocks, np.flatnonzero(np.diff(blocks) != 1) + 1)
+            readable = segment.readable()
+            with open(segment.log_path, "rb") as f:
+                for run in runs:
+                    lo = segment.block_offset[int(run[0])]
+                    last = int(run[-1]) + 1
+                    hi = min(segment.block_offset[last] if last < len(segment.block_offset) else segment.bytes, readable)
+                    if hi <= lo:
+                        continue
+                    f.seek(lo)
+                    data = f.read(hi - lo)
+                    pos = 0
+                    while pos + LOG_RECORD.size <= len(data):
+                        unix, subsec, seq, length = LOG_RECORD.unpack_from(data, pos)
+                        raw = data[pos + LOG_RECORD.size:pos + LOG_RECORD.size + length]
+                        pos += LOG_RECORD.size + length
+                        if start is not None and unix < start or end is not None and unix > end:
+                            continue
+                        # cheap checks on the bytes before anything is decoded
+                        if needle is not None and needle not in raw:
+                            continue
+                        if words:
+                            lower = raw.lower()
+                            if not all(word in lower for word in encoded):
+                                continue
+
+                        text = raw.decode("utf-8", "replace")
+                        if words and not words <= tokens(text):
+                            continue
+                        out.append(LogLine(unix, subsec, seq, text))
+                        if limit is not None and len(out) >= limit:
+                            return out
+        return out
+
+def main():
+    parser = argparse.ArgumentParser(description="search a console log archive")
+    parser.add_argument("path", help="log store directory (logs in a collector strap directory)")
+    parser.add_argument("--start_date", help="first time to include, e.g. 2025-01-01 or 2025-01-01 22:00:00")
+    parser.add_argument("--end_date", help="last time to include")
+    parser.add_argument("--words", nargs="+", help="whole words every line must have, found through the index (case insensitive)")
+    parser.add_argument("--grep", help="substring every line must contain")
+    parser.add_argument("--limit", type=int, default=None, help="stop after this many lines")
+    args = parser.parse_args()
+
+    store = LogStore(args.path, readonly=True)
+    start = time.perf_counter()
+    lines = store.query(args.start_date, args.end_date, args.words, args.grep, args.limit)
+    elapsed = time.perf_counter() - start
+    store.close()
+
+    for line in lines:
+        print(line)
+    print(f"{len(lines)} of {len(store)} lines in {elapsed * 1000:.1f} ms", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import json, time, bisect, asyncio
+
+# default histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    """
+    A monotonic count, or a function returning one that is only called when the metrics are read.
+    """
+    __slots__ = ("value", "func")
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.func() if self.func is not None else self.value
+
+class Gauge:
+    """
+    A value that goes up and down, set directly or read from a function when the metrics are read.
+    """
+    __slots__ = ("value", "func")
+
+    def __init__(self, func=None):
+        self.value = 0
+        self.func = func
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.func() if self.func is not None else self.value
+
+class Histogram:
+    """
+    Counts of observations per fixed bucket plus their sum, memory does not grow with the observations.
+    """
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # a bucket counts the values up to and including its bound
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        return self.count
+
+    def quantile(self, q):
+        """
+        Estimates the q quantile by interpolating inside its bucket, values over the last bound count as the last bound.
+        """
+        if self.count == 0:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lo = self.bounds[i - 1] if i > 0 else 0.0
+                hi = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lo + (hi - lo) * (rank - seen) / count
+            seen += count
+        return self.bounds[-1]
+
+class Family:
+    """
+    The metrics of one name, one child per set of label values.
+    """
+    def __init__(self, name, help, kind, factory):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.factory = factory
+        self.children = {}
+
+    def labels(self, labels, *args):
+        key = tuple(sorted(labels.items()))
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self.factory(*args)
+        return child
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metrics:
+    """
+    Registry of counters, gauges and histograms. The hot path only touches the child objects handed out
+    by counter, gauge and histogram, so every update is an attribute increment. Formatting happens when
+    the metrics are read, as Prometheus text (prometheus, or serve over HTTP) or as a JSON snapshot.
+    """
+    def __init__(self):
+        self.families = {}
+
+    def _family(self, name, help, kind, factory):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = Family(name, help, kind, factory)
+        elif family.kind != kind:
+            raise Exception(f"metric {name} is a {family.kind}, not a {kind}")
+        return family
+
+    def counter(self, name, help, func=None, **labels):
+        child = self._family(name, help, "counter", Counter).labels(labels)
+        if func is not None:
+            child.func = func
+        return child
+
+    def gauge(self, name, help, func=None, **labels):
+        child = self._family(name, help, "gauge", Gauge).labels(labels)
+        if func is not None:
+            child.func = func
+        return child
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self._family(name, help, "histogram", Histogram).labels(labels, buckets)
+
+    def remove(self, **labels):
+        """
+        Drops every child with these label values, e.g. of a strap that is gone.
+        """
+        items = set(labels.items())
+        for family in self.families.values():
+            for key in [key for key in family.children if items <= set(key)]:
+                del family.children[key]
+
+    def prometheus(self):
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        for family in self.families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for key, child in family.children.items():
+                if family.kind != "histogram":
+                    lines.append(f"{family.name}{_labels(key)} {_number(child.get())}")
+                    continue
+
+                total = 0
+                for bound, count in zip(child.bounds + (float("inf"),), child.counts):
+                    total += count
+                    lines.append(f"{family.name}_bucket{_labels(key, [('le', _number(bound))])} {total}")
+                lines.append(f"{family.name}_sum{_labels(key)} {_number(child.sum)}")
+                lines.append(f"{family.name}_count{_labels(key)} {child.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Every metric as a dict of name{labels} to its value, histograms as count, sum, mean, p50, p90 and p99.
+        """
+        out = {}
+        for family in self.families.values():
+            for key, child in family.children.items():
+                name = family.name + _labels(key)
+                if family.kind != "histogram":
+                    out[name] = child.get()
+                    continue
+
+                out[name] = {
+                    "count": child.count,
+                    "sum": child.sum,
+                    "mean": child.sum / child.count if child.count else None,
+                    "p50": child.quantile(0.5),
+                    "p90": child.quantile(0.9),
+                    "p99": child.quantile(0.99),
+                }
+        return out
+
+    async def serve(self, host="127.0.0.1", port=9464):
+        """
+        Serves GET /metrics as Prometheus text and GET /snapshot as JSON, returns the asyncio server.
+        """
+        async def handle(reader, writer):
+            try:
+                request = await reader.readline()
+                # skip the headers
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+
+                parts = request.decode("latin-1").split()
+                path = parts[1].split("?")[0] if len(parts) > 1 else ""
+                if path == "/metrics":
+                    status, kind, body = "200 OK", "text/plain; version=0.0.4", self.prometheus().encode()
+                elif path == "/snapshot":
+                    status, kind, body = "200 OK", "application/json", json.dumps(self.snapshot()).encode()
+                else:
+                    status, kind, body = "404 Not Found", "text/plain", b"not found\n"
+
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {kind}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+                await writer.drain()
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+    async def write_snapshots(self, path, interval=60.0):
+        """
+        Appends a JSON snapshot line to path every interval seconds, with the per second rate of every counter
+        since the line before. Runs until cancelled.
+        """
+        last = None
+        while True:
+            await asyncio.sleep(interval)
+            now = time.time()
+            snapshot = self.snapshot()
+            line = {"time": now, "metrics": snapshot}
+            if last is not None:
+                elapsed = now - last[0]
+                line["rates"] = {name: (value - last[1][name]) / elapsed for name, value in snapshot.items()
+                                 if name in last[1] and self._is_counter(name) and elapsed > 0}
+            last = (now, snapshot)
+            await asyncio.to_thread(_append, path, json.dumps(line) + "\n")
+
+    def _is_counter(self, name):
+        family = self.families.get(name.split("{")[0])
+        return family is not None and family.kind == "counter"
+
+def _append(path, text):
+    with open(path, "a") as f:
+        f.write(text)
+
+# the registry every StrapSession reports to unless it is given its own
+METRICS = Metrics()
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics_port", type=int, default=0, help="serve Prometheus metrics on 127.0.0.1:port/metrics, 0 is off")
+    parser.add_argument("--metrics_json", help="append a JSON snapshot of the metrics to this file every --metrics_interval seconds")
+    parser.add_argument("--metrics_interval", type=float, default=60.0, help="seconds between JSON snapshots (default is 60)")
+
+async def start_metrics(args, metrics=METRICS):
+    """
+    Starts the HTTP endpoint and the JSON snapshots asked for on the command line, returns a function stopping them.
+    """
+    server = await metrics.serve(port=args.metrics_port) if args.metrics_port else None
+    task = asyncio.ensure_future(metrics.write_snapshots(args.metrics_json, args.metrics_interval)) if args.metrics_json else None
+    if server is not None:
+        print(f"metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+
+    def stop():
+        if server is not None:
+            server.close()
+        if task is not None:
+            task.cancel()
+
+    return stop
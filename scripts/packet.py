@@ -1,5 +1,6 @@
-import struct, zlib, datetime, pytz
+import struct, zlib, collections
 from enum import Enum
+from timeutil import *
 
 class PacketType(Enum):
     COMMAND = 35
@@ -181,142 +182,206 @@ def crc8(buffer):
 
 # return "RawDataStreamResult(type=" + this.f100235a + ", timestampSeconds=" + this.f100236b + ", timestampSubseconds=" + this.f100237c + ", heartRate=" + C15640x.m68903i(this.f100238d) + ", accelerometerSamplesX=" + Arrays.toString(this.f100239e) + ", accelerometerSamplesY=" + Arrays.toString(this.f100240f) + ", accelerometerSamplesZ=" + Arrays.toString(this.f100241g) + ", gyroscopeSamplesX=" + Arrays.toString(this.f100242h) + ", gyroscopeSamplesY=" + Arrays.toString(this.f100243i) + ", gyroscopeSamplesZ=" + Arrays.toString(this.f100244j) + ")";
 
-def timestring(unix):
-    dt = datetime.datetime.fromtimestamp(unix)
-    est_timezone = pytz.timezone("US/Eastern")
-    dt_est = dt.astimezone(est_timezone)
+PACKET_TYPES = {t.value: t for t in PacketType}
 
-    return dt_est.strftime('%Y-%m-%d %I:%M:%S %p')
+# value to member lookups, unknown values stay plain ints instead of raising like Enum(value)
+METADATA_TYPES = {t.value: t for t in MetadataType}
+EVENT_NUMBERS = {e.value: e for e in EventNumber}
+COMMAND_NUMBERS = {c.value: c for c in CommandNumber}
+
+# REALTIME_DATA: unix, subsec, heart rate, rr count and three rr intervals, the unix time starts in the cmd byte
+REALTIME_STRUCT = struct.Struct("<LHBB3H")
+REALTIME_OFFSET = 6
+
+# typed records returned by the decoders, their str is what WhoopPacket.__str__ shows after the header
+class Realtime(collections.namedtuple("Realtime", "unix subsec heart_rate rr_count rr1 rr2 rr3")):
+    __slots__ = ()
+
+    def __str__(self):
+        resp = f"time({timestring(self.unix)}) heart({self.heart_rate}) "
+        if self.rr_count > 0:
+            resp += f"rr({self.rr1} {self.rr2} {self.rr3})"
+        return resp
+
+class Clock(collections.namedtuple("Clock", "unix")):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"timestamp({self.unix})"
+
+class Battery(collections.namedtuple("Battery", "level")):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"battery({self.level}%)"
+
+class Version(collections.namedtuple("Version", "harvard boylston")):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"version harvard({'.'.join(map(str, self.harvard))}) boylston({'.'.join(map(str, self.boylston))})"
+
+class WristEvent(collections.namedtuple("WristEvent", "event unix")):
+    __slots__ = ()
+
+    def __str__(self):
+        return f"timestamp({self.unix})"
+
+class Metadata(collections.namedtuple("Metadata", "kind unix subsec trim")):
+    """
+    HISTORY_START, HISTORY_END or HISTORY_COMPLETE, trim is only sent with HISTORY_END.
+    """
+    __slots__ = ()
 
 # Gen4PacketFrame and FramedPacket from Java
 class WhoopPacket:
+    """
+    Packets parsed with from_data keep a memoryview of their frame and only decode a field when it is accessed.
+    """
+    __slots__ = ("_frame", "_type", "_seq", "_cmd", "_data")
     sof = 0xAA
 
     def __init__(self, type=PacketType.COMMAND, seq=0, cmd=CommandNumber.GET_HELLO, data=b""):
-        self.type = type
-        self.seq = seq
-        self.cmd = cmd
-        self.data = data
+        self._frame = None
+        self._type = type
+        self._seq = seq
+        self._cmd = cmd
+        self._data = data
+
+    @property
+    def type(self):
+        if self._type is None:
+            # unknown types stay plain ints
+            self._type = PACKET_TYPES.get(self._frame[4], self._frame[4])
+        return self._type
+
+    @type.setter
+    def type(self, value):
+        self._type = value
 
-    def __str__(self):        
+    @property
+    def seq(self):
+        if self._seq is None:
+            self._seq = self._frame[5]
+        return self._seq
+
+    @seq.setter
+    def seq(self, value):
+        self._seq = value
+
+    @property
+    def cmd(self):
+        if self._cmd is None:
+            self._cmd = self._frame[6]
+        return self._cmd
+
+    @cmd.setter
+    def cmd(self, value):
+        self._cmd = value
+
+    @property
+    def payload(self):
+        """
+        The packet data without a copy, a memoryview of the frame for parsed packets.
+        """
+        if self._data is None:
+            return self._frame[7:self._frame[1] | self._frame[2] << 8]
+        return memoryview(self._data)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = bytes(self.payload)
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+    def __str__(self):
         te = self.type
-        if type(self.type) != PacketType:
-            te = PacketType(self.type)
+        if type(te) != PacketType:
+            return f"WhoopPacket: type[{te}]"
 
-        # realtime data
+        record = self.decode()
+        cmd = self.cmd.value if isinstance(self.cmd, Enum) else self.cmd
         if te == PacketType.REALTIME_DATA:
-            # TODO: fix this its bad, special case
-            recon = struct.pack("<B", self.cmd) + self.data[:7]
-            unix, subsec, heart, rrnum = struct.unpack("<LHBB", recon)
-            print(unix, subsec, heart, rrnum)
-            resp = f"WhoopPacket: type[{te}] time({timestring(unix)}) heart({heart}) "
-            if rrnum > 0:
-                rr1, rr2, rr3 = struct.unpack("<HHH", self.data[7:7 + 6])
-                resp += f"rr({rr1} {rr2} {rr3})"
-            
-            return resp
-        # event
+            return f"WhoopPacket: type[{te}] {record}"
         elif te == PacketType.EVENT:
-            ee = self.cmd
-            if type(self.cmd) != EventNumber:
-                ee = EventNumber(self.cmd)
-
-            resp = f"WhoopPacket: type[{te}] seq[{hex(self.seq)}] event({ee}) "
-            if ee == EventNumber.WRIST_ON:
-                # aa100057 30 7e 09 00 c2e96e67 685d0000a2a61c12
-                unix = struct.unpack("<L", self.data[1:5])[0]
-                resp += f"timestamp({unix})"
-            elif ee == EventNumber.WRIST_OFF:
-                # aa100057 30 04 0a 00 3bea6e67 58690000c7b723e7
-                unix = struct.unpack("<L", self.data[1:5])[0]
-                resp += f"timestamp({unix})"
-            else:
-                resp += f"data[{self.data.hex()}]"
-            
-            return resp
+            resp = f"WhoopPacket: type[{te}] seq[{hex(self.seq)}] event({EVENT_NUMBERS.get(cmd, cmd)}) "
         elif te == PacketType.COMMAND or te == PacketType.COMMAND_RESPONSE:
-            ce = self.cmd
-            if type(self.cmd) != CommandNumber:
-                ce = CommandNumber(self.cmd)
-            
-            resp = f"WhoopPacket: type[{te}] seq[{hex(self.seq)}] cmd[{ce}] "
-            if ce == CommandNumber.GET_CLOCK:
-                unix = struct.unpack("<L", self.data[2:6])[0]
-                resp += f"timestamp({unix})"
-            elif ce == CommandNumber.GET_BATTERY_LEVEL:
-                level = float(struct.unpack("<H", self.data[2:4])[0]) / 10
-                resp += f"battery({level}%)" 
-            elif ce == CommandNumber.REPORT_VERSION_INFO:
-                unpack = struct.unpack("<BBBLLLLLLLLLLLLLLLLBBL", self.data)
-                harvard = f"{unpack[3]}.{unpack[4]}.{unpack[5]}.{unpack[6]}"
-                boylston = f"{unpack[7]}.{unpack[8]}.{unpack[9]}.{unpack[10]}"
-                resp += f"version harvard({harvard}) boylston({boylston})" 
-            else:
-                resp += f"data[{self.data.hex()}]"
-
-            return resp
+            resp = f"WhoopPacket: type[{te}] seq[{hex(self.seq)}] cmd[{COMMAND_NUMBERS.get(cmd, cmd)}] "
         elif te == PacketType.HISTORICAL_DATA:
-            unix, subseconds = struct.unpack("<LH", self.data[0:4 + 2])
-            
-            resp = f"WhoopPacket: type[{te}] seq[{hex(self.seq)}] {self.data.hex()}" #unix({unix}) subseconds({subseconds})"
-
-            return resp
-
+            return f"WhoopPacket: type[{te}] seq[{hex(self.seq)}] {self.data.hex()}"
         elif te == PacketType.METADATA:
-            # 75c47a67 9858 06000000100000000200000029000000100000000600000000000000080200
-            # 75c47a67 186b 33000000948b000000000000000000
-            # 76c47a67 8802 06000000100000000200000029000000100000000600000000000000080200
-            # 76c47a67 2815 32000000998b000000000000000000
-
-            # end
-            # c9c47a67 a006 320000009e8b000000000000000000
-            # c9c47a67 182e 39000000a38b000000000000000000
-            # c9c47a67 f875 67000000a68b000000000000000000
-            # cac47a67 f825 48000000a98b000000000000000000
-            # cac47a67 3063 4c000000ac8b000000000000000000
-            # cbc47a67 e008 37000000ae8b000000000000000000
-
-            # complete
-            # b2c57a67 7033 000000
-
-            return f"WhoopPacket: type[{te}] metadata[{MetadataType(self.cmd)}] data[{self.data.hex()}]"
+            # e.g. HISTORY_END c9c47a67 a006 320000009e8b000000000000000000, unix subsec unk trim
+            return f"WhoopPacket: type[{te}] metadata[{METADATA_TYPES.get(cmd, cmd)}] data[{self.data.hex()}]"
         elif te == PacketType.CONSOLE_LOGS:
             # aa44000f 32 32 02 0053ea6e67 186b 340001726473203d20320a2031302c20333136373830323a2053494750524f432d574541522d4445544543542056333a206d6f766900 21e17a8d
-            # aa44000f 32 33 02 0053ea6e67 186b 3400016e672066726f6d207374617465203120746f207374617465203320286465627567203d2034292c2073746174655f636e742000 09a813f6
-            # aa44000f 32 5b 02 0081ea6e67 f053 34000165616c74696d652048522064697361626c65640a2031302c20333233373632303a2053656e736f72733a205265616c74696d0007ed8ada
             return self.data[7:len(self.data) - 1].decode()
         else:
             return f"WhoopPacket: type[{te}]"
 
+        if record is None:
+            return resp + f"data[{self.data.hex()}]"
+        return resp + str(record)
+
+    def decode(self):
+        """
+        The typed record of the packet from the decoder registered for its type and cmd, None if there is none.
+        """
+        return decode_packet(self)
+
+    def realtime(self):
+        """
+        Realtime (unix, subsec, heart rate, rr count, rr1, rr2, rr3) of a REALTIME_DATA packet, unpacked in place from the frame.
+        """
+        frame = self._frame
+        if frame is not None and len(frame) >= REALTIME_OFFSET + REALTIME_STRUCT.size + 4:
+            return Realtime._make(REALTIME_STRUCT.unpack_from(frame, REALTIME_OFFSET))
+
+        # built packets, and short frames without all the rr slots
+        cmd = self.cmd.value if isinstance(self.cmd, Enum) else self.cmd
+        buf = (bytes([cmd]) + bytes(self.payload)).ljust(REALTIME_STRUCT.size, b"\x00")
+        return Realtime._make(REALTIME_STRUCT.unpack_from(buf))
+
+    @staticmethod
     def from_data(data):
+        """
+        Parses a frame. The packet keeps a view of data, so data must not be modified afterwards.
+        """
+        frame = memoryview(data)
+
         # verify SOF
-        if data[0] != WhoopPacket.sof:
-            raise Exception(f"invalid packet sof: {data.hex()}")
+        if frame[0] != WhoopPacket.sof:
+            raise Exception(f"invalid packet sof: {frame.hex()}")
         
         # verify header crc8
-        if crc8(data[1:3]) != data[3]:
+        if crc8(frame[1:3]) != frame[3]:
             raise Exception(f"invalid packet header crc8")
 
         # verify data crc32
-        length = struct.unpack("<H", data[1:3])[0]
-        pkt = data[4:length]
-        calculated = zlib.crc32(pkt) & 0xFFFFFFFF
-        expected = struct.unpack("<L", data[length:length + 4])[0]
+        length = frame[1] | frame[2] << 8
+        calculated = zlib.crc32(frame[4:length]) & 0xFFFFFFFF
+        expected = int.from_bytes(frame[length:length + 4], "little")
         if calculated != expected:
             raise Exception(f"invalid packet data crc32")
-        
-        return WhoopPacket(PacketType(pkt[0]), pkt[1], pkt[2], pkt[3:length])
+
+        packet = WhoopPacket.__new__(WhoopPacket)
+        packet._frame = frame
+        packet._type = packet._seq = packet._cmd = packet._data = None
+        return packet
 
     def create_packet(self):
         tv = self.type
-        if type(self.type) == PacketType:
-            tv = self.type.value
+        if isinstance(tv, Enum):
+            tv = tv.value
 
         tc = self.cmd
-        if type(self.cmd) == CommandNumber:
-            tc = self.cmd.value
+        if isinstance(tc, Enum):
+            tc = tc.value
 
-        return struct.pack("<BBB", tv, self.seq, tc) + self.data
+        return struct.pack("<BBB", tv, self.seq, tc) + self.payload
 
     def framed_packet(self):
         pkt = self.create_packet()
@@ -324,6 +389,163 @@ class WhoopPacket:
         crc32 = zlib.crc32(pkt) & 0xFFFFFFFF
         return struct.pack("<B", WhoopPacket.sof) + blen + struct.pack("<B", crc8(blen)) + pkt + struct.pack("<L", crc32)
 
+# (packet type, cmd) values to a function decoding a packet into a typed record,
+# cmd None is the fallback for every cmd of a type, e.g. REALTIME_DATA where the cmd is part of the unix time
+DECODERS = {}
+
+def register_decoder(type, cmd, layout, make=None, offset=0):
+    """
+    Registers a decoder unpacking layout, a struct.Struct, from offset into the packet data and passing the values to make.
+    layout can also be a function of the packet doing the whole decode.
+    """
+    key = (type.value, None if cmd is None else cmd.value)
+    if not isinstance(layout, struct.Struct):
+        DECODERS[key] = layout
+        return
+
+    unpack = layout.unpack_from
+    DECODERS[key] = lambda packet: make(unpack(packet.payload, offset))
+
+def decode_packet(packet):
+    """
+    Decodes a packet with the decoder registered for it, returns None if there is none.
+    """
+    frame = packet._frame
+    if frame is not None:
+        # parsed packets are keyed straight from the frame bytes
+        key = (frame[4], frame[6])
+    else:
+        type, cmd = packet.type, packet.cmd
+        key = (type.value if isinstance(type, Enum) else type, cmd.value if isinstance(cmd, Enum) else cmd)
+
+    decoder = DECODERS.get(key)
+    if decoder is None:
+        decoder = DECODERS.get((key[0], None))
+        if decoder is None:
+            return None
+    return decoder(packet)
+
+CLOCK_STRUCT = struct.Struct("<L")
+BATTERY_STRUCT = struct.Struct("<H")
+VERSION_STRUCT = struct.Struct("<BBBLLLLLLLLLLLLLLLLBBL")
+EVENT_TIME_STRUCT = struct.Struct("<L")
+METADATA_STRUCT = struct.Struct("<LH")
+HISTORY_END_STRUCT = struct.Struct("<LHLL")
+
+register_decoder(PacketType.REALTIME_DATA, None, WhoopPacket.realtime)
+register_decoder(PacketType.COMMAND_RESPONSE, CommandNumber.GET_CLOCK, CLOCK_STRUCT, lambda v: Clock(v[0]), 2)
+register_decoder(PacketType.COMMAND_RESPONSE, CommandNumber.GET_BATTERY_LEVEL, BATTERY_STRUCT, lambda v: Battery(v[0] / 10), 2)
+register_decoder(PacketType.COMMAND_RESPONSE, CommandNumber.REPORT_VERSION_INFO, VERSION_STRUCT, lambda v: Version(v[3:7], v[7:11]))
+register_decoder(PacketType.EVENT, EventNumber.WRIST_ON, EVENT_TIME_STRUCT, lambda v: WristEvent(EventNumber.WRIST_ON, v[0]), 1)
+register_decoder(PacketType.EVENT, EventNumber.WRIST_OFF, EVENT_TIME_STRUCT, lambda v: WristEvent(EventNumber.WRIST_OFF, v[0]), 1)
+register_decoder(PacketType.METADATA, MetadataType.HISTORY_START, METADATA_STRUCT, lambda v: Metadata(MetadataType.HISTORY_START, v[0], v[1], None))
+register_decoder(PacketType.METADATA, MetadataType.HISTORY_END, HISTORY_END_STRUCT, lambda v: Metadata(MetadataType.HISTORY_END, v[0], v[1], v[3]))
+register_decoder(PacketType.METADATA, MetadataType.HISTORY_COMPLETE, METADATA_STRUCT, lambda v: Metadata(MetadataType.HISTORY_COMPLETE, v[0], v[1], None))
+
+def frame_offsets(data, partial=False):
+    """
+    Returns the start offset and total length (crc32 included) of every frame in a buffer.
+    With partial set a truncated frame at the end of the buffer is left out instead of raising.
+    """
+    import numpy as np
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if len(buf) < 3:
+        if len(buf) == 0 or partial:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        raise Exception("truncated packet header at offset 0")
+
+    # fast path, every frame has the same length
+    length = int(buf[1]) | int(buf[2]) << 8
+    length += 4
+    if len(buf) % length == 0:
+        offsets = np.arange(0, len(buf), length, dtype=np.int64)
+        lengths = buf[offsets + 1].astype(np.int64) | buf[offsets + 2].astype(np.int64) << 8
+        if np.all(lengths + 4 == length):
+            return offsets, lengths + 4
+
+    # walk the headers
+    offsets = []
+    lengths = []
+    dp = 0
+    while dp < len(buf):
+        if dp + 3 > len(buf):
+            if partial:
+                break
+            raise Exception(f"truncated packet header at offset {dp}")
+        length = (data[dp + 1] | data[dp + 2] << 8) + 4
+        if dp + length > len(buf):
+            if partial:
+                break
+            raise Exception(f"truncated packet at offset {dp}")
+        offsets.append(dp)
+        lengths.append(length)
+        dp += length
+
+    return np.array(offsets, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+def header_crc8(buf, offsets):
+    """
+    crc8 of the two length bytes of every frame header at once.
+    """
+    import numpy as np
+
+    tab = np.array(crc8tab, dtype=np.uint8)
+    return tab[tab[buf[offsets + 1]] ^ buf[offsets + 2]]
+
+def validate_payloads(data, offsets, lengths, mask=None):
+    """
+    Checks the data crc32 of every frame (or of the frames set in mask), returns a validity mask.
+    """
+    import numpy as np
+
+    view = memoryview(data)
+    valid = np.zeros(len(offsets), dtype=bool)
+    indices = range(len(offsets)) if mask is None else np.flatnonzero(mask).tolist()
+    for i in indices:
+        offset = int(offsets[i])
+        end = offset + int(lengths[i])
+        valid[i] = zlib.crc32(view[offset + 4:end - 4]) & 0xFFFFFFFF == int.from_bytes(view[end - 4:end], "little")
+
+    return valid
+
+def validate_frames(data, offsets=None, lengths=None, payload=True):
+    """
+    Checks every frame of a buffer of framed packets in one call.
+    The sof and header crc8 of all frames are checked vectorized, the data crc32 only when payload is set,
+    validate_payloads can run it later on the frames of data that was already checked at ingest.
+    Returns the validity mask, the frame offsets and the frame lengths.
+    """
+    import numpy as np
+
+    if offsets is None:
+        offsets, lengths = frame_offsets(data)
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    valid = (buf[offsets] == WhoopPacket.sof) & (header_crc8(buf, offsets) == buf[offsets + 3])
+    if payload:
+        valid &= validate_payloads(data, offsets, lengths, valid)
+
+    return valid, offsets, lengths
+
+def verify_frames(data, offsets, lengths, payload=True):
+    """
+    Like validate_frames, but raises on the first invalid frame.
+    """
+    import numpy as np
+
+    valid = validate_frames(data, offsets, lengths, payload)[0]
+    bad = np.flatnonzero(~valid)
+    if len(bad) == 0:
+        return
+
+    offset = int(offsets[bad[0]])
+    if data[offset] != WhoopPacket.sof:
+        raise Exception(f"invalid packet sof at offset {offset}")
+    if crc8(data[offset + 1:offset + 3]) != data[offset + 3]:
+        raise Exception(f"invalid packet header crc8 at offset {offset}")
+    raise Exception(f"invalid packet data crc32 at offset {offset}")
+
 if __name__ == "__main__":
     # COMMAND = 35
     # TOGGLE_REALTIME_HR = 3
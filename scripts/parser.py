@@ -1,7 +1,92 @@
 
-import sys, struct, datetime, pytz, numpy as np
+import os, sys, mmap, bisect, struct, zlib, datetime, numpy as np
 from packet import *
 
+def to_epoch(value):
+    """
+    Converts a time bound to unix seconds. Accepts unix seconds, datetimes, and strings either in
+    DATE_FORMAT or ISO 8601. Naive times are taken in the timeutil timezone, like the timestamps we print.
+    """
+    if value is None or isinstance(value, (int, float, np.integer, np.floating)):
+        return value
+
+    if isinstance(value, str):
+        try:
+            return float(value) if "." in value else int(value)
+        except ValueError:
+            pass
+
+        try:
+            value = datetime.datetime.strptime(value, DATE_FORMAT)
+        except ValueError:
+            value = datetime.datetime.fromisoformat(value)
+
+    if value.tzinfo is None:
+        value = get_timezone().localize(value)
+
+    return int(value.timestamp()) if value.microsecond == 0 else value.timestamp()
+
+
+ANOMALY_HEART_RATE = 20
+# what hold fills in when there is no valid value at all
+ANOMALY_DEFAULT = 60
+FILL_POLICIES = ("hold", "linear", "nearest", "nan")
+
+def fill_gaps(values, valid, policy="hold", max_gap=None):
+    """
+    Fills the runs of invalid values of an array in one vectorized pass.
+    hold is what interpolate_anomalies always did: a run takes the next valid value, a single invalid value
+    between two valid ones their mean, and a run at the end the last valid value. With no valid value at all
+    everything becomes ANOMALY_DEFAULT, except one or two values, which are kept as they are.
+    linear interpolates between the valid neighbours, nearest copies the closest valid value and nan leaves
+    every gap as nan, for these gaps at either end take the nearest valid value.
+    Runs longer than max_gap are left as nan. Returns the filled float array and a mask of the indices that were filled.
+    """
+    if policy not in FILL_POLICIES:
+        raise Exception(f"invalid fill policy: {policy}")
+
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.asarray(valid, dtype=bool)
+    out = np.where(valid, values, np.nan)
+
+    fill = ~valid
+    if max_gap is not None:
+        # label each run of invalid values and drop the long ones
+        starts = fill & ~np.concatenate(([False], fill[:-1]))
+        runs = np.cumsum(starts)
+        lengths = np.bincount(runs, weights=fill)
+        fill &= lengths[runs] <= max_gap
+
+    good = np.flatnonzero(valid)
+    if policy == "hold" and len(good) == 0 and fill.any():
+        # interpolate_anomalies never touched the first and the last value unless there was one in between
+        if len(values) <= 2:
+            return values.copy(), np.zeros(len(values), dtype=bool)
+        out[fill] = ANOMALY_DEFAULT
+        return out, fill
+    if policy == "nan" or len(good) == 0 or not fill.any():
+        return out, np.zeros(len(values), dtype=bool)
+
+    idx = np.flatnonzero(fill)
+    if policy == "linear":
+        # np.interp holds the end values past the first and last valid index
+        out[idx] = np.interp(idx, good, values[good])
+    else:
+        # index of the previous and the next valid value of every gap index
+        pos = np.searchsorted(good, idx)
+        prev = good[np.maximum(pos - 1, 0)]
+        following = good[np.minimum(pos, len(good) - 1)]
+        if policy == "hold":
+            following_valid = pos < len(good)
+            out[idx] = np.where(following_valid, values[following], values[prev])
+            single = (pos > 0) & following_valid & (prev == idx - 1) & (following == idx + 1)
+            out[idx[single]] = (values[prev[single]] + values[following[single]]) / 2
+        else:
+            src = np.where((pos > 0) & ((idx - prev <= following - idx) | (pos == len(good))), prev, following)
+            out[idx] = values[src]
+
+    return out, fill
+
 class HistoricalRecord:
     def __init__(self, unix, heart_rate, rr):
         self.unix = unix
@@ -9,11 +94,7 @@ class HistoricalRecord:
         self.rr = rr
     
     def timestamp(self):
-        dt = datetime.datetime.fromtimestamp(self.unix)
-        est_timezone = pytz.timezone("US/Eastern")
-        dt_est = dt.astimezone(est_timezone)
-
-        return dt_est.strftime('%Y-%m-%d %I:%M:%S %p')
+        return timestring(self.unix)
 
     def __repr__(self):
         return f"HistoricalRecord(timestamp={self.timestamp()}, heart_rate={self.heart_rate})"
@@ -22,143 +103,375 @@ class HistoricalRecord:
     def filter_records_by_date(records, start_date, end_date):
         """
         Filters the list of HistoricalRecord objects by a given date range.
+        Records must be sorted by unix time, the bounds are found with a binary search.
         """
-        start_dt = datetime.datetime.strptime(start_date, "%Y-%m-%d %I:%M:%S %p")
-        end_dt = datetime.datetime.strptime(end_date, "%Y-%m-%d %I:%M:%S %p")
-        
-        filtered_records = [
-            record for record in records
-            if start_dt <= datetime.datetime.strptime(record.timestamp(), "%Y-%m-%d %I:%M:%S %p") <= end_dt
-        ]
-        
-        return filtered_records
+        lo, hi = 0, len(records)
+        start = to_epoch(start_date)
+        if start is not None:
+            lo = bisect.bisect_left(records, start, key=lambda record: record.unix)
+
+        end = to_epoch(end_date)
+        if end is not None:
+            hi = bisect.bisect_right(records, end, lo=lo, key=lambda record: record.unix)
+
+        return records[lo:hi]
 
     @staticmethod
-    def interpolate_anomalies(records):
+    def interpolate_anomalies(records, policy="hold", max_gap=None):
         """
         Interpolates heart rate values that are below 20 (considered anomalies).
-        Handles the case where both previous and next records are anomalies.
-        """
-        for i in range(1, len(records) - 1):
-            if records[i].heart_rate < 20:
-                prev_record = records[i - 1]
-                next_record = records[i + 1]
-                
-                # Case 1: Both previous and next records are valid, interpolate
-                if prev_record.heart_rate >= 20 and next_record.heart_rate >= 20:
-                    interpolated_heart_rate = (prev_record.heart_rate + next_record.heart_rate) / 2
-                    records[i].heart_rate = interpolated_heart_rate
-                
-                # Case 2: If previous or next records are anomalies, replace with nearest valid record
-                elif prev_record.heart_rate < 20 or next_record.heart_rate < 20:
-                    # Search forward or backward for a valid record
-                    # Look forward for the next valid record
-                    forward_idx = i + 1
-                    while forward_idx < len(records) and records[forward_idx].heart_rate < 20:
-                        forward_idx += 1
-                    
-                    # If a valid record is found, use it
-                    if forward_idx < len(records):
-                        records[i].heart_rate = records[forward_idx].heart_rate
-                    else:
-                        # If no valid record found forward, look backward
-                        backward_idx = i - 1
-                        while backward_idx >= 0 and records[backward_idx].heart_rate < 20:
-                            backward_idx -= 1
-                        
-                        if backward_idx >= 0:
-                            records[i].heart_rate = records[backward_idx].heart_rate
-                        else:
-                            # If no valid record found at all, replace with a default value (e.g., mean or zero)
-                            records[i].heart_rate = 60  # Default value (could be modified as needed)
-        
-        # Check the first and last record in case they are anomalies
-        if records[0].heart_rate < 20:
-            for i in range(1, len(records)):
-                if records[i].heart_rate >= 20:
-                    records[0].heart_rate = records[i].heart_rate  # Set the first value to the first valid heart rate
-                    break
+        See fill_gaps for the policies, anomalies that are not filled become nan.
+        """
+        if len(records) == 0:
+            return records
+
+        heart_rate = np.fromiter((record.heart_rate for record in records), dtype=np.float64, count=len(records))
+        filled, _ = fill_gaps(heart_rate, heart_rate >= ANOMALY_HEART_RATE, policy, max_gap)
+        for i in np.flatnonzero(heart_rate < ANOMALY_HEART_RATE).tolist():
+            records[i].heart_rate = float(filled[i])
 
-        if records[-1].heart_rate < 20:
-            for i in range(len(records) - 2, -1, -1):
-                if records[i].heart_rate >= 20:
-                    records[-1].heart_rate = records[i].heart_rate  # Set the last value to the last valid heart rate
-                    break
-        
         return records
 
     @staticmethod
     def downsample(records, interval=5):
         """
-        Downsamples records to a specific interval (in seconds).
-        """
-        # downsampled_records = []
-        # last_time = None
-        
-        # for record in records:
-        #     if last_time is None or record.unix - last_time >= interval:
-        #         downsampled_records.append(record)
-        #         last_time = record.unix
-                
-        # return downsampled_records
-        downsampled_records = []
-        interval_start_time = records[0].unix  # Initialize the start time of the first interval
-        interval_values = []
-        
-        for record in records:
-            # If the current record is within the same interval, add it to the interval_values list
-            if record.unix < interval_start_time + interval:
-                interval_values.append(record.heart_rate)
-            else:
-                # If the current record is outside the current interval, calculate the average and create a new record
-                if interval_values:
-                    avg_heart_rate = np.mean(interval_values)
-                    downsampled_records.append(HistoricalRecord(interval_start_time, avg_heart_rate, []))
-                
-                # Reset for the next interval
-                interval_values = [record.heart_rate]
-                interval_start_time = record.unix
-        
-        # Ensure the last interval is included
-        if interval_values:
-            avg_heart_rate = np.mean(interval_values)
-            downsampled_records.append(HistoricalRecord(interval_start_time, avg_heart_rate, []))
-        
-        return downsampled_records
+        Downsamples records to a specific interval (in seconds), averaging the heart rate of each
+        interval long bucket aligned to the unix epoch. Records with a nan heart rate are left out.
+        """
+        if len(records) == 0:
+            return []
+
+        unix = np.fromiter((record.unix for record in records), dtype=np.int64, count=len(records))
+        heart_rate = np.fromiter((record.heart_rate for record in records), dtype=np.float64, count=len(records))
+        rows = rollup(unix, heart_rate, interval)
+
+        return [HistoricalRecord(unix, mean, []) for unix, mean in zip(rows["unix"].tolist(), (rows["sum"] / rows["count"]).tolist())]
     
-def parse_data(file_path):
+ROLLUP_DTYPE = np.dtype([("unix", "<u4"), ("count", "<u4"), ("sum", "<f8"), ("min", "<f4"), ("max", "<f4")])
+
+def _buckets(unix, values, interval, by_value=False):
+    # drop nan values, sort by bucket (and by value within a bucket) and find where each bucket starts
+    unix = np.asarray(unix, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    ok = ~np.isnan(values)
+    keys = unix[ok] // interval
+    values = values[ok]
+
+    if by_value:
+        order = np.lexsort((values, keys))
+        keys, values = keys[order], values[order]
+    elif len(keys) > 1 and np.any(keys[1:] < keys[:-1]):
+        order = np.argsort(keys, kind="stable")
+        keys, values = keys[order], values[order]
+
+    starts = np.flatnonzero(np.diff(keys)) + 1
+    starts = np.concatenate(([0], starts)) if len(keys) else starts
+    return keys, values, starts
+
+def _reduce(keys, counts, sums, mins, maxs, starts, interval):
+    rows = np.empty(len(starts), dtype=ROLLUP_DTYPE)
+    rows["unix"] = keys[starts] * interval
+    rows["count"] = np.add.reduceat(counts, starts) if len(starts) else 0
+    rows["sum"] = np.add.reduceat(sums, starts) if len(starts) else 0
+    rows["min"] = np.minimum.reduceat(mins, starts) if len(starts) else 0
+    rows["max"] = np.maximum.reduceat(maxs, starts) if len(starts) else 0
+    return rows
+
+def rollup(unix, values, interval):
+    """
+    Buckets values into interval second buckets aligned to the unix epoch in one pass.
+    Returns ROLLUP_DTYPE rows with the count, sum, min and max of every bucket, nan values are left out.
+    """
+    keys, values, starts = _buckets(unix, values, interval)
+    return _reduce(keys, np.ones(len(values), dtype=np.int64), values, values, values, starts, interval)
+
+def merge_rollup(rows, interval):
+    """
+    Rolls ROLLUP_DTYPE rows up into interval second buckets, interval must be a multiple of theirs.
+    Rows of the same bucket are merged, so rollups of consecutive chunks can be concatenated first.
+    """
+    keys = rows["unix"].astype(np.int64) // interval
+    if len(keys) > 1 and np.any(keys[1:] < keys[:-1]):
+        order = np.argsort(keys, kind="stable")
+        rows, keys = rows[order], keys[order]
+
+    starts = np.flatnonzero(np.diff(keys)) + 1
+    starts = np.concatenate(([0], starts)) if len(keys) else starts
+    return _reduce(keys, rows["count"], rows["sum"], rows["min"], rows["max"], starts, interval)
+
+def rollup_stats(rows):
+    """
+    Returns the unix (bucket start), count, mean, min and max columns of ROLLUP_DTYPE rows.
+    """
+    return {
+        "unix": rows["unix"].astype(np.int64),
+        "count": rows["count"].astype(np.int64),
+        "mean": rows["sum"] / np.maximum(rows["count"], 1),
+        "min": rows["min"].astype(np.float64),
+        "max": rows["max"].astype(np.float64),
+    }
+
+def bucket_stats(unix, values, interval, percentiles=()):
+    """
+    Computes the count, mean, min, max and percentiles (e.g. 5, 50, 95) of every interval second bucket in one pass.
+    Returns a dict of columns, the percentiles are named like p50.
+    """
+    keys, values, starts = _buckets(unix, values, interval, by_value=len(percentiles) > 0)
+    stats = rollup_stats(_reduce(keys, np.ones(len(values), dtype=np.int64), values, values, values, starts, interval))
+
+    # values are sorted within every bucket, so percentiles are read off by position
+    counts = stats["count"]
+    for p in percentiles:
+        pos = starts + (counts - 1) * (p / 100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        stats[f"p{p:g}"] = values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+    return stats
+
+# frame layout of a HISTORICAL_DATA packet, sof through the rr intervals
+HISTORICAL_FIELDS = {
+    "sof": ("u1", 0),
+    "length": ("<u2", 1),
+    "crc8": ("u1", 3),
+    "type": ("u1", 4),
+    "seq": ("u1", 5),
+    "cmd": ("u1", 6),
+    "unix": ("<u4", 11),
+    "subsec": ("<u2", 15),
+    "heart_rate": ("u1", 21),
+    "rr_count": ("u1", 22),
+    "rr": (("<u2", (4,)), 23),
+}
+HISTORICAL_SIZE = 31
+
+def historical_dtype(itemsize=HISTORICAL_SIZE):
+    return np.dtype({
+        "names": list(HISTORICAL_FIELDS),
+        "formats": [f for f, _ in HISTORICAL_FIELDS.values()],
+        "offsets": [o for _, o in HISTORICAL_FIELDS.values()],
+        "itemsize": itemsize,
+    })
+
+class HistoricalTable:
+    """
+    Columnar HISTORICAL_DATA records, one numpy array per field.
+    """
+    def __init__(self, unix, subsec, heart_rate, rr_count, rr):
+        self.unix = unix
+        self.subsec = subsec
+        self.heart_rate = heart_rate
+        self.rr_count = rr_count
+        self.rr = rr
+
+    def __len__(self):
+        return len(self.unix)
+
+    def __repr__(self):
+        return f"HistoricalTable(records={len(self)})"
+
+    @staticmethod
+    def empty():
+        return HistoricalTable(
+            np.zeros(0, dtype=np.uint32),
+            np.zeros(0, dtype=np.uint16),
+            np.zeros(0, dtype=np.uint8),
+            np.zeros(0, dtype=np.uint8),
+            np.zeros((0, 4), dtype=np.uint16),
+        )
+
+    @staticmethod
+    def from_rows(rows):
+        """
+        Builds a table from an array of historical_dtype() rows.
+        """
+        rows = rows[rows["type"] == PacketType.HISTORICAL_DATA.value]
+
+        rr_count = np.ascontiguousarray(rows["rr_count"])
+        bad = np.flatnonzero(rr_count > 4)
+        if len(bad):
+            raise Exception(f"rrnum not 1, 2, 3, or 4: {rr_count[bad[0]]}")
+
+        # zero the unused rr slots so the array can be used directly
+        rr = np.array(rows["rr"])
+        rr[np.arange(4) >= rr_count[:, None]] = 0
+
+        return HistoricalTable(
+            np.ascontiguousarray(rows["unix"]),
+            np.ascontiguousarray(rows["subsec"]),
+            np.ascontiguousarray(rows["heart_rate"]),
+            rr_count,
+            rr,
+        )
+
+    @staticmethod
+    def from_buffer(data, verify=True, trusted=False):
+        """
+        Decodes every HISTORICAL_DATA packet of a buffer of framed packets in one pass.
+        trusted skips the data crc32 of frames that were already checked when they were captured.
+        """
+        offsets, lengths = frame_offsets(data)
+        if len(offsets) == 0:
+            return HistoricalTable.empty()
+
+        if verify:
+            verify_frames(data, offsets, lengths, payload=not trusted)
+
+        buf = np.frombuffer(data, dtype=np.uint8)
+        historical = buf[offsets + 4] == PacketType.HISTORICAL_DATA.value
+        short = np.flatnonzero(historical & (lengths < HISTORICAL_SIZE + 4))
+        if len(short):
+            raise Exception(f"historical packet too short at offset {offsets[short[0]]}")
+
+        length = int(lengths[0])
+        if np.all(lengths == length):
+            # fixed layout, view the buffer in place
+            rows = np.frombuffer(data, dtype=historical_dtype(length))
+        else:
+            # gather the fixed-size prefix of each historical frame
+            offsets = offsets[historical]
+            rows = buf[offsets[:, None] + np.arange(HISTORICAL_SIZE)].view(historical_dtype()).reshape(-1)
+
+        return HistoricalTable.from_rows(rows)
+
+    def slice(self, lo, hi):
+        return HistoricalTable(self.unix[lo:hi], self.subsec[lo:hi], self.heart_rate[lo:hi], self.rr_count[lo:hi], self.rr[lo:hi])
+
+    def between(self, start=None, end=None):
+        """
+        Returns the records between start and end (inclusive), see to_epoch for the accepted bounds.
+        The table must be sorted by unix time, the bounds are found with a binary search.
+        """
+        lo, hi = 0, len(self)
+        start = to_epoch(start)
+        if start is not None:
+            lo = int(np.searchsorted(self.unix, start, side="left"))
+
+        end = to_epoch(end)
+        if end is not None:
+            hi = max(lo, int(np.searchsorted(self.unix, end, side="right")))
+
+        return self.slice(lo, hi)
+
+    def interpolate_anomalies(self, policy="hold", max_gap=None):
+        """
+        Returns the heart rate as floats with the anomalies (below 20) filled, see fill_gaps,
+        and a mask of the filled indices.
+        """
+        return fill_gaps(self.heart_rate, self.heart_rate >= ANOMALY_HEART_RATE, policy, max_gap)
+
+    def valid_heart_rate(self):
+        """
+        The heart rate as floats with the anomalies (below 20) as nan.
+        """
+        return np.where(self.heart_rate >= ANOMALY_HEART_RATE, self.heart_rate, np.nan)
+
+    def downsample(self, interval=5, percentiles=()):
+        """
+        Heart rate count/mean/min/max/percentiles per interval second bucket, anomalies left out, see bucket_stats.
+        """
+        return bucket_stats(self.unix, self.valid_heart_rate(), interval, percentiles)
+
+    def records(self):
+        """
+        Builds the HistoricalRecord list.
+        """
+        rr = self.rr.tolist()
+        return [
+            HistoricalRecord(unix, heart, rr[i][:count])
+            for i, (unix, heart, count) in enumerate(zip(self.unix.tolist(), self.heart_rate.tolist(), self.rr_count.tolist()))
+        ]
+
+    @staticmethod
+    def concat(tables):
+        tables = list(tables)
+        if len(tables) == 0:
+            return HistoricalTable.empty()
+
+        return HistoricalTable(
+            np.concatenate([t.unix for t in tables]),
+            np.concatenate([t.subsec for t in tables]),
+            np.concatenate([t.heart_rate for t in tables]),
+            np.concatenate([t.rr_count for t in tables]),
+            np.concatenate([t.rr for t in tables]),
+        )
+
+def iter_windows(file_path, batch_size=65536, verify=True, offset=0, partial=False, trusted=False):
+    """
+    Memory maps a dump and yields (end offset, HistoricalTable) for batches of at most batch_size packets,
+    starting at byte offset. With partial set a truncated frame at the end of the file ends the iteration.
+    """
     with open(file_path, "rb") as f:
-        data = f.read()
-
-    records = []
-
-    dp = 0
-    while dp != len(data):
-        length = struct.unpack("<H", data[dp + 1:dp + 3])[0] + 4 # add crc32 length
-        pkt = WhoopPacket.from_data(data[dp:dp + length])
-        dp += length
-
-        # unpack the heart rate and timestamp data
-        unix, subsec, unk, heart = struct.unpack("<LHLB", pkt.data[4:4 + 11])
-
-        # rr intervals
-        rrnum = pkt.data[15]
-        rr1, rr2, rr3, rr4 = struct.unpack("<HHHH", pkt.data[16:24])
-        rr = []
-        if rrnum == 1:
-            rr = [rr1]
-        elif rrnum == 2:
-            rr = [rr1, rr2]
-        elif rrnum == 3:
-            rr = [rr1, rr2, rr3]
-        elif rrnum == 4:
-            rr = [rr1, rr2, rr3, rr4]
-        elif rrnum != 0:
-            raise Exception(f"rrnum not 1, 2, 3, or 4: {rrnum}")
-
-        records.append(HistoricalRecord(unix, heart, rr))
-
-    return records
+        size = os.fstat(f.fileno()).st_size
+        if size <= offset:
+            return
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        dp = offset
+        while dp < size:
+            if dp + 3 > size:
+                if partial:
+                    break
+                raise Exception(f"truncated packet header at offset {dp}")
+
+            # size the window from the length of the first frame in it
+            length = (mm[dp + 1] | mm[dp + 2] << 8) + 4
+            end = min(size, dp + batch_size * length)
+
+            # copying one window out of the map keeps numpy from pinning it
+            window = mm[dp:end]
+            offsets, lengths = frame_offsets(window, partial=True)
+            if len(offsets) == 0:
+                if partial:
+                    break
+                raise Exception(f"truncated packet at offset {dp}")
+
+            offsets = offsets[:batch_size]
+            lengths = lengths[:batch_size]
+            used = int(offsets[-1] + lengths[-1])
+            table = HistoricalTable.from_buffer(memoryview(window)[:used], verify=verify, trusted=trusted)
+
+            dp += used
+            yield dp, table
+    finally:
+        mm.close()
+
+def iter_tables(file_path, batch_size=65536, verify=True, trusted=False):
+    """
+    Yields HistoricalTable batches of at most batch_size packets.
+    Only the current batch is ever held in memory, never the whole file.
+    """
+    for _, table in iter_windows(file_path, batch_size, verify, trusted=trusted):
+        yield table
+
+def iter_records(file_path, batch_size=None):
+    """
+    Yields HistoricalRecord objects one by one, or lists of batch_size records.
+    """
+    batch = []
+    for table in iter_tables(file_path):
+        records = table.records()
+        if batch_size is None:
+            yield from records
+            continue
+
+        batch += records
+        start = 0
+        while len(batch) - start >= batch_size:
+            yield batch[start:start + batch_size]
+            start += batch_size
+        batch = batch[start:]
+
+    if batch_size is not None and batch:
+        yield batch
+
+def parse_table(file_path, trusted=False):
+    return HistoricalTable.concat(iter_tables(file_path, trusted=trusted))
+
+def parse_data(file_path):
+    return parse_table(file_path).records()
 
 if __name__ == "__main__":
     records = parse_data(sys.argv[1])
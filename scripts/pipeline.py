@@ -0,0 +1,165 @@
+import asyncio
+from packet import *
+
+# commands that only read from the strap, safe to send again when the response is lost
+IDEMPOTENT_COMMANDS = {
+    CommandNumber.LINK_VALID,
+    CommandNumber.GET_MAX_PROTOCOL_VERSION,
+    CommandNumber.REPORT_VERSION_INFO,
+    CommandNumber.GET_CLOCK,
+    CommandNumber.GET_BATTERY_LEVEL,
+    CommandNumber.GET_DATA_RANGE,
+    CommandNumber.GET_HELLO_HARVARD,
+    CommandNumber.GET_HELLO,
+    CommandNumber.GET_LED_DRIVE,
+    CommandNumber.GET_TIA_GAIN,
+    CommandNumber.GET_BIAS_OFFSET,
+    CommandNumber.GET_ALARM_TIME,
+    CommandNumber.GET_ADVERTISING_NAME_HARVARD,
+    CommandNumber.GET_ADVERTISING_NAME,
+    CommandNumber.GET_ALL_HAPTICS_PATTERN,
+    CommandNumber.GET_BODY_LOCATION_AND_STATUS,
+    CommandNumber.GET_EXTENDED_BATTERY_INFO,
+    CommandNumber.GET_FF_VALUE,
+    CommandNumber.GET_DEVICE_CONFIG_VALUE,
+    CommandNumber.GET_RESEARCH_PACKET,
+}
+
+class CommandPipeline:
+    """
+    Request/response layer for strap commands. Every command gets its own sequence number and
+    COMMAND_RESPONSE packets are matched to the waiting request by the seq the strap echoes and cmd, so up to max_in_flight
+    commands can be outstanding at once. A request that gets no response within timeout seconds
+    is sent again with a new seq, up to retries times, if it is in IDEMPOTENT_COMMANDS. Posted commands hold their seq until the response
+    arrives or for timeout seconds.
+    latency, a metrics.Histogram, gets the round trip time of every answered request.
+    """
+    def __init__(self, send, max_in_flight=4, timeout=5.0, retries=2, latency=None):
+        self.send = send
+        self.timeout = timeout
+        self.retries = retries
+        self.latency = latency
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.pending = {}
+        self.posted = {}
+        self.seq = 0
+
+        self.sent = 0
+        self.responses = 0
+        self.unmatched = 0
+        self.timeouts = 0
+
+    def __repr__(self):
+        return f"CommandPipeline(in_flight={len(self.pending)}, sent={self.sent}, responses={self.responses}, unmatched={self.unmatched}, timeouts={self.timeouts})"
+
+    def stats(self):
+        return {
+            "in_flight": len(self.pending),
+            "sent": self.sent,
+            "responses": self.responses,
+            "unmatched": self.unmatched,
+            "timeouts": self.timeouts,
+        }
+
+    def _next_seq(self):
+        # posted commands whose response never came give their seq back
+        now = asyncio.get_running_loop().time()
+        for key, deadline in list(self.posted.items()):
+            if deadline <= now:
+                del self.posted[key]
+
+        busy = {seq for seq, cmd in self.pending} | {seq for seq, cmd in self.posted}
+        for i in range(256):
+            self.seq = (self.seq + 1) & 0xFF
+            if self.seq not in busy:
+                return self.seq
+        raise Exception("no free command sequence numbers")
+
+    async def _send(self, cmd, data, table, value):
+        seq = self._next_seq()
+        key = (seq, cmd.value)
+        table[key] = value
+        try:
+            await self.send(WhoopPacket(PacketType.COMMAND, seq, cmd, data).framed_packet())
+        except Exception:
+            table.pop(key, None)
+            raise
+        self.sent += 1
+        return key
+
+    async def request(self, cmd, data=b"\x00", timeout=None, retries=None):
+        """
+        Sends a command and returns its COMMAND_RESPONSE packet. Only commands in IDEMPOTENT_COMMANDS
+        are retried unless retries is given.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if retries is None:
+            retries = self.retries if cmd in IDEMPOTENT_COMMANDS else 0
+
+        async with self.slots:
+            loop = asyncio.get_running_loop()
+            for attempt in range(retries + 1):
+                future = loop.create_future()
+                start = loop.time()
+                key = await self._send(cmd, data, self.pending, future)
+                try:
+                    response = await asyncio.wait_for(future, timeout)
+                    if self.latency is not None:
+                        self.latency.observe(loop.time() - start)
+                    return response
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                finally:
+                    if self.pending.get(key) is future:
+                        del self.pending[key]
+
+        raise Exception(f"no response to {cmd} after {retries + 1} attempts")
+
+    async def post(self, cmd, data=b"\x00"):
+        """
+        Sends a command without waiting, its response is dropped when it arrives.
+        """
+        await self._send(cmd, data, self.posted, asyncio.get_running_loop().time() + self.timeout)
+
+    async def gather(self, commands, timeout=None):
+        """
+        Sends (cmd, data) pairs pipelined and returns the responses in order, or the exception of a failed command.
+        """
+        return await asyncio.gather(*(self.request(cmd, data, timeout) for cmd, data in commands), return_exceptions=True)
+
+    def dispatch(self, packet):
+        """
+        Hands a response to its request, returns False if no request was waiting for it.
+        """
+        if packet.type != PacketType.COMMAND_RESPONSE:
+            return False
+
+        # the header seq is the strap's own counter, the seq of the request comes back in the first data byte
+        payload = packet.payload
+        if len(payload) == 0:
+            self.unmatched += 1
+            return False
+        key = (payload[0], packet.cmd.value if isinstance(packet.cmd, Enum) else packet.cmd)
+        future = self.pending.pop(key, None)
+        if future is not None:
+            self.responses += 1
+            if not future.done():
+                future.set_result(packet)
+            return True
+
+        if self.posted.pop(key, None) is not None:
+            self.responses += 1
+            return True
+
+        self.unmatched += 1
+        return False
+
+    def fail(self, error):
+        """
+        Fails every outstanding request, e.g. when the connection drops.
+        """
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+        self.posted.clear()
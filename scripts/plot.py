@@ -1,15 +1,16 @@
-import argparse
-import matplotlib.pyplot as plt
-from parser import *
+import os, argparse
+from store import *
 
-def plot_heart_rate(records):
-    timestamps = [record.timestamp() for record in records]
-    heart_rates = [record.heart_rate for record in records]
+def plot_heart_rate(unix, heart_rates):
+    # matplotlib takes longer to import than the rest, only load it when there is something to plot
+    import matplotlib.pyplot as plt
+
+    timestamps = to_datetime64(unix)
 
     plt.figure(figsize=(10, 5))
     plt.plot(timestamps, heart_rates, linestyle="-", color="b")
     plt.xticks(rotation=45)
-    plt.xlabel("Timestamp (EST)")
+    plt.xlabel(f"Timestamp ({get_timezone().zone})")
     plt.ylabel("Heart Rate (bpm)")
     plt.title("Heart Rate Over Time")
     plt.tight_layout()
@@ -17,26 +18,34 @@ def plot_heart_rate(records):
 
 def main():
     parser = argparse.ArgumentParser(description="process and plot heart rate data from Whoop packets.")
-    parser.add_argument("file", help="path to the binary file containing the Whoop historical data packets")
-    parser.add_argument("--start_date", help="start date-time in 'YYYY-MM-DD HH:MM:SS AM/PM' format")
-    parser.add_argument("--end_date", help="end date-time in 'YYYY-MM-DD HH:MM:SS AM/PM' format")
+    parser.add_argument("file", help="path to the binary file containing the Whoop historical data packets, or a history store made by store.py")
+    parser.add_argument("--start_date", help="start date-time in 'YYYY-MM-DD HH:MM:SS AM/PM' or ISO format, or unix seconds")
+    parser.add_argument("--end_date", help="end date-time in 'YYYY-MM-DD HH:MM:SS AM/PM' or ISO format, or unix seconds")
     parser.add_argument('--interval', type=int, default=5, help="Downsampling interval in seconds (default is 5)")
+    parser.add_argument("--fill", choices=FILL_POLICIES, help="how heart rate anomalies of a raw dump are filled (default is hold, see parser.fill_gaps)")
+    parser.add_argument("--max_gap", type=int, help="longest run of anomalies of a raw dump to fill, longer ones are left out of the plot")
+    parser.add_argument("--timezone", default="US/Eastern", help="timezone of the dates and the time axis (default is US/Eastern)")
     args = parser.parse_args()
 
-    records = parse_data(args.file)
+    set_timezone(args.timezone)
+
+    if os.path.isdir(args.file):
+        # a history store has the heart rate rolled up already, anomalies are left out
+        if args.fill not in (None, "nan") or args.max_gap is not None:
+            parser.error("--fill and --max_gap only apply to a raw dump, a history store leaves anomalies out")
+        buckets = HistoryStore(args.file).downsample(args.interval, args.start_date, args.end_date)
+        plot_heart_rate(buckets["unix"], buckets["mean"])
+        return
 
-    if args.start_date and args.end_date:
-        filtered_records = HistoricalRecord.filter_records_by_date(records, args.start_date, args.end_date)
-    else:
-        filtered_records = records
+    table = load_table(args.file, args.start_date, args.end_date)
 
-    # Interpolate anomalies (heart rate < 20)
-    filtered_records = HistoricalRecord.interpolate_anomalies(filtered_records)
+    # Interpolate anomalies (heart rate < 20), the ones left unfilled are nan
+    heart_rate, _ = table.interpolate_anomalies(args.fill or "hold", args.max_gap)
 
-    # Downsample the records based on the specified interval
-    downsampled_records = HistoricalRecord.downsample(filtered_records, interval=args.interval)
+    # Downsample the heart rate based on the specified interval
+    buckets = bucket_stats(table.unix, heart_rate, args.interval)
 
-    plot_heart_rate(downsampled_records)
+    plot_heart_rate(buckets["unix"], buckets["mean"])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,236 @@
+import os, sys, time, argparse, numpy as np
+from parser import *
+from sink import *
+
+# packet types carrying blocks of accelerometer and gyroscope samples
+RAW_TYPES = (PacketType.REALTIME_RAW_DATA, PacketType.REALTIME_IMU_DATA_STREAM, PacketType.HISTORICAL_IMU_DATA_STREAM)
+
+# frame layout of a raw data block, after the header like an EVENT: a zero byte, unix and subsec,
+# then the fields of RawDataStreamResult in the app: heart rate, the samples per axis and the sample blocks
+# accel x, accel y, accel z, gyro x, gyro y, gyro z, each samples <i2 long
+RAW_FIELDS = {
+    "type": ("u1", 4),
+    "seq": ("u1", 5),
+    "cmd": ("u1", 6),
+    "unix": ("<u4", 8),
+    "subsec": ("<u2", 12),
+    "heart_rate": ("u1", 14),
+    "samples": ("<u2", 16),
+}
+RAW_HEADER_SIZE = 18
+AXES = 6
+
+# subsec ticks per second
+SUBSEC = 32768
+
+# assumed full scale ranges over int16, +-8 g and +-2000 deg/s
+ACCEL_SCALE = 8.0 / 32768
+GYRO_SCALE = 2000.0 / 32768
+
+def raw_dtype(itemsize=RAW_HEADER_SIZE):
+    return np.dtype({
+        "names": list(RAW_FIELDS),
+        "formats": [f for f, _ in RAW_FIELDS.values()],
+        "offsets": [o for _, o in RAW_FIELDS.values()],
+        "itemsize": itemsize,
+    })
+
+def raw_packet(type, seq, unix, subsec, heart_rate, accel, gyro, cmd=0):
+    """
+    Builds a raw data frame from (samples, 3) accel and gyro arrays, like the strap sends them.
+    """
+    blocks = np.concatenate((np.asarray(accel, dtype="<i2").T, np.asarray(gyro, dtype="<i2").T))
+    data = struct.pack("<BLHBBH", 0, unix, subsec, heart_rate, 0, blocks.shape[1]) + blocks.tobytes()
+    return WhoopPacket(type, seq, cmd, data).framed_packet()
+
+class RawTable:
+    """
+    Decoded raw data blocks, one row per block, and their samples as contiguous arrays.
+    accel and gyro are (samples, 3) int16, time is the float64 unix time of every sample and block the row it came from.
+    """
+    def __init__(self, type, unix, subsec, heart_rate, samples, time, block, accel, gyro):
+        self.type = type
+        self.unix = unix
+        self.subsec = subsec
+        self.heart_rate = heart_rate
+        self.samples = samples
+        self.time = time
+        self.block = block
+        self.accel = accel
+        self.gyro = gyro
+
+    def __len__(self):
+        return len(self.time)
+
+    def __repr__(self):
+        return f"RawTable(blocks={len(self.unix)}, samples={len(self)})"
+
+    @staticmethod
+    def empty():
+        return RawTable(
+            np.zeros(0, dtype=np.uint8),
+            np.zeros(0, dtype=np.uint32),
+            np.zeros(0, dtype=np.uint16),
+            np.zeros(0, dtype=np.uint8),
+            np.zeros(0, dtype=np.uint16),
+            np.zeros(0, dtype=np.float64),
+            np.zeros(0, dtype=np.int64),
+            np.zeros((0, 3), dtype=np.int16),
+            np.zeros((0, 3), dtype=np.int16),
+        )
+
+    def scaled(self, accel_scale=ACCEL_SCALE, gyro_scale=GYRO_SCALE):
+        """
+        (accel in g, gyro in deg/s) as float32 arrays.
+        """
+        return self.accel.astype(np.float32) * np.float32(accel_scale), self.gyro.astype(np.float32) * np.float32(gyro_scale)
+
+    def of_type(self, type):
+        """
+        The blocks and samples of one packet type.
+        """
+        keep = self.type == (type.value if isinstance(type, PacketType) else type)
+        samples = keep[self.block]
+        block = np.cumsum(keep) - 1
+        return RawTable(self.type[keep], self.unix[keep], self.subsec[keep], self.heart_rate[keep], self.samples[keep],
+                        self.time[samples], block[self.block[samples]], self.accel[samples], self.gyro[samples])
+
+    @staticmethod
+    def from_buffer(data, verify=True, rate=None):
+        """
+        Decodes every raw data packet of a buffer of framed packets in one pass, other packets are skipped.
+        A sample's time is its block's time plus its index over rate Hz, rate is estimated from the block times
+        of each packet type when it is not given.
+        """
+        offsets, lengths = frame_offsets(data)
+        if len(offsets) == 0:
+            return RawTable.empty()
+
+        if verify:
+            verify_frames(data, offsets, lengths)
+
+        buf = np.frombuffer(data, dtype=np.uint8)
+        raw = np.isin(buf[offsets + 4], [t.value for t in RAW_TYPES])
+        offsets = offsets[raw]
+        lengths = lengths[raw]
+        if len(offsets) == 0:
+            return RawTable.empty()
+
+        short = np.flatnonzero(lengths < RAW_HEADER_SIZE + 4)
+        if len(short):
+            raise Exception(f"raw data packet too short at offset {offsets[short[0]]}")
+
+        rows = buf[offsets[:, None] + np.arange(RAW_HEADER_SIZE)].view(raw_dtype()).reshape(-1)
+        counts = rows["samples"].astype(np.int64)
+        bad = np.flatnonzero(RAW_HEADER_SIZE + AXES * 2 * counts + 4 > lengths)
+        if len(bad):
+            raise Exception(f"raw data packet shorter than its {counts[bad[0]]} samples at offset {offsets[bad[0]]}")
+
+        length = int(lengths[0])
+        n = int(counts[0])
+        if np.all(lengths == length) and np.all(counts == n) and np.all(np.diff(offsets) == length):
+            # one block size and nothing in between, view the sample blocks in place
+            frames = buf[int(offsets[0]):int(offsets[0]) + len(offsets) * length].reshape(-1, length)
+            values = frames[:, RAW_HEADER_SIZE:RAW_HEADER_SIZE + AXES * 2 * n].view("<i2").reshape(-1, AXES, n)
+            samples = values.transpose(0, 2, 1).reshape(-1, AXES)
+        else:
+            # gather every axis of every sample from its own frame
+            block = np.repeat(np.arange(len(offsets)), counts)
+            index = np.arange(len(block)) - np.repeat(np.cumsum(counts) - counts, counts)
+            start = offsets[block] + RAW_HEADER_SIZE + 2 * index
+            axis = 2 * counts[block]
+            pos = start[:, None] + axis[:, None] * np.arange(AXES)
+            samples = (buf[pos].astype(np.uint16) | buf[pos + 1].astype(np.uint16) << 8).view(np.int16)
+
+        block = np.repeat(np.arange(len(rows)), counts)
+        index = np.arange(len(block)) - np.repeat(np.cumsum(counts) - counts, counts)
+        base = rows["unix"].astype(np.float64) + rows["subsec"] / SUBSEC
+        step = np.zeros(len(rows))
+        for kind in np.unique(rows["type"]).tolist():
+            mask = rows["type"] == kind
+            step[mask] = 1.0 / rate if rate else _sample_step(base[mask], counts[mask])
+
+        return RawTable(
+            np.ascontiguousarray(rows["type"]),
+            np.ascontiguousarray(rows["unix"]),
+            np.ascontiguousarray(rows["subsec"]),
+            np.ascontiguousarray(rows["heart_rate"]),
+            np.ascontiguousarray(rows["samples"]),
+            base[block] + index * step[block],
+            block,
+            np.ascontiguousarray(samples[:, :3]),
+            np.ascontiguousarray(samples[:, 3:]),
+        )
+
+def _sample_step(times, counts):
+    # median seconds per sample between consecutive blocks, gaps are left out by the median
+    dt = np.diff(times) / np.maximum(counts[:-1], 1)
+    dt = dt[dt > 0]
+    return float(np.median(dt)) if len(dt) else 0.0
+
+def load_raw(file_path, verify=True, rate=None):
+    """
+    Decodes a raw data capture, or any dump of framed packets, into a RawTable.
+    """
+    with open(file_path, "rb") as f:
+        data = f.read()
+
+    # a capture cut off mid frame keeps its whole frames
+    offsets, lengths = frame_offsets(data, partial=True)
+    if len(offsets) == 0:
+        return RawTable.empty()
+    return RawTable.from_buffer(memoryview(data)[:int(offsets[-1] + lengths[-1])], verify, rate)
+
+class RawCapture:
+    """
+    Appends raw data frames as they arrive to a capture file, from a FileSink writer thread.
+    The frames are kept as sent, a few bytes of header and crc per block of samples, so the capture can be
+    checked and decoded again later with load_raw.
+    """
+    def __init__(self, path, batch_bytes=1024 * 1024):
+        self.path = path
+        self.sink = FileSink(path, "ab", batch_bytes=batch_bytes)
+        self.frames = 0
+        self.bytes = 0
+        self.start = time.monotonic()
+
+    def __repr__(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return f"RawCapture(path={self.path}, frames={self.frames}, bytes={self.bytes}, rate={self.bytes / elapsed / 1e3:.1f} kB/s, dropped={self.sink.dropped})"
+
+    def write(self, frame):
+        # frames the sink had no room for are counted in sink.dropped
+        if self.sink.write(frame):
+            self.frames += 1
+            self.bytes += len(frame)
+
+    def close(self):
+        self.sink.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="decode a raw accelerometer and gyroscope capture")
+    parser.add_argument("file", help="capture (raw.bin) or dump of framed packets")
+    parser.add_argument("--rate", type=float, default=None, help="samples per second (default is estimated from the block times)")
+    parser.add_argument("--no_verify", action="store_true", help="skip the sof and crc checks")
+    parser.add_argument("--out", help="write the decoded samples to an .npz file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    table = load_raw(args.file, verify=not args.no_verify, rate=args.rate)
+    elapsed = time.perf_counter() - start
+
+    size = os.path.getsize(args.file)
+    print(f"{table} from {size / 1e6:.1f} MB in {elapsed:.2f}s ({len(table) / max(elapsed, 1e-9) / 1e6:.1f}M samples/s)")
+    if len(table):
+        span = table.time[-1] - table.time[0]
+        print(f"{timestring(int(table.unix[0]))} to {timestring(int(table.unix[-1]))}, {len(table) / span if span > 0 else 0:.1f} samples/s")
+        accel, gyro = table.scaled()
+        print("accel mean " + " ".join(f"{v:.3f}" for v in accel.mean(axis=0).tolist()) + " g, gyro mean " + " ".join(f"{v:.2f}" for v in gyro.mean(axis=0).tolist()) + " deg/s")
+
+    if args.out:
+        accel, gyro = table.scaled()
+        np.savez(args.out, type=table.type[table.block], time=table.time, accel=accel, gyro=gyro, heart_rate=table.heart_rate[table.block])
+        print(f"wrote {args.out}")
+
+if __name__ == "__main__":
+    main()
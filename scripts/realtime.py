@@ -0,0 +1,82 @@
+import bisect, numpy as np
+from packet import *
+
+# one REALTIME_DATA sample, the same layout as REALTIME_STRUCT so a sample is packed straight into the ring
+REALTIME_DTYPE = np.dtype([
+    ("unix", "<u4"),
+    ("subsec", "<u2"),
+    ("heart_rate", "u1"),
+    ("rr_count", "u1"),
+    ("rr", "<u2", (3,)),
+])
+assert REALTIME_DTYPE.itemsize == REALTIME_STRUCT.size
+
+class RealtimeBuffer:
+    """
+    The last capacity REALTIME_DATA samples in a fixed size ring, nothing is allocated per sample.
+    Every sample is written twice, at i and i + capacity, so the last n samples are always one contiguous
+    slice and last() and window() return views of the ring instead of copies.
+    Views stay valid only until capacity more samples are pushed, copy them to keep them longer.
+    Samples are assumed to arrive in time order, like the strap sends them.
+    """
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.buffer = bytearray(2 * capacity * REALTIME_STRUCT.size)
+        self.rows = np.frombuffer(self.buffer, dtype=REALTIME_DTYPE)
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __repr__(self):
+        return f"RealtimeBuffer(samples={len(self)}, capacity={self.capacity}, pushed={self.count})"
+
+    def push(self, packet):
+        """
+        Decodes a REALTIME_DATA packet into the ring, returns (unix, subsec, heart rate, rr count, rr1, rr2, rr3).
+        """
+        sample = packet.realtime()
+        self.push_sample(sample)
+        return sample
+
+    def push_sample(self, sample):
+        size = REALTIME_STRUCT.size
+        REALTIME_STRUCT.pack_into(self.buffer, self.head * size, *sample)
+        REALTIME_STRUCT.pack_into(self.buffer, (self.head + self.capacity) * size, *sample)
+        self.head += 1
+        if self.head == self.capacity:
+            self.head = 0
+        self.count += 1
+
+    def last(self, n=None):
+        """
+        A view of the last n samples (all of them by default), oldest first.
+        """
+        n = len(self) if n is None else min(n, len(self))
+        end = self.head + self.capacity
+        return self.rows[end - n:end]
+
+    def window(self, seconds, now=None):
+        """
+        A view of the samples of the last seconds seconds before now, which defaults to the newest sample's time.
+        """
+        rows = self.last()
+        if len(rows) == 0:
+            return rows
+        unix = rows["unix"]
+        now = int(unix[-1]) if now is None else now
+        lo = bisect.bisect_right(unix, now - seconds)
+        hi = bisect.bisect_right(unix, now)
+        return rows[lo:hi]
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+def beats(rows):
+    """
+    (time, rr) arrays of the rr intervals of ring rows, a beat takes the unix time of its sample.
+    """
+    mask = np.arange(3) < rows["rr_count"][:, None]
+    return np.repeat(rows["unix"].astype(np.int64), np.minimum(rows["rr_count"], 3)), rows["rr"][mask].astype(np.int64)
@@ -0,0 +1,340 @@
+import os, time, random, argparse, asyncio, numpy as np
+from collector import *
+from synth import *
+
+VERSION_INFO = bytes.fromhex("01290000001000000006000000000000001100000002000000020000000000000003000000050000000000000000000000030000000c0000000100000000000000080201000000")
+HISTORY_START_INFO = bytes.fromhex("06000000100000000200000029000000100000000600000000000000080200")
+
+class StrapSimulator:
+    """
+    Simulated strap behind a FakeTransport, following the protocol as whoop.py uses it:
+    command responses, HISTORY_START/END/COMPLETE chunks acknowledged with trims,
+    realtime heart rate with rr intervals, raw accelerometer and gyroscope blocks, events and console logs.
+
+    rate limits notifications per second (0 sends as fast as the handlers take them), frames are split into
+    notifications of at most mtu bytes (0 sends whole frames, fragment picks random sizes up to mtu)
+    and corrupt is the chance of one byte of a notification being flipped.
+    Handler latency of every notification and the time from HISTORY_END to its acknowledgement are recorded.
+    """
+    def __init__(self, days=1.0, chunk=1000, start=1735362000, seed=0, rate=0, mtu=0, fragment=False, corrupt=0.0,
+                 realtime=1.0, event_interval=0, log_interval=0, raw=10.0, raw_samples=100):
+        self.frames = frame_table(synth_table(start, int(days * DAY), seed=seed))
+        self.frame_length = 95
+        self.chunk = chunk
+        self.rate = rate
+        self.mtu = mtu
+        self.fragment = fragment
+        self.corrupt = corrupt
+        self.realtime = realtime
+        self.event_interval = event_interval
+        self.log_interval = log_interval
+        self.raw = raw
+        self.raw_samples = raw_samples
+        self.random = random.Random(seed)
+
+        self.trim = 0
+        self.battery = 87.5
+        self.acked = asyncio.Event()
+        self.tasks = {}
+        self.locks = {}
+        self.seq = 0
+        self.next_time = 0.0
+
+        self.notifications = 0
+        self.bytes = 0
+        self.corrupted = 0
+        self.commands = 0
+        self.latencies = []
+        self.ack_latencies = []
+        self.end_time = None
+
+    def __repr__(self):
+        return f"StrapSimulator(trim={self.trim}, notifications={self.notifications}, bytes={self.bytes}, corrupted={self.corrupted})"
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        acks = np.array(self.ack_latencies) * 1000
+        out = {
+            "notifications": self.notifications,
+            "bytes": self.bytes,
+            "corrupted": self.corrupted,
+            "commands": self.commands,
+            "chunks": len(self.ack_latencies),
+        }
+        for name, values in (("latency", latencies), ("ack_latency", acks)):
+            if len(values):
+                out.update({f"{name}_p50": float(np.percentile(values, 50)), f"{name}_p99": float(np.percentile(values, 99)), f"{name}_max": float(values.max())})
+        return out
+
+    def _packet(self, type, cmd, data):
+        self.seq = (self.seq + 1) & 0xFF
+        return WhoopPacket(type, self.seq, cmd, data).framed_packet()
+
+    def _stamp(self):
+        now = time.time()
+        return struct.pack("<LH", int(now), int((now % 1) * 32768))
+
+    async def _pace(self):
+        if not self.rate:
+            # let the other strap tasks in now and then
+            if self.notifications % 64 == 0:
+                await asyncio.sleep(0)
+            return
+
+        now = asyncio.get_running_loop().time()
+        self.next_time = max(self.next_time, now)
+        if self.next_time > now:
+            await asyncio.sleep(self.next_time - now)
+        self.next_time += 1.0 / self.rate
+
+    def _split(self, frame):
+        if not self.mtu:
+            return [frame]
+
+        out = []
+        pos = 0
+        while pos < len(frame):
+            size = self.random.randint(1, self.mtu) if self.fragment else self.mtu
+            out.append(frame[pos:pos + size])
+            pos += size
+        return out
+
+    async def send(self, transport, uuid, frame):
+        """
+        Sends a frame as one or more notifications, frames on one characteristic never interleave.
+        """
+        lock = self.locks.setdefault(uuid, asyncio.Lock())
+        async with lock:
+            for data in self._split(frame):
+                if not transport.is_connected:
+                    return
+
+                if self.corrupt and self.random.random() < self.corrupt:
+                    data = bytearray(data)
+                    data[self.random.randrange(len(data))] ^= 0xFF
+                    self.corrupted += 1
+
+                await self._pace()
+                start = time.perf_counter()
+                await transport.notify(uuid, data)
+                self.latencies.append(time.perf_counter() - start)
+                self.notifications += 1
+                self.bytes += len(data)
+
+    def _start(self, name, coro):
+        task = self.tasks.get(name)
+        if task is not None and not task.done():
+            task.cancel()
+        self.tasks[name] = asyncio.ensure_future(coro)
+
+    def _stop(self, name):
+        task = self.tasks.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    async def on_connect(self, transport):
+        self.acked = asyncio.Event()
+        if self.event_interval:
+            self._start("events", self.send_events(transport))
+        if self.log_interval:
+            self._start("logs", self.send_logs(transport))
+
+    async def on_disconnect(self, transport):
+        for name in list(self.tasks):
+            self._stop(name)
+
+    def respond(self, packet):
+        """
+        The COMMAND_RESPONSE data for a command, the seq of the command followed by the status byte and the result.
+        """
+        cmd = packet.cmd
+        if cmd == CommandNumber.GET_CLOCK.value:
+            result = self._stamp()
+        elif cmd == CommandNumber.GET_BATTERY_LEVEL.value:
+            result = struct.pack("<H", int(self.battery * 10))
+        elif cmd == CommandNumber.REPORT_VERSION_INFO.value:
+            result = VERSION_INFO
+        else:
+            result = b"\x00"
+        return bytes([packet.seq, 0x01]) + result
+
+    async def on_write(self, transport, uuid, data):
+        packet = WhoopPacket.from_data(data)
+        if packet.type != PacketType.COMMAND:
+            return
+        self.commands += 1
+
+        # the header carries the strap's own seq, like every packet it sends
+        response = self._packet(PacketType.COMMAND_RESPONSE, packet.cmd, self.respond(packet))
+        await self.send(transport, WHOOP_CHAR_CMD_FROM_STRAP, response)
+
+        cmd = packet.cmd
+        if cmd == CommandNumber.SEND_HISTORICAL_DATA.value:
+            self._start("history", self.send_history(transport))
+        elif cmd == CommandNumber.HISTORICAL_DATA_RESULT.value:
+            self.trim = struct.unpack("<L", packet.data[1:5])[0]
+            if self.end_time is not None:
+                self.ack_latencies.append(time.perf_counter() - self.end_time)
+                self.end_time = None
+            self.acked.set()
+        elif cmd == CommandNumber.TOGGLE_REALTIME_HR.value:
+            on = packet.data[:1] == b"\x01"
+            event = EventNumber.BLE_REALTIME_HR_ON if on else EventNumber.BLE_REALTIME_HR_OFF
+            await self.send(transport, WHOOP_CHAR_EVENTS_FROM_STRAP, self._packet(PacketType.EVENT, event, b"\x00" + self._stamp()))
+            if on:
+                self._start("realtime", self.send_realtime(transport))
+            else:
+                self._stop("realtime")
+        elif cmd == CommandNumber.START_RAW_DATA.value:
+            self._start("raw", self.send_raw(transport))
+        elif cmd == CommandNumber.STOP_RAW_DATA.value:
+            self._stop("raw")
+        elif cmd == CommandNumber.REBOOT_STRAP.value:
+            asyncio.ensure_future(transport.disconnect())
+
+    async def send_history(self, transport):
+        size = self.chunk * self.frame_length
+        while transport.is_connected and self.trim * size < len(self.frames):
+            chunk = self.frames[self.trim * size:(self.trim + 1) * size]
+            unix = int.from_bytes(chunk[11:15], "little")
+            meta = self._packet(PacketType.METADATA, MetadataType.HISTORY_START, struct.pack("<LH", unix, 0) + HISTORY_START_INFO)
+            await self.send(transport, WHOOP_CHAR_DATA_FROM_STRAP, meta)
+            for offset in range(0, len(chunk), self.frame_length):
+                await self.send(transport, WHOOP_CHAR_DATA_FROM_STRAP, chunk[offset:offset + self.frame_length])
+
+            # the strap moves on once the chunk is acknowledged
+            self.acked.clear()
+            end = struct.pack("<LHLL", unix, 0, len(chunk) // self.frame_length, self.trim + 1) + bytes(9)
+            self.end_time = time.perf_counter()
+            await self.send(transport, WHOOP_CHAR_DATA_FROM_STRAP, self._packet(PacketType.METADATA, MetadataType.HISTORY_END, end))
+            await self.acked.wait()
+
+        await self.send(transport, WHOOP_CHAR_DATA_FROM_STRAP, self._packet(PacketType.METADATA, MetadataType.HISTORY_COMPLETE, self._stamp() + bytes(3)))
+
+    async def send_realtime(self, transport):
+        heart = 60
+        while transport.is_connected:
+            now = time.time()
+            heart = max(40, min(180, heart + self.random.randint(-2, 2)))
+            rr = [int(60000 / heart) + self.random.randint(-30, 30) for i in range(self.random.randint(0, 3))]
+            data = struct.pack("<LHBB", int(now), int((now % 1) * 32768), heart, len(rr))
+            data += struct.pack("<HHH", *(rr + [0] * (3 - len(rr))))
+
+            # the first byte of the unix time goes in the cmd field
+            await self.send(transport, WHOOP_CHAR_DATA_FROM_STRAP, self._packet(PacketType.REALTIME_DATA, data[0], data[1:] + bytes(4)))
+            await asyncio.sleep(1.0 / self.realtime)
+
+    async def send_raw(self, transport):
+        # raw blocks of raw_samples samples per axis, a slow wobble plus noise around 1 g on z
+        rng = np.random.default_rng(self.random.randrange(1 << 32))
+        n = self.raw_samples
+        phase = 0.0
+        while transport.is_connected:
+            now = time.time()
+            t = phase + np.arange(n) / (n * self.raw)
+            phase = t[-1] + 1.0 / (n * self.raw)
+            accel = np.stack((np.sin(t) * 400, np.cos(t) * 400, np.full(n, 4096.0)), axis=1) + rng.normal(0, 20, (n, 3))
+            gyro = rng.normal(0, 50, (n, 3))
+            self.seq = (self.seq + 1) & 0xFF
+            frame = raw_packet(PacketType.REALTIME_RAW_DATA, self.seq, int(now), int((now % 1) * 32768), 60, accel.astype(np.int16), gyro.astype(np.int16))
+            await self.send(transport, WHOOP_CHAR_DATA_FROM_STRAP, frame)
+            await asyncio.sleep(1.0 / self.raw)
+
+    async def send_events(self, transport):
+        events = [EventNumber.WRIST_ON, EventNumber.BATTERY_LEVEL, EventNumber.WRIST_OFF, EventNumber.DOUBLE_TAP]
+        i = 0
+        while transport.is_connected:
+            await asyncio.sleep(self.event_interval)
+            event = events[i % len(events)]
+            await self.send(transport, WHOOP_CHAR_EVENTS_FROM_STRAP, self._packet(PacketType.EVENT, event, b"\x00" + self._stamp() + bytes(2)))
+            i += 1
+
+    async def send_logs(self, transport):
+        lines = ["Sensors: Realtime HR enabled", "SIGPROC-WEAR-DETECT V3: moving from state 1 to state 3", "BLE: connection interval 15ms"]
+        i = 0
+        while transport.is_connected:
+            await asyncio.sleep(self.log_interval)
+            text = f"{i}, {int(time.time())}: {lines[i % len(lines)]}\n".encode()
+            data = b"\x00" + self._stamp() + b"\x34\x00\x01" + text + b"\x00"
+            await self.send(transport, WHOOP_CHAR_DATA_FROM_STRAP, self._packet(PacketType.CONSOLE_LOGS, 2, data))
+            i += 1
+
+async def main():
+    parser = argparse.ArgumentParser(description="run StrapSessions against simulated straps and report throughput and latency")
+    parser.add_argument("--straps", type=int, default=1, help="number of simulated straps (default is 1)")
+    parser.add_argument("--days", type=float, default=1.0, help="days of history per strap (default is 1)")
+    parser.add_argument("--chunk", type=int, default=1000, help="records per history chunk (default is 1000)")
+    parser.add_argument("--rate", type=float, default=0, help="notifications per second per strap, 0 is unlimited")
+    parser.add_argument("--mtu", type=int, default=0, help="largest notification in bytes, 0 sends whole frames")
+    parser.add_argument("--fragment", action="store_true", help="split frames at random sizes up to mtu")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="chance of a notification being corrupted")
+    parser.add_argument("--realtime", type=float, default=0, help="realtime heart rate packets per second, 0 is off")
+    parser.add_argument("--raw", type=float, default=0, help="raw data blocks per second, captured to raw.bin, 0 is off")
+    parser.add_argument("--events", type=float, default=0, help="seconds between events, 0 is off")
+    parser.add_argument("--logs", type=float, default=0, help="seconds between console logs, 0 is off")
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for the strap before reconnecting (default is 10)")
+    parser.add_argument("--out", default="simulated", help="directory with one sub directory per strap (default is simulated)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default is 0)")
+    args = parser.parse_args()
+
+    sessions = []
+    for i in range(args.straps):
+        strap = StrapSimulator(args.days, args.chunk, seed=args.seed + i, rate=args.rate, mtu=args.mtu, fragment=args.fragment,
+                               corrupt=args.corrupt, realtime=args.realtime or 1.0, event_interval=args.events, log_interval=args.logs,
+                               raw=args.raw or 10.0)
+        session = StrapSession(FakeTransport(strap), os.path.join(args.out, f"sim{i}"), f"sim{i}", timeout=args.timeout, backoff=Backoff(0.1, 1.0))
+        sessions.append(session)
+
+        if args.realtime:
+            async def realtime(session=session):
+                await session.connected.wait()
+                await session.commands.request(CommandNumber.TOGGLE_REALTIME_HR, b"\x01")
+
+            asyncio.create_task(realtime())
+
+        if args.raw:
+            async def raw(session=session):
+                await session.connected.wait()
+                session.start_capture()
+                await session.commands.request(CommandNumber.START_RAW_DATA, b"\x01")
+
+            asyncio.create_task(raw())
+
+    collector = Collector(sessions)
+
+    async def stop_when_synced():
+        while not all(session.syncs for session in sessions):
+            await asyncio.sleep(0.1)
+        collector.stop()
+
+    asyncio.create_task(stop_when_synced())
+
+    start = time.perf_counter()
+    await collector.run()
+    elapsed = time.perf_counter() - start
+
+    notifications = 0
+    total = 0
+    for session in sessions:
+        strap = session.transport.peer
+        stats = strap.stats()
+        notifications += stats["notifications"]
+        total += stats["bytes"]
+        print(f"{session.label}: {stats}")
+        print(f"{session.label}: data {session.data_framer}")
+        if session.capture is not None:
+            print(f"{session.label}: {session.capture}")
+
+    latencies = np.concatenate([session.transport.peer.latencies for session in sessions]) * 1000
+    acks = np.concatenate([session.transport.peer.ack_latencies for session in sessions]) * 1000
+    print(f"{notifications} notifications, {total / 1e6:.1f} MB in {elapsed:.2f}s: {notifications / elapsed:.0f} notifications/s, {total / 1e6 / elapsed:.2f} MB/s")
+    if len(latencies):
+        print(f"handler latency ms: p50 {np.percentile(latencies, 50):.3f} p99 {np.percentile(latencies, 99):.3f} max {latencies.max():.3f}")
+    if len(acks):
+        print(f"chunk ack latency ms: p50 {np.percentile(acks, 50):.3f} p99 {np.percentile(acks, 99):.3f} max {acks.max():.3f}")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("program terminated")
@@ -0,0 +1,154 @@
+import os, time, queue, threading
+
+class FileSink:
+    """
+    Appends to a file from a writer thread so the event loop never waits on the disk.
+    Writes are queued and written in batches, once batch_bytes are pending or every flush_interval seconds.
+    fsync is one of "never", "flush" (after every batch) or "close" (once, when the sink is closed).
+    write never waits, when the queue is full the data is dropped and counted instead.
+    on_close is called from the writer thread once everything is written, e.g. to save an index of the file.
+    """
+    def __init__(self, path, mode="ab", max_queue=4096, batch_bytes=64 * 1024, flush_interval=1.0, fsync="close", on_close=None):
+        if fsync not in ("never", "flush", "close"):
+            raise Exception(f"invalid fsync policy: {fsync}")
+
+        self.path = path
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.on_close = on_close
+        self.file = open(path, mode)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.error = None
+        self.closed = False
+        # set by close, the writer finishes once the queue is empty even if the end marker did not fit in it
+        self.closing = threading.Event()
+
+        self.bytes_queued = 0
+        self.bytes_written = 0
+        self.batches = 0
+        self.fsyncs = 0
+        self.max_depth = 0
+        self.dropped = 0
+        self.bytes_dropped = 0
+
+        self.thread = threading.Thread(target=self._run, name=f"sink {path}", daemon=True)
+        self.thread.start()
+
+    def __repr__(self):
+        return f"FileSink(path={self.path}, depth={self.queue.qsize()}, written={self.bytes_written}, dropped={self.dropped})"
+
+    def stats(self):
+        return {
+            "depth": self.queue.qsize(),
+            "max_depth": self.max_depth,
+            "bytes_queued": self.bytes_queued,
+            "bytes_written": self.bytes_written,
+            "batches": self.batches,
+            "fsyncs": self.fsyncs,
+            "dropped": self.dropped,
+            "bytes_dropped": self.bytes_dropped,
+        }
+
+    def write(self, data):
+        """
+        Queues data, returns False if it was dropped because the queue is full.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.closed:
+            raise Exception(f"sink closed: {self.path}")
+
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+            self.bytes_dropped += len(data)
+            return False
+
+        self.bytes_queued += len(data)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+
+    def close(self, wait=True):
+        """
+        Writes everything still queued, then closes the file. Without wait this is left to the writer thread.
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+        self.closing.set()
+        try:
+            # wakes a writer waiting on an empty queue, a full queue is drained first anyway
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        if not wait:
+            return
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _flush(self, pending):
+        self.file.write(b"".join(pending))
+        self.file.flush()
+        self.bytes_written += sum(len(data) for data in pending)
+        self.batches += 1
+
+        if self.fsync == "flush":
+            os.fsync(self.file.fileno())
+            self.fsyncs += 1
+
+    def _run(self):
+        pending = []
+        size = 0
+        first = 0.0
+        done = False
+
+        try:
+            while not done:
+                if not pending and self.closing.is_set() and self.queue.empty():
+                    break
+
+                # wait for data, or until the oldest pending write is due
+                timeout = max(0.0, first + self.flush_interval - time.monotonic()) if pending else None
+                try:
+                    data = self.queue.get(timeout=timeout)
+                    while True:
+                        if data is None:
+                            done = True
+                            break
+
+                        if not pending:
+                            first = time.monotonic()
+                        pending.append(data)
+                        size += len(data)
+                        if size >= self.batch_bytes:
+                            break
+
+                        # take whatever else is already queued
+                        data = self.queue.get_nowait()
+                except queue.Empty:
+                    done = self.closing.is_set() and self.queue.empty()
+
+                if pending and (done or size >= self.batch_bytes or time.monotonic() - first >= self.flush_interval):
+                    self._flush(pending)
+                    pending = []
+                    size = 0
+
+            if self.fsync == "close":
+                os.fsync(self.file.fileno())
+                self.fsyncs += 1
+            if self.on_close is not None:
+                self.on_close()
+        except Exception as e:
+            self.error = e
+            # keep draining until close so writes keep being accepted or dropped instead of piling up
+            while not done:
+                try:
+                    done = self.queue.get(timeout=self.flush_interval) is None
+                except queue.Empty:
+                    done = self.closing.is_set()
+        finally:
+            self.file.close()
@@ -0,0 +1,128 @@
+import functools, numpy as np
+
+# frequency bands in Hz
+BANDS = {
+    "vlf": (0.0033, 0.04),
+    "lf": (0.04, 0.15),
+    "hf": (0.15, 0.4),
+}
+
+def beat_times(times, rrs):
+    """
+    Places beats on a continuous time axis (seconds) from the rr intervals (ms) and the unix time of their records.
+    Every beat stays in the second of its record, like hrvstream.table_beats and tumbling count it,
+    the beats of one record are spread evenly over its second so the axis keeps increasing.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    rrs = np.asarray(rrs, dtype=np.float64)
+    if len(times) == 0:
+        return times, rrs
+
+    # position of every beat within the beats of its record
+    starts = np.ones(len(times), dtype=bool)
+    starts[1:] = times[1:] != times[:-1]
+    first = np.flatnonzero(starts)
+    counts = np.diff(np.append(first, len(times)))
+    index = np.arange(len(times)) - np.repeat(first, counts)
+    return times + index / np.repeat(counts, counts), rrs
+
+def resample(t, rr, fs=4.0, start=None, end=None, max_gap=3):
+    """
+    Interpolates the rr series onto a uniform fs Hz grid from start to end (seconds).
+    Returns the grid values and a mask of the samples that are no more than max_gap seconds from a beat on both sides.
+    """
+    start = t[0] if start is None else start
+    end = t[-1] if end is None else end
+    grid = start + np.arange(int(round((end - start) * fs))) / fs
+    if len(t) < 2:
+        return np.full(len(grid), np.nan), np.zeros(len(grid), dtype=bool)
+
+    values = np.interp(grid, t, rr)
+    i = np.clip(np.searchsorted(t, grid), 1, len(t) - 1)
+    valid = (grid >= t[0]) & (grid <= t[-1]) & (t[i] - t[i - 1] <= max_gap)
+    return values, valid
+
+@functools.lru_cache(maxsize=16)
+def _welch_plan(fs, nperseg, noverlap):
+    # hann window (periodic, like scipy), density scaling and frequencies, reused between calls
+    window = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(nperseg) / nperseg)
+    scale = np.full(nperseg // 2 + 1, 2.0 / (fs * np.sum(window ** 2)))
+    scale[0] /= 2
+    if nperseg % 2 == 0:
+        scale[-1] /= 2
+    freqs = np.fft.rfftfreq(nperseg, 1.0 / fs)
+    return window, scale, freqs
+
+@functools.lru_cache(maxsize=16)
+def _band_weights(freqs, bands):
+    # trapezoid weights over the frequencies inside each band, so a band power is one dot product
+    freqs = np.array(freqs)
+    weights = np.zeros((len(bands), len(freqs)))
+    for i, (lo, hi) in enumerate(bands):
+        idx = np.flatnonzero((freqs >= lo) & (freqs < hi))
+        if len(idx) > 1:
+            step = np.diff(freqs[idx])
+            weights[i, idx[:-1]] += step / 2
+            weights[i, idx[1:]] += step / 2
+    return weights
+
+def welch_batch(x, fs=4.0, nperseg=256, noverlap=None):
+    """
+    Welch PSD of every row of x at once, like scipy.signal.welch with a hann window, constant detrend and density scaling.
+    Returns the frequencies and a (rows, frequencies) PSD array.
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    nperseg = min(nperseg, x.shape[1])
+    noverlap = nperseg // 2 if noverlap is None else noverlap
+    window, scale, freqs = _welch_plan(float(fs), nperseg, noverlap)
+
+    step = nperseg - noverlap
+    count = (x.shape[1] - noverlap) // step
+    segments = np.lib.stride_tricks.sliding_window_view(x, nperseg, axis=1)[:, ::step][:, :count]
+    segments = segments - segments.mean(axis=2, keepdims=True)
+
+    spectrum = np.fft.rfft(segments * window, axis=2)
+    psd = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=1) * scale
+    return freqs, psd
+
+def band_powers(freqs, psd, bands=BANDS):
+    """
+    Integrated power of every band for every PSD row, as a dict of arrays.
+    """
+    weights = _band_weights(tuple(freqs.tolist()), tuple(bands.values()))
+    powers = psd @ weights.T
+    return {name: powers[..., i] for i, name in enumerate(bands)}
+
+def frequency_windows(times, rrs, interval=300, fs=4.0, nperseg=256, max_gap=3, min_coverage=0.9, batch=512):
+    """
+    LF, HF and LF/HF (power in ms^2) of every interval second window aligned to the epoch, from (time, rr) beats
+    such as hrvstream.table_beats returns. The rr series is resampled once and every window's PSD is computed in one pass.
+    Windows whose grid is less than min_coverage covered by beats get nan.
+    The PSDs are computed batch windows at a time to bound the memory of the segment arrays.
+    """
+    t, rr = beat_times(times, rrs)
+    if len(t) < 2:
+        return {"start": np.zeros(0, dtype=np.int64), "coverage": np.zeros(0), "vlf": np.zeros(0), "lf": np.zeros(0), "hf": np.zeros(0), "lf_hf": np.zeros(0)}
+
+    first = int(t[0]) - int(t[0]) % interval
+    last = int(t[-1]) - int(t[-1]) % interval + interval
+    values, valid = resample(t, rr, fs, first, last, max_gap)
+
+    # one row per window
+    samples = int(interval * fs)
+    rows = len(values) // samples
+    values = values[:rows * samples].reshape(rows, samples)
+    coverage = valid[:rows * samples].reshape(rows, samples).mean(axis=1)
+
+    powers = {name: np.zeros(rows) for name in BANDS}
+    for lo in range(0, rows, batch):
+        freqs, psd = welch_batch(values[lo:lo + batch], fs, nperseg)
+        for name, power in band_powers(freqs, psd).items():
+            powers[name][lo:lo + batch] = power
+
+    out = {"start": first + np.arange(rows, dtype=np.int64) * interval, "coverage": coverage}
+    for name, power in powers.items():
+        out[name] = np.where(coverage >= min_coverage, power, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        out["lf_hf"] = np.where(out["hf"] > 0, out["lf"] / out["hf"], np.nan)
+    return out
@@ -0,0 +1,342 @@
+import os, sys, json, zlib, numpy as np
+from parser import *
+
+# on disk layout of a history store directory:
+#   meta.json       source dump, bytes of it already converted, record count, pyramid rows and open bucket
+#   <column>.bin    one raw little endian file per HistoricalTable column
+#   index.bin       min/max unix of every block of BLOCK_SIZE records
+#   rollup_<n>.bin  heart rate ROLLUP_DTYPE rows of n second buckets, for every n in PYRAMID
+STORE_VERSION = 1
+BLOCK_SIZE = 4096
+HEAD_SIZE = 4096
+PYRAMID = (5, 60, 900, 3600)
+
+COLUMNS = {
+    "unix": (np.dtype("<u4"), ()),
+    "subsec": (np.dtype("<u2"), ()),
+    "heart_rate": (np.dtype("u1"), ()),
+    "rr_count": (np.dtype("u1"), ()),
+    "rr": (np.dtype("<u2"), (4,)),
+}
+
+def head_checksum(file_path, length):
+    """
+    crc32 of the first bytes of a dump, used to notice the dump was rewritten from scratch.
+    """
+    with open(file_path, "rb") as f:
+        return zlib.crc32(f.read(min(length, HEAD_SIZE))) & 0xFFFFFFFF
+
+class HistoryStore:
+    """
+    Memory mapped columnar copy of a historical dump with a sparse time index.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+
+        if self.meta["version"] != STORE_VERSION:
+            raise Exception(f"unsupported store version: {self.meta['version']}")
+
+        self.count = self.meta["count"]
+        self.block_size = self.meta["block_size"]
+        self.columns = {name: self._map(name) for name in COLUMNS}
+
+        index = self._map_file("index.bin", np.dtype("<u4"), (2,), -(-self.count // self.block_size))
+        self.block_min = index[:, 0]
+        self.block_max = index[:, 1]
+
+        self.levels = {int(interval): self._map_file(f"rollup_{interval}.bin", ROLLUP_DTYPE, (), rows) for interval, rows in self.meta.get("pyramid", {}).items()}
+
+    def _map_file(self, name, dtype, shape, count):
+        if count == 0:
+            return np.zeros((0,) + shape, dtype=dtype)
+
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=(count,) + shape)
+
+    def _map(self, name):
+        dtype, shape = COLUMNS[name]
+        return self._map_file(name + ".bin", dtype, shape, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return f"HistoryStore(path={self.path}, records={self.count})"
+
+    def _slice(self, lo, hi):
+        return {name: column[lo:hi] for name, column in self.columns.items()}
+
+    def blocks(self, start=None, end=None):
+        """
+        Returns the indices of the blocks that may hold records between start and end (unix, inclusive).
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        mask = np.ones(len(self.block_min), dtype=bool)
+        if start is not None:
+            mask &= self.block_max >= start
+        if end is not None:
+            mask &= self.block_min <= end
+
+        return np.flatnonzero(mask)
+
+    def table(self, start=None, end=None):
+        """
+        Returns a HistoricalTable of the records between start and end (inclusive), see to_epoch for the accepted bounds.
+        Only the blocks the sparse index selects are read.
+        """
+        start, end = to_epoch(start), to_epoch(end)
+        if start is None and end is None:
+            return HistoricalTable(**{name: np.array(column) for name, column in self.columns.items()})
+
+        blocks = self.blocks(start, end)
+        if len(blocks) == 0:
+            return HistoricalTable.empty()
+
+        # read runs of consecutive blocks in one slice each
+        runs = np.split(blocks, np.flatnonzero(np.diff(blocks) != 1) + 1)
+        tables = []
+        for run in runs:
+            lo = int(run[0]) * self.block_size
+            hi = min(self.count, (int(run[-1]) + 1) * self.block_size)
+            columns = self._slice(lo, hi)
+
+            mask = np.ones(hi - lo, dtype=bool)
+            if start is not None:
+                mask &= columns["unix"] >= start
+            if end is not None:
+                mask &= columns["unix"] <= end
+
+            tables.append(HistoricalTable(**{name: column[mask] for name, column in columns.items()}))
+
+        return HistoricalTable.concat(tables)
+
+    def downsample(self, interval=5, start=None, end=None):
+        """
+        Heart rate count/mean/min/max per interval second bucket between start and end, anomalies left out.
+        The whole buckets are read from the coarsest pyramid level interval is a multiple of, the buckets
+        start and end cut through from the raw records, so the result is the same as downsampling the table.
+        """
+        levels = [level for level in self.levels if interval % level == 0]
+        if not levels:
+            return self.table(start, end).downsample(interval)
+
+        level = max(levels)
+        start, end = to_epoch(start), to_epoch(end)
+
+        # [first, last) are the whole buckets between the bounds
+        first = None if start is None else -(-int(np.ceil(start)) // interval) * interval
+        last = None if end is None else (int(np.floor(end)) + 1) // interval * interval
+        if first is not None and last is not None and last <= first:
+            return self.table(start, end).downsample(interval)
+
+        rows = self.levels[level]
+        lo = 0 if first is None else int(np.searchsorted(rows["unix"], first, side="left"))
+        hi = len(rows) if last is None else max(lo, int(np.searchsorted(rows["unix"], last, side="left")))
+        parts = [np.array(rows[lo:hi])]
+
+        # the partial buckets at either end
+        if first is not None and start < first:
+            parts.append(self._rollup(start, first - 1, interval))
+        if last is not None and last <= end:
+            parts.append(self._rollup(last, end, interval))
+
+        return rollup_stats(merge_rollup(np.concatenate(parts), interval))
+
+    def _rollup(self, start, end, interval):
+        table = self.table(start, end)
+        return rollup(table.unix, table.valid_heart_rate(), interval)
+
+def _rollup_records(path, first, count, chunk=1 << 22):
+    # the heart rate of records first to count rolled up into the finest PYRAMID level
+    rows = []
+    if count > first:
+        unix = np.memmap(os.path.join(path, "unix.bin"), dtype="<u4", mode="r", shape=(count,))
+        heart_rate = np.memmap(os.path.join(path, "heart_rate.bin"), dtype="u1", mode="r", shape=(count,))
+        for lo in range(first, count, chunk):
+            hr = heart_rate[lo:lo + chunk]
+            rows.append(rollup(unix[lo:lo + chunk], np.where(hr >= ANOMALY_HEART_RATE, hr, np.nan), PYRAMID[0]))
+        del unix, heart_rate
+
+    # buckets split between chunks are merged here
+    return merge_rollup(np.concatenate(rows) if rows else np.zeros(0, dtype=ROLLUP_DTYPE), PYRAMID[0])
+
+def _open_bucket(path, first, count, bucket):
+    # the first record of the last (still open) bucket of the coarsest level, records from there on are rolled
+    # up again on the next update. None when the records are out of order around it, then the next update rebuilds.
+    if bucket is None:
+        return None
+    unix = np.memmap(os.path.join(path, "unix.bin"), dtype="<u4", mode="r", shape=(count,))
+    before = unix[first:count] < bucket
+    split = int(np.count_nonzero(before))
+    ordered = not before[split:].any()
+    del unix
+    return {"index": first + split, "unix": bucket} if ordered else None
+
+def build_pyramid(path, count):
+    """
+    Rolls the heart rate of the first count records up into every PYRAMID level.
+    Returns the rows per level and where the next update_pyramid continues.
+    """
+    level = _rollup_records(path, 0, count)
+    pyramid = {}
+    for interval in PYRAMID:
+        if interval != PYRAMID[0]:
+            level = merge_rollup(level, interval)
+        with open(os.path.join(path, f"rollup_{interval}.bin"), "wb") as f:
+            f.write(level.tobytes())
+        pyramid[str(interval)] = len(level)
+
+    bucket = int(level["unix"][-1]) if len(level) else None
+    return pyramid, _open_bucket(path, 0, count, bucket)
+
+def update_pyramid(path, pyramid, open_bucket, count):
+    """
+    Rolls up the records from the open bucket of the last update to count and replaces the rows of every
+    level from that bucket on, the rows before it are final. Rebuilds every level when new records go back
+    before the open bucket. Returns the same as build_pyramid.
+    """
+    if open_bucket is None:
+        return build_pyramid(path, count)
+
+    first, bucket = open_bucket["index"], open_bucket["unix"]
+    unix = np.memmap(os.path.join(path, "unix.bin"), dtype="<u4", mode="r", shape=(count,))
+    behind = first < count and int(unix[first:count].min()) < bucket
+    del unix
+    if behind:
+        return build_pyramid(path, count)
+
+    level = _rollup_records(path, first, count)
+    updated = {}
+    for interval in PYRAMID:
+        if interval != PYRAMID[0]:
+            level = merge_rollup(level, interval)
+
+        # rows from the open bucket on are replaced, which also drops rows of an update that crashed before meta.json
+        file_path = os.path.join(path, f"rollup_{interval}.bin")
+        rows = min(pyramid[str(interval)], os.path.getsize(file_path) // ROLLUP_DTYPE.itemsize)
+        existing = np.memmap(file_path, dtype=ROLLUP_DTYPE, mode="r", shape=(rows,)) if rows else np.zeros(0, dtype=ROLLUP_DTYPE)
+        keep = int(np.searchsorted(existing["unix"], bucket, side="left"))
+        del existing
+        with open(file_path, "r+b") as f:
+            f.truncate(keep * ROLLUP_DTYPE.itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(level.tobytes())
+        updated[str(interval)] = keep + len(level)
+
+    last = int(level["unix"][-1]) if len(level) else bucket
+    return updated, _open_bucket(path, first, count, last)
+
+def load_table(file_path, start=None, end=None):
+    """
+    Returns a HistoricalTable of the records between start and end of a raw dump or a history store directory.
+    A raw dump must be sorted by unix time, reading stops at the first batch past end.
+    """
+    if os.path.isdir(file_path):
+        return HistoryStore(file_path).table(start, end)
+
+    start, end = to_epoch(start), to_epoch(end)
+    tables = []
+    for table in iter_tables(file_path):
+        if end is not None and len(table) and table.unix[0] > end:
+            break
+        tables.append(table.between(start, end))
+
+    return HistoricalTable.concat(tables)
+
+def _reset(path):
+    for name in COLUMNS:
+        open(os.path.join(path, name + ".bin"), "wb").close()
+    open(os.path.join(path, "index.bin"), "wb").close()
+
+def _write_meta(path, meta):
+    tmp = os.path.join(path, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+def _truncate(path, count, block_size):
+    # drop anything written after the last committed meta.json, and the index entry of a partial last block
+    for name, (dtype, shape) in COLUMNS.items():
+        with open(os.path.join(path, name + ".bin"), "r+b") as f:
+            f.truncate(count * dtype.itemsize * int(np.prod(shape, dtype=np.int64)))
+
+    with open(os.path.join(path, "index.bin"), "r+b") as f:
+        f.truncate((count // block_size) * 8)
+
+def _update_index(path, first, count, block_size):
+    # append index entries for every block from block first on
+    lo = first * block_size
+    if lo >= count:
+        return
+
+    unix = np.memmap(os.path.join(path, "unix.bin"), dtype="<u4", mode="r", shape=(count,))
+    starts = np.arange(0, count - lo, block_size)
+    index = np.empty((len(starts), 2), dtype="<u4")
+    index[:, 0] = np.minimum.reduceat(unix[lo:], starts)
+    index[:, 1] = np.maximum.reduceat(unix[lo:], starts)
+    del unix
+
+    with open(os.path.join(path, "index.bin"), "ab") as f:
+        f.write(index.tobytes())
+
+def convert(file_path, path, block_size=BLOCK_SIZE):
+    """
+    Converts a raw historical dump into a history store, decoding only the bytes appended since the last conversion.
+    Returns the number of records added.
+    """
+    os.makedirs(path, exist_ok=True)
+
+    meta = None
+    if os.path.exists(os.path.join(path, "meta.json")):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+    size = os.path.getsize(file_path)
+
+    # start over if the dump was truncated or rewritten since the last conversion
+    if (meta is None or meta["version"] != STORE_VERSION or meta["block_size"] != block_size
+            or meta["offset"] > size or meta["head"] != head_checksum(file_path, meta["offset"])):
+        _reset(path)
+        meta = {"version": STORE_VERSION, "block_size": block_size, "source": os.path.abspath(file_path), "offset": 0, "head": 0, "count": 0}
+        _write_meta(path, meta)
+
+    _truncate(path, meta["count"], block_size)
+
+    added = 0
+    offset = meta["offset"]
+    files = {name: open(os.path.join(path, name + ".bin"), "ab") for name in COLUMNS}
+    try:
+        for offset, table in iter_windows(file_path, offset=offset, partial=True):
+            for name in COLUMNS:
+                files[name].write(np.ascontiguousarray(getattr(table, name)).tobytes())
+            added += len(table)
+    finally:
+        for f in files.values():
+            f.close()
+
+    # the last partial block is the first one to be reindexed
+    _update_index(path, meta["count"] // block_size, meta["count"] + added, block_size)
+    meta["count"] += added
+
+    if "pyramid" not in meta:
+        meta["pyramid"], meta["open_bucket"] = build_pyramid(path, meta["count"])
+    elif added:
+        meta["pyramid"], meta["open_bucket"] = update_pyramid(path, meta["pyramid"], meta.get("open_bucket"), meta["count"])
+
+    meta["offset"] = offset
+    meta["head"] = head_checksum(file_path, offset)
+    _write_meta(path, meta)
+
+    return added
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: store.py whoop_hist.bin whoop_hist.store")
+        sys.exit(1)
+
+    added = convert(sys.argv[1], sys.argv[2])
+    store = HistoryStore(sys.argv[2])
+    print(f"added {added} records, {len(store)} total")
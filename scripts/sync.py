@@ -0,0 +1,148 @@
+import os, json, asyncio
+from parser import *
+
+class HistorySync:
+    """
+    Appends synced history chunks to a dump and keeps a cursor of the last acknowledged chunk next to it.
+    A chunk is written and fsynced, then the cursor is saved, and only then is its trim acknowledged,
+    so after a dropped connection the strap resends just the chunks that were not acknowledged yet.
+    Records whose (unix, subsec) was in the last committed chunk are dropped, so a chunk that is sent twice
+    is stored once. Other records at or before the cursor time are kept and reported, the strap clock moved back.
+    A chunk during which the framer dropped bytes may be missing frames, it is never committed or acknowledged.
+    """
+    def __init__(self, file_path="whoop_hist.bin", state_path=None):
+        self.file_path = file_path
+        self.state_path = state_path or file_path + ".sync.json"
+        self.pending = []
+        self.chunks = []
+        self.dropped = 0
+
+        self.state = {"trim": None, "unix": 0, "bytes": 0, "chunks": 0, "acked": True, "recent": []}
+        size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state.update(json.load(f))
+        elif size:
+            self._adopt()
+        if size < self.state["bytes"]:
+            # the dump was truncated or replaced, rebuild the cursor from what is in it
+            print("history dump shorter than the sync cursor, rebuilding the cursor from the dump")
+            self.state.update({"unix": 0, "bytes": 0, "recent": []})
+            if size:
+                self._adopt()
+        if size > self.state["bytes"]:
+            # drop a chunk that was written but never committed
+            with open(file_path, "r+b") as f:
+                f.truncate(self.state["bytes"])
+
+    def _adopt(self, recent=4096):
+        # a dump without a cursor, keep its complete frames and treat its last records as the last chunk
+        for offset, table in iter_windows(self.file_path, partial=True, trusted=True):
+            self.state["bytes"] = offset
+            if len(table):
+                self.state["unix"] = max(self.state["unix"], int(table.unix.max()))
+                self.state["recent"] = (self.state["recent"] + record_keys(table).tolist())[-recent:]
+
+    def __repr__(self):
+        return f"HistorySync(file={self.file_path}, chunks={self.state['chunks']}, trim={self.state['trim']}, unix={self.state['unix']}, pending={len(self.pending)})"
+
+    def reset(self, dropped=0):
+        """
+        Called on connect with the dropped_bytes of the data framer, drops the frames of a chunk that never ended
+        and of ended chunks that were not committed, the strap sends them again.
+        """
+        self.pending = []
+        self.chunks = []
+        self.dropped = dropped
+
+    def start_chunk(self):
+        """
+        Called on HISTORY_START, drops the frames of a chunk that never ended.
+        """
+        self.pending = []
+
+    def add(self, frame):
+        self.pending.append(frame)
+
+    def end_chunk(self, metapkt, dropped=0):
+        """
+        Called on HISTORY_END with its metadata packet and the dropped_bytes of the data framer, the frames received
+        since the start are committed by the commit call for that packet. If the framer dropped anything since
+        the last chunk ended, a frame of this chunk, or its HISTORY_START, may be lost and the chunk is marked bad.
+        """
+        self.chunks.append((metapkt, None if dropped != self.dropped else self.pending))
+        self.pending = []
+        self.dropped = dropped
+
+    def _write(self, data, state):
+        if data:
+            with open(self.file_path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.state_path)
+
+    async def commit(self, metapkt):
+        """
+        Durably appends the chunk ended by the HISTORY_END metapkt and saves the cursor from it.
+        Returns the trim to acknowledge, call acked once it has been sent, or None for a chunk that lost frames
+        or is not known, which must not be acknowledged so the strap sends it again.
+        """
+        trim = metapkt.decode().trim
+        frames = None
+        while self.chunks:
+            end, chunk = self.chunks.pop(0)
+            if end is metapkt:
+                frames = chunk
+                break
+        if frames is None:
+            return None
+
+        data = b""
+        state = dict(self.state)
+        if frames:
+            table = HistoricalTable.from_buffer(b"".join(frames), verify=False)
+            keys = record_keys(table)
+            fresh = ~np.isin(keys, np.array(self.state["recent"], dtype=np.int64))
+            back = int(np.count_nonzero(fresh & (table.unix <= self.state["unix"])))
+            if back:
+                print(f"{back} history records at or before the sync cursor {timestring(self.state['unix'])}, the strap clock moved back")
+            keep = np.flatnonzero(fresh).tolist()
+            data = b"".join(frames[i] for i in keep)
+            if keep:
+                state["unix"] = int(table.unix[keep].max())
+            state["recent"] = keys.tolist()
+
+        state.update({"trim": trim, "bytes": self.state["bytes"] + len(data), "chunks": self.state["chunks"] + 1, "acked": False})
+        await asyncio.to_thread(self._write, data, state)
+        self.state = state
+
+        return trim
+
+    async def acked(self):
+        self.state["acked"] = True
+        await asyncio.to_thread(self._write, b"", dict(self.state))
+
+    def unacked_trim(self):
+        """
+        The trim of a committed chunk whose acknowledgement may never have reached the strap, or None.
+        """
+        return None if self.state["acked"] else self.state["trim"]
+
+def record_keys(table):
+    """
+    (unix, subsec) of every record of a table as one int64 each, what duplicate records are found by.
+    """
+    return table.unix.astype(np.int64) << 16 | table.subsec.astype(np.int64)
+
+def history_result(trim):
+    """
+    HISTORICAL_DATA_RESULT data acknowledging a chunk up to trim.
+    """
+    return struct.pack("<BLL", 1, trim, 0)
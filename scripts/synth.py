@@ -0,0 +1,97 @@
+import argparse, zlib, numpy as np
+from parser import *
+
+DAY = 24 * 60 * 60
+
+def synth_table(start, count, seed=0, anomaly_rate=0.0005, anomaly_length=30):
+    """
+    Generates count one second HISTORICAL_DATA records from unix time start.
+    Heart rate follows a day/night curve with noise, rr intervals match the heart rate,
+    and off wrist stretches (heart rate and rr count 0) of anomaly_length records on average
+    start with probability anomaly_rate per record.
+    """
+    rng = np.random.default_rng(seed)
+    unix = np.arange(start, start + count, dtype=np.int64)
+
+    # slow daily cycle, lowest around 4am, plus a random walk and beat to beat noise
+    phase = 2 * np.pi * ((unix % DAY) / DAY - 4 / 24)
+    walk = np.cumsum(rng.normal(0, 0.3, count))
+    window = min(301, count)
+    walk -= np.convolve(walk, np.ones(window) / window, mode="same")
+    heart = 68 - 14 * np.cos(phase) + walk + rng.normal(0, 2, count)
+    heart = np.clip(np.rint(heart), 35, 190).astype(np.uint8)
+
+    # one beat every 60 / hr seconds, so the number of rr intervals per second follows the heart rate
+    beats = np.diff(np.floor(np.cumsum(heart / 60.0) + rng.random()), prepend=0)
+    rr_count = np.clip(beats, 0, 4).astype(np.uint8)
+    rr = 60000.0 / heart[:, None] + rng.normal(0, 25, (count, 4))
+    rr = np.clip(np.rint(rr), 250, 2000).astype(np.uint16)
+
+    # off wrist stretches
+    starts = np.flatnonzero(rng.random(count) < anomaly_rate)
+    lengths = rng.geometric(1.0 / anomaly_length, len(starts))
+    off = np.zeros(count + 1, dtype=np.int64)
+    np.add.at(off, starts, 1)
+    np.add.at(off, np.minimum(starts + lengths, count), -1)
+    off = np.cumsum(off[:count]) > 0
+    heart[off] = 0
+    rr_count[off] = 0
+
+    rr[np.arange(4) >= rr_count[:, None]] = 0
+    subsec = rng.integers(0, 65536, count, dtype=np.uint16)
+
+    return HistoricalTable(unix.astype(np.uint32), subsec, heart, rr_count, rr)
+
+def frame_table(table, length=95, seq=0):
+    """
+    Frames every record of a table as a HISTORICAL_DATA packet of length bytes, crc8 and crc32 included.
+    """
+    rows = np.zeros(len(table), dtype=historical_dtype(length))
+    blen = struct.pack("<H", length - 4)
+    rows["sof"] = WhoopPacket.sof
+    rows["length"] = length - 4
+    rows["crc8"] = crc8(blen)
+    rows["type"] = PacketType.HISTORICAL_DATA.value
+    rows["seq"] = (np.arange(len(table)) + seq) & 0xFF
+    rows["unix"] = table.unix
+    rows["subsec"] = table.subsec
+    rows["heart_rate"] = table.heart_rate
+    rows["rr_count"] = table.rr_count
+    rows["rr"] = table.rr
+
+    frames = rows.view(np.uint8).reshape(len(table), length)
+    crc = np.empty(len(table), dtype="<u4")
+    for i, frame in enumerate(frames):
+        crc[i] = zlib.crc32(frame[4:length - 4])
+    frames[:, length - 4:] = crc.view(np.uint8).reshape(-1, 4)
+
+    return frames.tobytes()
+
+def write_dump(file_path, days=1.0, start=1735362000, seed=0, anomaly_rate=0.0005, anomaly_length=30, length=95):
+    """
+    Writes a dump of days of one second records, one day at a time. Returns the number of records.
+    """
+    total = int(days * DAY)
+    with open(file_path, "wb") as f:
+        for offset in range(0, total, DAY):
+            count = min(DAY, total - offset)
+            table = synth_table(start + offset, count, seed=seed + offset // DAY, anomaly_rate=anomaly_rate, anomaly_length=anomaly_length)
+            f.write(frame_table(table, length, seq=offset))
+
+    return total
+
+def main():
+    parser = argparse.ArgumentParser(description="write a synthetic WHOOP historical data dump")
+    parser.add_argument("file", help="path of the dump to write")
+    parser.add_argument("--days", type=float, default=1.0, help="days of one second records (default is 1)")
+    parser.add_argument("--start", type=int, default=1735362000, help="unix time of the first record")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default is 0)")
+    parser.add_argument("--anomaly_rate", type=float, default=0.0005, help="chance per record of an off wrist stretch starting")
+    parser.add_argument("--anomaly_length", type=float, default=30, help="average length of an off wrist stretch in records")
+    args = parser.parse_args()
+
+    count = write_dump(args.file, args.days, args.start, args.seed, args.anomaly_rate, args.anomaly_length)
+    print(f"wrote {count} records to {args.file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+import asyncio
+from simulator import *
+
+def test_corrupted_history_loses_no_records(tmp_path):
+    async def run():
+        strap = StrapSimulator(0.01, 50, seed=3, corrupt=0.01)
+        session = StrapSession(FakeTransport(strap), str(tmp_path), "sim", timeout=0.5, command_timeout=0.5, backoff=Backoff(0.01, 0.05))
+        collector = Collector([session])
+
+        async def stop_when_synced():
+            while not session.syncs:
+                await asyncio.sleep(0.01)
+            collector.stop()
+
+        asyncio.create_task(stop_when_synced())
+        await asyncio.wait_for(collector.run(), 60)
+        return strap, session
+
+    strap, session = asyncio.run(run())
+    assert strap.corrupted
+    assert session.data_framer.dropped_frames and session.errors
+    assert (tmp_path / "whoop_hist.bin").read_bytes() == strap.frames
@@ -0,0 +1,32 @@
+from framer import *
+from synth import *
+
+def test_resync_and_drop_counting():
+    data = frame_table(synth_table(1735362000, 10))
+    frames = [data[i:i + 95] for i in range(0, len(data), 95)]
+
+    # noise before the first frame, a bad crc32 in the third and the rest split at odd sizes
+    noise = b"\x01\x02\xaa\x03"
+    bad = bytearray(frames[2])
+    bad[50] ^= 0xFF
+    stream = noise + b"".join(frames[:2]) + bytes(bad) + b"".join(frames[3:])
+
+    framer = Framer()
+    out = []
+    for pos in range(0, len(stream), 37):
+        out += framer.feed(stream[pos:pos + 37])
+
+    assert [frame for frame, packet in out] == frames[:2] + frames[3:]
+    assert framer.frames == 9
+    assert framer.dropped_frames == 1
+    # every byte fed is either in a frame or counted as dropped
+    assert framer.dropped_bytes == len(noise) + len(bad)
+    assert len(framer.buffer) == 0
+
+def test_reset_counts_a_partial_frame():
+    data = frame_table(synth_table(1735362000, 2))
+    framer = Framer()
+    assert len(framer.feed(data[:95 + 40])) == 1
+    framer.reset()
+    assert framer.dropped_bytes == 40
+    assert [frame for frame, packet in framer.feed(data[95:])] == [data[95:]]
@@ -0,0 +1,15 @@
+import numpy as np
+from hrvstream import *
+
+def test_sliding_and_tumbling_windows_share_edges():
+    # a beat exactly on every window edge
+    rng = np.random.default_rng(0)
+    times = np.repeat(np.arange(1800, dtype=np.int64), 2)
+    rrs = rng.integers(600, 1100, len(times))
+
+    slid = {due - 300: metrics for due, metrics in sliding(times, rrs, 300, 300)}
+    tumbled = dict(tumbling(times, rrs, 300))
+    assert list(slid) == list(tumbled)
+    for start, metrics in tumbled.items():
+        assert metrics["beats"] == 600
+        assert slid[start] == metrics
@@ -0,0 +1,28 @@
+import numpy as np
+from ingest import *
+from ingest import _frame_at
+from synth import *
+
+def test_overlapping_dumps_and_shard_splits(tmp_path):
+    table = synth_table(1735362000, 6000)
+    first = tmp_path / "whoop_hist_1.bin"
+    second = tmp_path / "whoop_hist_2.bin"
+    # overlapping dumps, the second one changes frame length halfway so some splits have to walk the frames
+    first.write_bytes(frame_table(table.slice(0, 3500)))
+    second.write_bytes(frame_table(table.slice(2000, 4500)) + frame_table(table.slice(4500, 6000), length=100))
+
+    shards = split_file(str(second), 20000)
+    assert len(shards) > 10
+    data = second.read_bytes()
+    for lo, hi in shards[1:]:
+        assert _frame_at(data, lo, 95) or _frame_at(data, lo, 100)
+
+    timeline = ingest([str(tmp_path)], workers=2, shard_bytes=20000)
+    assert np.array_equal(timeline.table.unix, table.unix)
+    assert np.array_equal(timeline.table.subsec, table.subsec)
+    assert np.array_equal(timeline.table.rr, table.rr)
+    # the overlap is taken from the first dump
+    assert np.all(timeline.source[:3500] == 0) and np.all(timeline.source[3500:] == 1)
+
+    timeline.write_dump(str(tmp_path / "merged.bin"))
+    assert (tmp_path / "merged.bin").read_bytes() == first.read_bytes() + data[1500 * 95:]
@@ -0,0 +1,42 @@
+import os
+from logstore import *
+
+def lines(count, start=1735362000):
+    return [LogLine(start + i, 0, i & 0xFF, f"task {'sensor' if i % 3 else 'radio'} tick {i}") for i in range(count)]
+
+def test_segment_roll_and_query(tmp_path):
+    path = str(tmp_path / "logs")
+    store = LogStore(path, segment_bytes=2000, block_records=8)
+    store.extend(lines(500))
+    store.close()
+    assert len(store.segments) > 5
+    assert store.dropped == 0
+
+    expected = lines(500)
+    for store in (LogStore(path, readonly=True), LogStore(path, indexed=False)):
+        assert len(store) == 500
+        assert store.query() == expected
+        assert store.query(1735362100, 1735362109) == expected[100:110]
+        assert store.query(words="RADIO") == [line for line in expected if "radio" in line.text]
+        assert store.query(1735362200, words=["radio", "tick"], limit=3) == [line for line in expected[200:] if "radio" in line.text][:3]
+        assert store.query(contains="tick 42") == [line for line in expected if "tick 42" in line.text]
+        assert store.query(words="missing") == []
+        store.close()
+
+def test_index_is_rebuilt_after_a_crash(tmp_path):
+    path = str(tmp_path / "logs")
+    store = LogStore(path, segment_bytes=2000, block_records=8)
+    store.extend(lines(100))
+    store.close()
+
+    # the last segment lost its index and the end of its last record
+    last = store.segments[-1]
+    os.remove(last.index_path)
+    with open(last.log_path, "r+b") as f:
+        f.truncate(last.bytes - 3)
+
+    store = LogStore(path, segment_bytes=2000, block_records=8)
+    assert store.query() == lines(99)
+    store.extend(lines(1, 1735363000))
+    store.close()
+    assert LogStore(path, readonly=True).query(1735363000) == lines(1, 1735363000)
@@ -0,0 +1,42 @@
+import numpy as np
+from parser import *
+from synth import *
+
+def hold(values):
+    records = [HistoricalRecord(i, value, []) for i, value in enumerate(values)]
+    HistoricalRecord.interpolate_anomalies(records)
+    return [record.heart_rate for record in records]
+
+def test_hold_without_valid_values():
+    # one or two anomalies are kept as they are, from three on they become the default
+    assert hold([0]) == [0]
+    assert hold([0, 5]) == [0, 5]
+    assert hold([0, 0, 0]) == [ANOMALY_DEFAULT] * 3
+    assert hold([0, 70]) == [70, 70]
+    assert hold([70, 0]) == [70, 70]
+
+def test_fill_gaps_policies():
+    values = np.array([0, 60, 0, 70, 0, 0, 0, 100, 0, 0], dtype=np.float64)
+    valid = values > 0
+    expected = {
+        "hold": [60, 60, 65, 70, 100, 100, 100, 100, 100, 100],
+        "linear": [60, 60, 65, 70, 77.5, 85, 92.5, 100, 100, 100],
+        "nearest": [60, 60, 60, 70, 70, 70, 100, 100, 100, 100],
+        "nan": [np.nan, 60, np.nan, 70, np.nan, np.nan, np.nan, 100, np.nan, np.nan],
+    }
+    for policy, filled in expected.items():
+        out, mask = fill_gaps(values, valid, policy)
+        assert np.array_equal(out, filled, equal_nan=True)
+        assert np.array_equal(mask, ~valid if policy != "nan" else np.zeros(len(values), dtype=bool))
+
+    # runs longer than max_gap stay nan
+    out, mask = fill_gaps(values, valid, "linear", max_gap=2)
+    assert np.array_equal(out, [60, 60, 65, 70, np.nan, np.nan, np.nan, 100, 100, 100], equal_nan=True)
+    assert np.flatnonzero(mask).tolist() == [0, 2, 8, 9]
+
+def test_table_fill_matches_records():
+    table = synth_table(1735362000, 20000, anomaly_rate=0.005)
+    for policy in FILL_POLICIES:
+        filled, _ = table.interpolate_anomalies(policy, 40)
+        records = HistoricalRecord.interpolate_anomalies(table.records(), policy, 40)
+        assert np.array_equal(filled, [record.heart_rate for record in records], equal_nan=True)
@@ -0,0 +1,69 @@
+import asyncio
+from pipeline import *
+
+# REPORT_VERSION_INFO response captured from a strap, header seq 0xb9 is the strap's counter and the request seq 0x0a is the first data byte
+VERSION_RESPONSE = bytes.fromhex("aa50000c24b9070a0101290000001000000006000000000000001100000002000000020000000000000003000000050000000000000000000000030000000c0000000100000000000000080201000000bdc1a75b")
+
+def test_dispatch_matches_echoed_seq():
+    async def run():
+        sent = []
+        pipeline = CommandPipeline(None, timeout=1.0, retries=0)
+
+        async def send(frame):
+            sent.append(WhoopPacket.from_data(frame))
+            assert pipeline.dispatch(WhoopPacket.from_data(VERSION_RESPONSE))
+
+        pipeline.send = send
+        pipeline.seq = 0x09
+        response = await pipeline.request(CommandNumber.REPORT_VERSION_INFO)
+        assert sent[0].seq == 0x0a
+        assert response.seq == 0xb9
+        assert str(response.decode()) == "version harvard(41.16.6.0) boylston(17.2.2.0)"
+        assert pipeline.stats() == {"in_flight": 0, "sent": 1, "responses": 1, "unmatched": 0, "timeouts": 0}
+
+    asyncio.run(run())
+
+def test_dispatch_ignores_header_seq():
+    pipeline = CommandPipeline(None)
+    pipeline.pending[(0xb9, CommandNumber.REPORT_VERSION_INFO.value)] = None
+    assert not pipeline.dispatch(WhoopPacket.from_data(VERSION_RESPONSE))
+    assert pipeline.unmatched == 1
+
+def test_posted_seqs_are_held_until_they_expire():
+    async def run():
+        pipeline = CommandPipeline(None, timeout=0.05)
+
+        async def send(frame):
+            pass
+
+        pipeline.send = send
+        pipeline.seq = 0xFF
+        await pipeline.post(CommandNumber.HISTORICAL_DATA_RESULT)
+        pipeline.seq = 0xFF
+        await pipeline.post(CommandNumber.HISTORICAL_DATA_RESULT)
+        assert sorted(pipeline.posted) == [(0, CommandNumber.HISTORICAL_DATA_RESULT.value), (1, CommandNumber.HISTORICAL_DATA_RESULT.value)]
+
+        await asyncio.sleep(0.06)
+        await pipeline.post(CommandNumber.GET_CLOCK)
+        assert list(pipeline.posted) == [(2, CommandNumber.GET_CLOCK.value)]
+
+    asyncio.run(run())
+
+def test_only_idempotent_commands_are_retried():
+    async def run():
+        sent = []
+        pipeline = CommandPipeline(None, timeout=0.01, retries=2)
+
+        async def send(frame):
+            sent.append(WhoopPacket.from_data(frame).cmd)
+
+        pipeline.send = send
+        for cmd in (CommandNumber.START_RAW_DATA, CommandNumber.GET_CLOCK):
+            try:
+                await pipeline.request(cmd)
+            except Exception:
+                pass
+        assert sent == [CommandNumber.START_RAW_DATA.value] + [CommandNumber.GET_CLOCK.value] * 3
+        assert pipeline.timeouts == 4
+
+    asyncio.run(run())
@@ -0,0 +1,17 @@
+import time
+from sink import *
+
+def test_close_without_wait_on_a_full_queue(tmp_path):
+    closed = []
+    sink = FileSink(str(tmp_path / "out.bin"), "wb", max_queue=4, flush_interval=0.05, on_close=lambda: closed.append(True))
+    queued = sum(sink.write(b"x" * 10) for _ in range(1000))
+    assert sink.dropped == 1000 - queued
+
+    start = time.monotonic()
+    sink.close(wait=False)
+    assert time.monotonic() - start < 0.05
+
+    sink.thread.join(5)
+    assert not sink.thread.is_alive()
+    assert closed == [True]
+    assert (tmp_path / "out.bin").read_bytes() == b"x" * 10 * queued
@@ -0,0 +1,24 @@
+import numpy as np
+from spectrum import *
+from hrvstream import *
+from synth import *
+
+def test_welch_batch_matches_per_window():
+    table = synth_table(1735362000, 3600, seed=1, anomaly_rate=0)
+    times, rrs = table_beats(table)
+    out = frequency_windows(times, rrs, 300)
+
+    # every window on its own, from the beats of the records inside it
+    t, rr = beat_times(times, rrs)
+    for i, start in enumerate(out["start"].tolist()):
+        inside = (times >= start) & (times < start + 300)
+        assert np.all((t[inside] >= start) & (t[inside] < start + 300))
+        values, valid = resample(t, rr, 4.0, start, start + 300)
+        freqs, psd = welch_batch(values)
+        powers = band_powers(freqs, psd)
+        assert np.isclose(out["coverage"][i], valid.mean())
+        for name in ("lf", "hf"):
+            assert np.isclose(out[name][i], powers[name][0])
+
+    # the same windows tumbling counts the beats in
+    assert out["start"].tolist() == [start for start, metrics in tumbling(times, rrs, 300)]
@@ -0,0 +1,44 @@
+import numpy as np
+from store import *
+from synth import *
+
+def test_incremental_convert_matches_a_full_one(tmp_path):
+    table = synth_table(1735362000, 4 * 3600, anomaly_rate=0.002)
+    data = frame_table(table)
+    dump = tmp_path / "hist.bin"
+
+    # the dump grows by a partial frame, then by the rest
+    cut = 3000 * 95 + 40
+    dump.write_bytes(data[:cut])
+    assert convert(str(dump), str(tmp_path / "store"), block_size=256) == 3000
+    with open(dump, "ab") as f:
+        f.write(data[cut:])
+    assert convert(str(dump), str(tmp_path / "store"), block_size=256) == len(table) - 3000
+    assert convert(str(dump), str(tmp_path / "full"), block_size=256) == len(table)
+
+    store = HistoryStore(str(tmp_path / "store"))
+    full = HistoryStore(str(tmp_path / "full"))
+    assert np.array_equal(store.table().unix, table.unix)
+    assert np.array_equal(store.table().rr, table.rr)
+    assert np.array_equal(store.block_min, full.block_min) and np.array_equal(store.block_max, full.block_max)
+    assert store.levels.keys() == full.levels.keys()
+    for interval in store.levels:
+        assert np.array_equal(store.levels[interval], full.levels[interval])
+
+def test_store_downsample_matches_the_table(tmp_path):
+    table = synth_table(1735362000, 6 * 3600, anomaly_rate=0.002)
+    dump = tmp_path / "hist.bin"
+    dump.write_bytes(frame_table(table))
+    convert(str(dump), str(tmp_path / "store"))
+    store = HistoryStore(str(tmp_path / "store"))
+
+    # bounds on and off bucket edges, within one bucket and open ended
+    bounds = [(None, None), (1735362000, 1735383599), (1735362017, 1735380001), (1735365000, 1735365010), (1735370123, None), (None, 1735370123)]
+    for interval in (5, 60, 300, 900, 3600, 7):
+        for start, end in bounds:
+            expected = table.between(start, end).downsample(interval)
+            got = store.downsample(interval, start, end)
+            assert np.array_equal(got["unix"], expected["unix"])
+            assert np.array_equal(got["count"], expected["count"])
+            assert np.allclose(got["mean"], expected["mean"])
+            assert np.array_equal(got["min"], expected["min"]) and np.array_equal(got["max"], expected["max"])
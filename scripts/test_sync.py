@@ -0,0 +1,107 @@
+import os, json, asyncio
+from sync import *
+from synth import *
+
+def history_end(unix, trim):
+    data = struct.pack("<LHLL", unix, 0, 50, trim) + bytes(9)
+    return WhoopPacket(PacketType.METADATA, 0, MetadataType.HISTORY_END, data)
+
+def chunks(table, size=50, length=95):
+    frames = frame_table(table)
+    return [[frames[offset:offset + length] for offset in range(start, min(start + size * length, len(frames)), length)]
+            for start in range(0, len(frames), size * length)]
+
+def send(sync, frames, trim, unix=1735362000):
+    sync.start_chunk()
+    for frame in frames:
+        sync.add(frame)
+    end = history_end(unix, trim)
+    sync.end_chunk(end)
+    return end
+
+def test_cursor_is_saved_before_the_ack(tmp_path):
+    async def run():
+        first, second = chunks(synth_table(1735362000, 100))
+        sync = HistorySync(str(tmp_path / "hist.bin"))
+        assert await sync.commit(send(sync, first, 1)) == 1
+
+        # written and fsynced, the cursor is on disk but the trim not acknowledged yet
+        with open(sync.state_path) as f:
+            state = json.load(f)
+        assert state["trim"] == 1 and not state["acked"]
+        assert state["bytes"] == 50 * 95 == os.path.getsize(sync.file_path)
+        assert HistorySync(sync.file_path).unacked_trim() == 1
+
+        await sync.acked()
+        assert HistorySync(sync.file_path).unacked_trim() is None
+
+        # a chunk written but never committed is dropped on the next start
+        with open(sync.file_path, "ab") as f:
+            f.write(b"".join(second))
+        sync = HistorySync(sync.file_path)
+        assert os.path.getsize(sync.file_path) == 50 * 95
+        assert sync.state["unix"] == 1735362049
+
+    asyncio.run(run())
+
+def test_resent_chunk_is_stored_once(tmp_path):
+    async def run():
+        first, second = chunks(synth_table(1735362000, 100))
+        sync = HistorySync(str(tmp_path / "hist.bin"))
+        assert await sync.commit(send(sync, first, 1)) == 1
+
+        # the ack was lost, the strap sends the chunk again
+        sync = HistorySync(sync.file_path)
+        assert sync.unacked_trim() == 1
+        await sync.acked()
+        assert await sync.commit(send(sync, first, 1)) == 1
+        await sync.acked()
+        assert os.path.getsize(sync.file_path) == 50 * 95
+
+        # a resent chunk overlapping the next one only adds the new records
+        assert await sync.commit(send(sync, first[25:] + second, 2)) == 2
+        await sync.acked()
+        assert sync.state["chunks"] == 3 and sync.state["unix"] == 1735362099
+
+    asyncio.run(run())
+    assert (tmp_path / "hist.bin").read_bytes() == frame_table(synth_table(1735362000, 100))
+
+def test_chunk_with_dropped_bytes_is_not_committed(tmp_path):
+    async def run():
+        first, = chunks(synth_table(1735362000, 50))
+        sync = HistorySync(str(tmp_path / "hist.bin"))
+        sync.reset(10)
+        sync.start_chunk()
+        for frame in first[1:]:
+            sync.add(frame)
+        end = history_end(1735362000, 1)
+        sync.end_chunk(end, 105)
+        assert await sync.commit(end) is None
+        assert sync.state["trim"] is None and sync.state["bytes"] == 0
+
+    asyncio.run(run())
+
+def test_reconnect_drops_uncommitted_chunks(tmp_path):
+    async def run():
+        table = synth_table(1735362000, 150)
+        first, second, third = chunks(table)
+        sync = HistorySync(str(tmp_path / "hist.bin"))
+
+        # two chunks ended before the link dropped, only the first was committed
+        assert await sync.commit(send(sync, first, 1)) == 1
+        await sync.acked()
+        send(sync, second, 2)
+        sync.reset()
+        assert sync.chunks == [] and sync.pending == []
+
+        # the strap resends the second chunk, followed by the third
+        for trim, frames in ((2, second), (3, third)):
+            assert await sync.commit(send(sync, frames, trim)) == trim
+            await sync.acked()
+
+        # a HISTORY_END the sync never saw the chunk of is not acknowledged
+        assert await sync.commit(history_end(1735362000, 4)) is None
+        assert sync.state["trim"] == 3
+
+    asyncio.run(run())
+    assert (tmp_path / "hist.bin").read_bytes() == frame_table(synth_table(1735362000, 150))
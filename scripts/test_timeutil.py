@@ -0,0 +1,11 @@
+import datetime, pytz
+from timeutil import *
+
+def test_dst_boundaries_match_astimezone():
+    tz = pytz.timezone("US/Eastern")
+    # 2025-03-09 2am EST and 2025-11-02 2am EDT
+    for transition in (1741503600, 1762063200):
+        for unix in range(transition - 2, transition + 3):
+            local = datetime.datetime.fromtimestamp(unix, datetime.timezone.utc).astimezone(tz)
+            assert timestring(unix, "US/Eastern") == local.strftime(DATE_FORMAT)
+            assert local_seconds([unix], "US/Eastern")[0] == unix + local.utcoffset().total_seconds()
@@ -0,0 +1,105 @@
+import bisect, datetime, functools
+
+# pytz and numpy are imported where they are used, formatting a single timestamp should not load numpy
+
+DATE_FORMAT = "%Y-%m-%d %I:%M:%S %p"
+EPOCH = datetime.datetime(1970, 1, 1)
+
+_timezone = "US/Eastern"
+
+def set_timezone(name):
+    """
+    Sets the timezone used for every timestamp we print or parse, US/Eastern by default.
+    """
+    import pytz
+
+    global _timezone
+    pytz.timezone(name)
+    _timezone = name
+
+def get_timezone():
+    import pytz
+
+    return pytz.timezone(_timezone)
+
+def _utc_offset(tz, unix):
+    return int(datetime.datetime.fromtimestamp(unix, tz).utcoffset().total_seconds())
+
+@functools.lru_cache(maxsize=None)
+def transition_table(name, first=0, last=2**31, step=7 * 86400):
+    """
+    Returns the utc transition times and the utc offset from each of them on, both in seconds, of a timezone.
+    The offset is sampled every step seconds from first to last (1970 to 2038, where pytz has transitions)
+    and every change is searched down to the second, offsets before first and after last are those at first and last.
+    """
+    import pytz
+
+    tz = pytz.timezone(name)
+    transitions = [-2**62]
+    offsets = [_utc_offset(tz, first)]
+    lo = first
+    for hi in range(first + step, last + step, step):
+        offset = _utc_offset(tz, hi)
+        if offset == offsets[-1]:
+            lo = hi
+            continue
+
+        # the first second with the new offset
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if _utc_offset(tz, mid) == offsets[-1]:
+                lo = mid
+            else:
+                hi = mid
+        transitions.append(hi)
+        offsets.append(_utc_offset(tz, hi))
+        lo = hi
+    return transitions, offsets
+
+def span_table(start, end, name=None):
+    """
+    Returns the part of the transition table covering unix times start to end, as numpy arrays.
+    """
+    import numpy as np
+
+    transitions, offsets = transition_table(name or _timezone)
+    lo = bisect.bisect_right(transitions, start) - 1
+    hi = bisect.bisect_right(transitions, end)
+    return np.array(transitions[lo:hi], dtype=np.int64), np.array(offsets[lo:hi], dtype=np.int64)
+
+def local_seconds(unix, name=None):
+    """
+    Converts an array of unix times to local wall clock seconds in one pass.
+    """
+    import numpy as np
+
+    unix = np.floor(np.asarray(unix)).astype(np.int64)
+    if unix.size == 0:
+        return unix
+
+    transitions, offsets = span_table(int(unix.min()), int(unix.max()), name)
+    return unix + offsets[np.searchsorted(transitions, unix, side="right") - 1]
+
+def local_second(unix, name=None):
+    transitions, offsets = transition_table(name or _timezone)
+    unix = int(unix // 1)
+    return unix + offsets[bisect.bisect_right(transitions, unix) - 1]
+
+def to_datetime64(unix, name=None):
+    """
+    Converts an array of unix times to naive local datetime64 values, e.g. for a plot axis.
+    """
+    return local_seconds(unix, name).astype("datetime64[s]")
+
+@functools.lru_cache(maxsize=65536)
+def format_local(seconds):
+    return (EPOCH + datetime.timedelta(seconds=seconds)).strftime(DATE_FORMAT)
+
+def timestring(unix, name=None):
+    return format_local(local_second(unix, name))
+
+def timestrings(unix, name=None):
+    """
+    Formats an array of unix times as local time labels.
+    """
+    return [format_local(seconds) for seconds in local_seconds(unix, name).tolist()]
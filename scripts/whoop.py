@@ -1,199 +1,143 @@
-import sys, argparse, asyncio
-from packet import *
-from bleak import BleakClient, BleakScanner
-
-WHOOP_SERVICE = "61080001-8d6d-82b8-614a-1c8cb0f8dcc6"
-WHOOP_CHAR_CMD_TO_STRAP = "61080002-8d6d-82b8-614a-1c8cb0f8dcc6"
-WHOOP_CHAR_CMD_FROM_STRAP = "61080003-8d6d-82b8-614a-1c8cb0f8dcc6"
-WHOOP_CHAR_EVENTS_FROM_STRAP = "61080004-8d6d-82b8-614a-1c8cb0f8dcc6"
-WHOOP_CHAR_DATA_FROM_STRAP = "61080005-8d6d-82b8-614a-1c8cb0f8dcc6"
-WHOOP_CHAR_MEMFAULT = "61080007-8D6D-82B8-614A-1C8CB0F8DCC6"
-
-cmdresp = asyncio.Queue()
-meta_queue = asyncio.Queue()
-verbose = False
-fp = open("whoop_hist.bin", "wb")
-logsfp = open("logs.bin", "ab")
-
-async def cmd_handler(sender, data):
-    packet = WhoopPacket.from_data(data)
-    await cmdresp.put(packet)
-
-    if verbose:
-        print(f"cmd: {data.hex()}")
-        print(packet)
-
-def events_handler(sender, data):
-    try:
-        packet = WhoopPacket.from_data(data)
-    except:
-        print("events exception")
-        return
-
-    if verbose:
-        print(f"events: {data.hex()}")
-        print(packet)
-
-async def data_handler(sender, data):
-    packet = WhoopPacket.from_data(data)
-
-    if verbose:
-        print(f"data: {data.hex()}")
-        print(packet)
-
-    # write this to disk
-    if packet.type == PacketType.HISTORICAL_DATA:
-        fp.write(data)
-        fp.flush()
-        #print(packet)
-
-    if packet.type == PacketType.METADATA:
-        print(packet)
-        await meta_queue.put(packet)
-    
-    if packet.type == PacketType.CONSOLE_LOGS:
-        logsfp.write(packet.__str__().encode().replace(b"\x34\x00\x01", b""))
-        logsfp.flush()
-
-def memfault_handler(sender, data):
-    #print(f"memfault: {data.hex()}")
-    pass
+import sys, time, argparse, asyncio
+from collector import *
 
 #pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.GET_HELLO_HARVARD, data=b"\x00").framed_packet()
 #aa8c004a2419230a0104ba02000000eedf6e67a0680000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000011000000020000000200000000000000c3425a4e
 
 running = True
 
-from prompt_toolkit import prompt
-from prompt_toolkit.history import InMemoryHistory
-command_history = InMemoryHistory()
+# prompt_toolkit and bleak are only imported once they are needed, so --help and errors come back quickly
+command_history = None
 def get_input():
+    from prompt_toolkit import prompt
+    from prompt_toolkit.history import InMemoryHistory
+
+    global command_history
+    if command_history is None:
+        command_history = InMemoryHistory()
     user_input = prompt("> ", history=command_history)
     return user_input.strip().lower()
 
-async def command_listener(client):
-    global history_index, verbose, running
-    
+async def run_command(session, command):
+    global running
+
+    if command == "startreal":
+        await session.commands.post(CommandNumber.TOGGLE_REALTIME_HR, b"\x01")
+    elif command == "stopreal":
+        await session.commands.post(CommandNumber.TOGGLE_REALTIME_HR, b"\x00")
+    elif command == "clock":
+        print(await session.commands.request(CommandNumber.GET_CLOCK, b"\x00", retries=0))
+    elif command == "ghr_on":
+        await session.commands.post(CommandNumber.TOGGLE_GENERIC_HR_PROFILE, b"\x01")
+    elif command == "ghr_off":
+        await session.commands.post(CommandNumber.TOGGLE_GENERIC_HR_PROFILE, b"\x00")
+    elif command == "battery":
+        print(await session.commands.request(CommandNumber.GET_BATTERY_LEVEL, b"\x00", retries=0))
+    elif command == "version":
+        # aa50000c24b8070a0101290000001000000006000000000000001100000002000000020000000000000003000000050000000000000000000000030000000c00000001000000000000000802010000002006f9a7
+        # aa50000c24b9070a0101290000001000000006000000000000001100000002000000020000000000000003000000050000000000000000000000030000000c0000000100000000000000080201000000bdc1a75b
+        # aa50000c24ba070a0101290000001000000006000000000000001100000002000000020000000000000003000000050000000000000000000000030000000c00000001000000000000000802010000005b8f3584
+        print(await session.commands.request(CommandNumber.REPORT_VERSION_INFO, b"\x00", retries=0))
+    elif command == "force":
+        # have not gotten this to work, in android app it seems to be some 8 byte buffer with 2 ints in it - which I would think correspond to the log!
+        await session.commands.post(CommandNumber.FORCE_TRIM, struct.pack("<LL", 0, 0))
+    elif command == "test":
+        
+        session.verbose = True
+        # pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.RUN_HAPTICS_PATTERN, data=b"\x00").framed_packet()
+        # pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.RUN_ALARM, data=b"\x00").framed_packet()
+        # pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.START_DEVICE_CONFIG_KEY_EXCHANGE, data=b"\x01").framed_packet()
+        # await session.send(pkt)
+        
+        # print(await session.commands.request(...))
+
+        # for i in range(20):
+        #     pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.SEND_NEXT_DEVICE_CONFIG, data=struct.pack("<B", i)).framed_packet()
+        #     await session.send(pkt)
+        print(await session.commands.request(CommandNumber.GET_HELLO_HARVARD, b"\x00", retries=0))
+
+        # 0a0104a0030000003e8e7967e8730000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000011000000020000000200000000000000, off wrist
+        # 0a0104a0030000005f8e7967483e0000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000, on wrist
+        # 0a0104a003000000858e7967284f0000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000, on wrist
+        # 0a01049f030000009f8e7967706b0000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000011000000020000000200000000000000, off wrist
+        # 0a01048d030000008faa7967e8130000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000
+        # 0a01048e03000001a3aa796718300000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000
+        # 0a01049303000000c1aa796730390000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000        
+        # 0a01049503000001eaaa7967500b0000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000
+    elif command == "history":
+        await session.sync_history()
+        print(session.history_sync)
+    elif command == "stats":
+        print(f"cmd {session.cmd_framer}")
+        print(f"events {session.events_framer}")
+        print(f"data {session.data_framer}")
+        print(session.history_sync)
+        print(session.logs)
+        print(session.commands)
+        if session.capture is not None:
+            print(session.capture)
+    elif command == "logs":
+        # the console log lines of the last hour
+        for line in session.logs.query(time.time() - 3600):
+            print(line)
+    elif command == "metrics":
+        print(session.metrics.prometheus(), end="")
+    elif command == "hrv":
+        # from the realtime rr intervals, run startreal first
+        session.hrv.expire(time.time())
+        print(session.hrv)
+    elif command == "realtime":
+        # the last minute of realtime samples, run startreal first
+        rows = session.realtime.window(60)
+        print(session.realtime)
+        if len(rows):
+            print(f"{timestring(int(rows['unix'][0]))} to {timestring(int(rows['unix'][-1]))} heart rate {rows['heart_rate'].mean():.1f} (min {rows['heart_rate'].min()}, max {rows['heart_rate'].max()})")
+    elif command == "startraw":
+        # raw sensor data is captured to raw.bin until stopraw
+        print(session.start_capture())
+        await session.commands.post(CommandNumber.START_RAW_DATA, b"\x01")
+    elif command == "stopraw":
+        await session.commands.post(CommandNumber.STOP_RAW_DATA, b"\x01")
+        print(session.stop_capture())
+    elif command == "reboot":
+        await session.commands.post(CommandNumber.REBOOT_STRAP)
+        running = False
+    elif command == "exit":
+        print("exiting")
+        running = False
+    else:
+        print(f"unknown command: {command}")
+
+async def command_listener(session):
+    """
+    Reads commands, several commands separated by ; are sent pipelined and run concurrently.
+    """
     while running:
-        command = await asyncio.to_thread(get_input)
+        line = await asyncio.to_thread(get_input)
         #command = (await asyncio.to_thread(input, "> ")).strip().lower()
-        if command:
-            command_history.append_string(command)
-        if command == "startreal":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.TOGGLE_REALTIME_HR, data=b"\x01").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-        elif command == "stopreal":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.TOGGLE_REALTIME_HR, data=b"\x00").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-        elif command == "clock":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.GET_CLOCK, data=b"\x00").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-        elif command == "ghr_on":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.TOGGLE_GENERIC_HR_PROFILE, data=b"\x01").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-        elif command == "ghr_off":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.TOGGLE_GENERIC_HR_PROFILE, data=b"\x00").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-        elif command == "battery":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.GET_BATTERY_LEVEL, data=b"\x00").framed_packet()
-            print(pkt.hex())
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-            pkt = await cmdresp.get()
-            print(pkt)
-        elif command == "version":
-            # aa50000c24b8070a0101290000001000000006000000000000001100000002000000020000000000000003000000050000000000000000000000030000000c00000001000000000000000802010000002006f9a7
-            # aa50000c24b9070a0101290000001000000006000000000000001100000002000000020000000000000003000000050000000000000000000000030000000c0000000100000000000000080201000000bdc1a75b
-            # aa50000c24ba070a0101290000001000000006000000000000001100000002000000020000000000000003000000050000000000000000000000030000000c00000001000000000000000802010000005b8f3584
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.REPORT_VERSION_INFO, data=b"\x00").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-            pkt = await cmdresp.get()
-            print(pkt)
-        elif command == "force":
-            # have not gotten this to work, in android app it seems to be some 8 byte buffer with 2 ints in it - which I would think correspond to the log!
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.FORCE_TRIM, data=struct.pack("<LL", 0, 0)).framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-        elif command == "test":
-            
-            verbose = True
-            # pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.RUN_HAPTICS_PATTERN, data=b"\x00").framed_packet()
-            # pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.RUN_ALARM, data=b"\x00").framed_packet()
-            # pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.START_DEVICE_CONFIG_KEY_EXCHANGE, data=b"\x01").framed_packet()
-            # await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-            
-            # pkt = await cmdresp.get()
-            # print(pkt)
-
-            # for i in range(20):
-            #     pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.SEND_NEXT_DEVICE_CONFIG, data=struct.pack("<B", i)).framed_packet()
-            #     await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-                
-            #     pkt = await cmdresp.get()
-                # print(pkt)
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.GET_HELLO_HARVARD, data=b"\x00").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-
-            # 0a0104a0030000003e8e7967e8730000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000011000000020000000200000000000000, off wrist
-            # 0a0104a0030000005f8e7967483e0000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000, on wrist
-            # 0a0104a003000000858e7967284f0000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000, on wrist
-            # 0a01049f030000009f8e7967706b0000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000011000000020000000200000000000000, off wrist
-            # 0a01048d030000008faa7967e8130000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000
-            # 0a01048e03000001a3aa796718300000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000
-            # 0a01049303000000c1aa796730390000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000        
-            # 0a01049503000001eaaa7967500b0000344331383635323239006233636265376430373232323366393138666261623236666536643061393962666236643932656634393436663231653930623031340600000002000000100000002900000010000000060000000000000008020100000000000111000000020000000200000000000000
-        elif command == "history":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.SEND_HISTORICAL_DATA, data=b"\x00").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-            pkt = await cmdresp.get()
-            print(pkt)
-            # 0a020b0000
-
-            # wait until the end, we will receive a few of these
-            while True:
-                # this should be the start metadata
-                metapkt = await meta_queue.get()
-
-                # get the first history end
-                while MetadataType(metapkt.cmd) != MetadataType.HISTORY_END and MetadataType(metapkt.cmd) != MetadataType.HISTORY_COMPLETE:
-                    print(metapkt)
-                    metapkt = await meta_queue.get()
-
-                # reached the complete metadata
-                if MetadataType(metapkt.cmd) == MetadataType.HISTORY_COMPLETE:
-                    break
-
-                unix, subsec, unk0, trim = struct.unpack("<LHLL", metapkt.data[:14])
-                data = struct.pack("<BLL", 1, trim, 0)
-                pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.HISTORICAL_DATA_RESULT, data=data).framed_packet()
-                await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-        elif command == "startraw":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.START_RAW_DATA, data=b"\x01").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-        elif command == "stopraw":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.STOP_RAW_DATA, data=b"\x01").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-        elif command == "reboot":
-            pkt = WhoopPacket(PacketType.COMMAND, 10, CommandNumber.REBOOT_STRAP, data=b"\x00").framed_packet()
-            await client.write_gatt_char(WHOOP_CHAR_CMD_TO_STRAP, pkt)
-            running = False
-        elif command == "exit":
-            print("exiting")
-            running = False
-        else:
-            print(f"unknown command: {command}")
+        if line:
+            command_history.append_string(line)
+
+        commands = [command.strip() for command in line.split(";")]
+        results = await asyncio.gather(*(run_command(session, command) for command in commands), return_exceptions=True)
+        for command, result in zip(commands, results):
+            if isinstance(result, Exception):
+                print(f"{command} failed: {result}")
 
 async def whoop_bluetooth(address):
-    client = BleakClient(address)
-    await client.connect()
-    if client.is_connected:
+    session = StrapSession(BleakTransport(address))
+    try:
+        try:
+            await session.connect()
+        except Exception as e:
+            print(f"failed to connect to {address}: {type(e).__name__} {e}")
+            return
         print(f"connected to {address}")
-        # setup notify
-        await client.start_notify(WHOOP_CHAR_CMD_FROM_STRAP, cmd_handler)
-        await client.start_notify(WHOOP_CHAR_EVENTS_FROM_STRAP, events_handler)
-        await client.start_notify(WHOOP_CHAR_DATA_FROM_STRAP, data_handler)
-        await client.start_notify(WHOOP_CHAR_MEMFAULT, memfault_handler)
-        await command_listener(client)
-    else:
-        print(f"failed to connect to {address}")
+        await command_listener(session)
+    except Exception as e:
+        print(f"{type(e).__name__} {e}")
+    finally:
+        session.close()
 
 async def main():
     parser = argparse.ArgumentParser(description="WHOOP debug client")
@@ -209,6 +153,7 @@ async def main():
         type=str,
         help="Bluetooth device name (e.g., 'WHOOP XXXXXXXXX')."
     )
+    add_metrics_arguments(parser)
 
     args = parser.parse_args()
 
@@ -229,6 +174,8 @@ async def main():
     if address is None:
         print(f"resolving device by name: {args.name}")
         try:
+            from bleak import BleakScanner
+
             address = await BleakScanner.find_device_by_name(args.name)
             if address is None:
                 print(f"error: device with name '{args.name}' not found")
@@ -239,7 +186,11 @@ async def main():
 
     print(address)
 
-    await whoop_bluetooth(address)
+    stop_metrics = await start_metrics(args)
+    try:
+        await whoop_bluetooth(address)
+    finally:
+        stop_metrics()
 
 if __name__ == "__main__":
     try: